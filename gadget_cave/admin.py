@@ -1,11 +1,57 @@
 # gadget_cave/admin.py
-from django.contrib import admin
+import itertools
+import os
+import uuid
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.core.files.storage import default_storage
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils import timezone
 from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 
-from .models import Category, Product, ProductImage, Order, OrderItem, Cart, CartItem, CustomUser
+from . import analytics
+from .carts import summary_changed
+from .catalog_io import export_catalog
+from .forms import CatalogImportForm
+from .images import processing_status
+from .inventory_feed import update_products
+from .order_export import KINDS as ORDER_EXPORT_KINDS, export_orders, parse_moment
+from .order_status import transition
+from .models import (
+    Category, Product, ProductImage, Order, OrderItem, Cart, CartItem, CustomUser, DailySales, InventoryChange, OrderTransition, RollupWatermark, Task,
+)
+from .pagination import EstimatedCountPaginator
+from .search import search_filter
+from .tasks import enqueue
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 
+# Streamed downloads (catalog and order exports). Under ASGI a plain
+# iterator would be read into memory whole before the first byte is sent, so
+# it is advanced in chunks in a thread instead.
+async def _aiterate(lines, chunk=200):
+    take = sync_to_async(lambda: list(itertools.islice(lines, chunk)))
+    while part := await take():
+        for line in part:
+            yield line
+
+
+def _download(request, lines, filename, content_type):
+    if isinstance(request, ASGIRequest):
+        lines = _aiterate(iter(lines))
+    response = StreamingHttpResponse(lines, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
 # Custom User Admin
 @admin.register(CustomUser)
 class CustomUserAdmin(BaseUserAdmin):
@@ -26,12 +72,29 @@ class CategoryAdmin(admin.ModelAdmin):
     prepopulated_fields = {'slug': ('name',)}
     search_fields = ['name']
 
+# Badge for the status of an image's background processing task (see images.processing_status)
+PROCESSING_BADGES = {'queued': 'secondary', 'running': 'info', 'done': 'success', 'failed': 'danger'}
+
+
+def processing_badge(status):
+    if status is None:
+        return "-"
+    return format_html('<span class="badge badge-{}">{}</span>', PROCESSING_BADGES.get(status, 'secondary'), status)
+
+
 # ProductImage Inline
 class ProductImageInline(admin.TabularInline):
     model = ProductImage
     extra = 1
-    fields = ['image', 'is_main', 'description', 'image_preview']
-    readonly_fields = ['image_preview']
+    fields = ['image', 'is_main', 'description', 'image_preview', 'processing_display']
+    readonly_fields = ['image_preview', 'processing_display']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(processing=processing_status('gadget_cave.productimage'))
+
+    def processing_display(self, obj):
+        return processing_badge(getattr(obj, 'processing', None))
+    processing_display.short_description = "Processing"
 
     def image_preview(self, obj):
         if obj.image:
@@ -42,13 +105,15 @@ class ProductImageInline(admin.TabularInline):
 # Product Admin
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ['name', 'slug', 'price', 'stock', 'available', 'created', 'updated', 'category', 'main_image_preview']
+    list_display = ['name', 'slug', 'sku', 'price', 'stock', 'reserved', 'available', 'created', 'updated', 'category', 'main_image_preview', 'processing_display']
     list_filter = ['available', 'created', 'updated', 'category']
     list_editable = ['price', 'stock', 'available']
     prepopulated_fields = {'slug': ('name',)}
     inlines = [ProductImageInline]
     search_fields = ['name', 'description']
     raw_id_fields = ['category']
+    list_select_related = ['category']
+    show_full_result_count = False
 
     def main_image_preview(self, obj):
         if obj.main_image:
@@ -56,14 +121,108 @@ class ProductAdmin(admin.ModelAdmin):
         return "(No Main Image)"
     main_image_preview.short_description = "Main Image"
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(processing=processing_status('gadget_cave.product'))
+
+    def get_search_results(self, request, queryset, search_term):
+        # Full-text index instead of LIKE '%term%' scans over name and description;
+        # the scan only runs for what the index can't match, like the middle of a word
+        condition = search_filter(search_term)
+        if condition is not None and queryset.filter(condition).exists():
+            return queryset.filter(condition), False
+        return super().get_search_results(request, queryset, search_term)
+
+    def processing_display(self, obj):
+        return processing_badge(obj.processing)
+    processing_display.short_description = "Image Processing"
+    processing_display.admin_order_field = 'processing'
+
+    # list_editable saves don't save() each edited row (and run its signals):
+    # save_model collects the edits and they are written as one bulk update,
+    # with an audit trail (see gadget_cave/inventory_feed.py).
+    def changelist_view(self, request, extra_context=None):
+        if request.method != 'POST' or '_save' not in request.POST:
+            return super().changelist_view(request, extra_context)
+        request.inventory_edits = {}
+        with transaction.atomic():
+            response = super().changelist_view(request, extra_context)
+            if request.inventory_edits:
+                update_products(request.inventory_edits, key='id', on_hand=False, source='admin', user=request.user)
+        return response
+
+    def save_model(self, request, obj, form, change):
+        edits = getattr(request, 'inventory_edits', None)
+        if edits is not None and change and set(form.changed_data) <= set(self.list_editable):
+            edits[obj.pk] = {field: form.cleaned_data[field] for field in form.changed_data}
+            return
+        super().save_model(request, obj, form, change)
+
+    actions = ['export_csv']
+
+    def export_csv(self, request, queryset):
+        # Streamed a chunk of products at a time (see gadget_cave/catalog_io.py)
+        products = Product.objects.filter(pk__in=queryset.values('pk'))
+        return _download(request, export_catalog('csv', products), 'products.csv', 'text/csv')
+    export_csv.short_description = 'Export selected products (CSV)'
+
+    # Catalog import: the upload is stored and imported by a background task
+    # (`manage.py run_tasks`), since a large file takes longer than a request.
+    def get_urls(self):
+        return [
+            path('import/', self.admin_site.admin_view(self.import_view), name='gadget_cave_product_import'),
+        ] + super().get_urls()
+
+    def import_view(self, request):
+        if not (self.has_add_permission(request) and self.has_change_permission(request)):
+            raise PermissionDenied
+        form = CatalogImportForm(request.POST or None, request.FILES or None)
+        if form.is_valid():
+            upload = form.cleaned_data['file']
+            name = default_storage.save(f'imports/{uuid.uuid4().hex}{os.path.splitext(upload.name)[1].lower()}', upload)
+            queued = enqueue('import_catalog', {
+                'name': name, 'fmt': upload.catalog_format,
+                'images_dir': getattr(settings, 'CATALOG_IMPORT_IMAGES_DIR', None),
+            })
+            self.message_user(request, f'{upload.name} was queued for import (task {queued.id}).')
+            return redirect('admin:gadget_cave_product_changelist')
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Import products',
+            'form': form,
+        }
+        return TemplateResponse(request, 'admin/gadget_cave/product/import.html', context)
+
+# Inventory audit trail (read-only)
+@admin.register(InventoryChange)
+class InventoryChangeAdmin(admin.ModelAdmin):
+    list_display = ['created', 'product', 'field', 'old_value', 'new_value', 'on_hand', 'source', 'user', 'batch']
+    list_filter = ['field', 'source', 'created']
+    search_fields = ['product__sku', 'product__name', 'source']
+    raw_id_fields = ['product', 'user']
+    list_select_related = ['product', 'user']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
 # OrderItem Inline (This is what enables showing product details inside an order)
 class OrderItemInline(admin.TabularInline):
     model = OrderItem
     extra = 0
-    readonly_fields = ['product_display_name', 'product_category', 'price', 'quantity', 'get_cost_display']
+    # 'product' is read-only like the rest of the line: an editable raw-id widget
+    # looks its label up with one query per row.
+    readonly_fields = ['product', 'product_display_name', 'product_category', 'price', 'quantity', 'get_cost_display']
     fields = ['product', 'product_display_name', 'product_category', 'price', 'quantity', 'get_cost_display']
     raw_id_fields = ['product']
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product__category')
+
     def product_display_name(self, obj):
         return obj.product.name if obj.product else "N/A"
     product_display_name.short_description = 'Product Name'
@@ -73,7 +232,7 @@ class OrderItemInline(admin.TabularInline):
     product_category.short_description = 'Category'
 
     def get_cost_display(self, obj):
-        return f"₹{obj.get_cost():.2f}"
+        return f"₹{obj.get_cost():.2f}" if obj.price is not None else "N/A"
     get_cost_display.short_description = 'Item Total'
 
 # Order Admin
@@ -90,53 +249,152 @@ class OrderAdmin(admin.ModelAdmin):
     'phone', 'house_shop_no', 'address', 'landmark', 'city', 'district', 'state', 'postal_code',
     'paid', 'transaction_id',
     'get_product_names',  # ✅ Add this line here
-    'created', 'updated', 'status', 'payment_status', 'get_total_cost_display'
+    'created', 'updated', 'status', 'payment_status', 'item_count_display', 'get_total_cost_display'
 ]
     list_filter = ['paid', 'created', 'updated', 'status', 'payment_status']
     search_fields = ['user__username', 'first_name', 'last_name', 'email', 'transaction_id', 'phone']
     inlines = [OrderItemInline] # This line is crucial for displaying order items
+    list_select_related = ['user']
+    # The orders table is large: estimate the unfiltered count and skip the
+    # second full COUNT(*) the changelist runs for "N total".
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        # Totals and product names come from one aggregated query (see OrderQuerySet.with_totals)
+        return super().get_queryset(request).with_totals()
 
     def user_display_name(self, obj):
         return obj.user.username if obj.user else "Guest"
     user_display_name.short_description = 'User'
+    user_display_name.admin_order_field = 'user__username'
+
+    def item_count_display(self, obj):
+        return obj.item_count
+    item_count_display.short_description = 'Items'
+    item_count_display.admin_order_field = 'item_count'
 
     def get_total_cost_display(self, obj):
         return f"₹{obj.get_total_cost():.2f}"
     get_total_cost_display.short_description = 'Order Total'
+    get_total_cost_display.admin_order_field = 'total_cost'
+
+    # Finance exports: streamed rows with SQL totals instead of this changelist.
+    # The changelist's created/status/paid filters carry over (see its template).
+    def get_urls(self):
+        return [
+            path('export/', self.admin_site.admin_view(self.export_view), name='gadget_cave_order_export'),
+        ] + super().get_urls()
 
-    actions = ['make_paid', 'mark_as_shipped']
+    def export_view(self, request):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        kind = request.GET.get('kind', 'orders')
+        fmt = request.GET.get('format', 'csv')
+        paid = request.GET.get('paid__exact')
+        if kind not in ORDER_EXPORT_KINDS or fmt not in ('csv', 'jsonl') or paid not in (None, '0', '1'):
+            return HttpResponseBadRequest('Unknown kind, format or paid filter.')
+        try:
+            since = parse_moment(request.GET.get('created__gte'))
+            until = parse_moment(request.GET.get('created__lt'))
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        lines = export_orders(
+            fmt, kind, since, until, status=request.GET.get('status__exact'), paid=None if paid is None else paid == '1',
+        )
+        content_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+        return _download(request, lines, f'{kind}.{fmt}', content_type)
+
+    actions = ['make_paid', 'mark_as_processing', 'mark_as_shipped', 'mark_as_delivered', 'cancel_orders', 'refund_orders']
+
+    # Validated, batched moves through the order state machine (gadget_cave/order_status.py)
+    def _transition(self, request, queryset, action, done):
+        result = transition(queryset, action, source='admin', user=request.user)
+        self.message_user(request, f"{result['changed']} orders were successfully {done}.")
+        if result['skipped']:
+            self.message_user(
+                request, f"{result['skipped']} orders were skipped: they can't be {done} from their current status or payment status.",
+                messages.WARNING,
+            )
 
     def make_paid(self, request, queryset):
-        updated = queryset.update(paid=True, payment_status='completed')
-        self.message_user(request, f'{updated} orders were successfully marked as paid.')
+        self._transition(request, queryset, 'mark_paid', 'marked as paid')
     make_paid.short_description = 'Mark selected orders as paid'
 
+    def mark_as_processing(self, request, queryset):
+        self._transition(request, queryset, 'process', 'marked as processing')
+    mark_as_processing.short_description = 'Mark selected orders as processing'
+
     def mark_as_shipped(self, request, queryset):
-        updated = queryset.update(status='shipped')
-        self.message_user(request, f'{updated} orders were successfully marked as shipped.')
+        self._transition(request, queryset, 'ship', 'marked as shipped')
     mark_as_shipped.short_description = 'Mark selected orders as shipped'
 
+    def mark_as_delivered(self, request, queryset):
+        self._transition(request, queryset, 'deliver', 'marked as delivered')
+    mark_as_delivered.short_description = 'Mark selected orders as delivered'
+
+    def cancel_orders(self, request, queryset):
+        self._transition(request, queryset, 'cancel', 'cancelled')
+    cancel_orders.short_description = 'Cancel selected orders and restock their items'
+
+    def refund_orders(self, request, queryset):
+        self._transition(request, queryset, 'refund', 'refunded')
+    refund_orders.short_description = 'Mark selected orders as refunded'
+
+
+@admin.register(OrderTransition)
+class OrderTransitionAdmin(admin.ModelAdmin):
+    list_display = ['created', 'order', 'action', 'from_status', 'to_status', 'from_payment_status', 'to_payment_status', 'source', 'user', 'batch']
+    list_filter = ['action', 'to_status', 'to_payment_status', 'source', 'created']
+    search_fields = ['order__id', 'source']
+    raw_id_fields = ['order', 'user']
+    list_select_related = ['order', 'user']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
 # Cart Admin
 @admin.register(Cart)
 class CartAdmin(admin.ModelAdmin):
     list_display = ['user_display_name', 'created_at', 'updated_at', 'get_total_cost_display']
     search_fields = ['user__username']
     inlines = []
+    list_select_related = ['user']
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_totals()
 
     def user_display_name(self, obj):
         return obj.user.username if obj.user else "N/A"
     user_display_name.short_description = 'User'
+    user_display_name.admin_order_field = 'user__username'
 
     def get_total_cost_display(self, obj):
         return f"₹{obj.get_total_cost():.2f}" if hasattr(obj, 'get_total_cost') else "N/A"
     get_total_cost_display.short_description = 'Cart Total'
+    get_total_cost_display.admin_order_field = 'total_cost'
+
+
+class CartListFilter(admin.RelatedFieldListFilter):
+    # The default filter renders str(cart) for every cart, which loads each cart's user separately
+    def field_choices(self, field, request, model_admin):
+        carts = Cart.objects.select_related('user').order_by('user__username')
+        return [(cart.pk, str(cart)) for cart in carts]
 
 # CartItem Admin
 @admin.register(CartItem)
 class CartItemAdmin(admin.ModelAdmin):
     list_display = ['cart_user', 'product_name', 'quantity', 'get_item_cost_display']
-    list_filter = ['cart']
+    list_filter = [('cart', CartListFilter)]
     search_fields = ['cart__user__username', 'product__name']
+    list_select_related = ['cart__user', 'product']
+    show_full_result_count = False
 
     def cart_user(self, obj):
         return obj.cart.user.username if obj.cart and obj.cart.user else "N/A"
@@ -148,4 +406,79 @@ class CartItemAdmin(admin.ModelAdmin):
 
     def get_item_cost_display(self, obj):
         return f"₹{obj.get_cost():.2f}" if hasattr(obj, 'get_cost') else "N/A"
-    get_item_cost_display.short_description = 'Item Total'
\ No newline at end of file
+    get_item_cost_display.short_description = 'Item Total'
+
+    # Keep the header cart badges (see gadget_cave/carts.py) in step with admin edits
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        summary_changed(obj.cart.user_id)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        summary_changed(obj.cart.user_id)
+
+    def delete_queryset(self, request, queryset):
+        user_ids = set(queryset.values_list('cart__user_id', flat=True))
+        super().delete_queryset(request, queryset)
+        summary_changed(*user_ids)
+
+# Task Admin (background queue, see gadget_cave/tasks.py)
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ['id', 'name', 'key', 'status', 'attempts', 'max_attempts', 'run_after', 'locked_by', 'updated', 'last_error']
+    list_filter = ['status', 'name']
+    search_fields = ['key']
+    readonly_fields = ['locked_by', 'locked_until', 'created', 'updated']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    actions = ['retry_tasks']
+
+    def retry_tasks(self, request, queryset):
+        updated = queryset.exclude(status='running').update(
+            status='queued', attempts=0, run_after=timezone.now(), last_error='', updated=timezone.now(),
+        )
+        self.message_user(request, f'{updated} tasks were queued again.')
+    retry_tasks.short_description = 'Retry selected tasks'
+
+
+# Sales dashboard: the "Daily sales" changelist, read from the rollups only
+# (`manage.py rollup_sales` keeps them current, see gadget_cave/analytics.py)
+@admin.register(DailySales)
+class SalesDashboardAdmin(admin.ModelAdmin):
+    PERIODS = (7, 30, 90, 365)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        try:
+            days = int(request.GET.get('days', 30))
+        except ValueError:
+            days = 30
+        if days not in self.PERIODS:
+            days = 30
+        last = timezone.localdate()
+        sales = analytics.dashboard(last - timedelta(days=days - 1), last)
+        peak = max((row['amount'] for row in sales['days']), default=0) or 1
+        for row in sales['days']:
+            row['width'] = round(row['amount'] / peak * 100)
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Sales',
+            'sales': sales,
+            'days': days,
+            'periods': self.PERIODS,
+            'watermark': RollupWatermark.objects.filter(name=analytics.WATERMARK).first(),
+            **(extra_context or {}),
+        }
+        return TemplateResponse(request, 'admin/gadget_cave/dailysales/dashboard.html', context)
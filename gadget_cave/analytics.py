@@ -0,0 +1,202 @@
+# gadget_cave/analytics.py
+#
+# Daily sales rollups (DailySales, ProductSales) and the admin sales
+# dashboard, which reads nothing but them.
+#
+# A day's rollup rows are always rebuilt whole from that day's orders, so
+# rebuilding a day twice, or one that hasn't changed, is harmless. The
+# incremental job (`manage.py rollup_sales`) rebuilds the days of the orders
+# updated since its watermark on Order.updated, which is why every write to
+# an order sets `updated`, queryset updates included. It stops LAG short of
+# now: a transaction still in flight may commit rows stamped a little
+# earlier, and those are read on the next run. A deleted order leaves no
+# row behind to find, so Order's post_delete queues a rebuild of its day.
+import itertools
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, Q, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .models import DailySales, Order, OrderItem, ProductSales, RollupWatermark, Task
+from .tasks import enqueue, task
+
+WATERMARK = 'sales'
+LAG = timedelta(seconds=getattr(settings, 'SALES_ROLLUP_LAG_SECONDS', 60))
+CHUNK_DAYS = getattr(settings, 'SALES_ROLLUP_CHUNK_DAYS', 7)
+BATCH_SIZE = 1000
+# What the dashboard counts as a sale
+SOLD = Q(paid=True) & ~Q(status='cancelled')
+
+_MONEY = DecimalField(max_digits=14, decimal_places=2)
+
+
+def _midnight(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def _daily_rows(start, end):
+    return (
+        Order.objects.filter(created__gte=start, created__lt=end)
+        .annotate(day=TruncDate('created'))
+        .values('day', 'status', 'payment_status', 'paid')
+        .annotate(
+            order_count=Count('id', distinct=True),
+            unit_count=Coalesce(Sum('items__quantity'), 0),
+            amount=Coalesce(Sum(F('items__price') * F('items__quantity'), output_field=_MONEY), Value(Decimal('0.00')), output_field=_MONEY),
+        )
+        .order_by()
+    )
+
+
+def _product_rows(start, end):
+    return (
+        OrderItem.objects.filter(order__created__gte=start, order__created__lt=end)
+        .annotate(day=TruncDate('order__created'))
+        .values('day', 'product', 'product__category', 'order__status', 'order__payment_status', 'order__paid')
+        .annotate(
+            order_count=Count('order', distinct=True),
+            unit_count=Sum('quantity'),
+            amount=Sum(F('price') * F('quantity'), output_field=_MONEY),
+        )
+        .order_by()
+    )
+
+
+def _insert(model, objs):
+    count = 0
+    objs = iter(objs)
+    while batch := list(itertools.islice(objs, BATCH_SIZE)):
+        model.objects.bulk_create(batch)
+        count += len(batch)
+    return count
+
+
+def rebuild_days(first, last):
+    """Rebuild the rollups of days first..last (inclusive) in one transaction; returns the rows written."""
+    start, end = _midnight(first), _midnight(last + timedelta(days=1))
+    with transaction.atomic():
+        DailySales.objects.filter(day__gte=first, day__lte=last).delete()
+        ProductSales.objects.filter(day__gte=first, day__lte=last).delete()
+        written = _insert(DailySales, (
+            DailySales(
+                day=row['day'], status=row['status'], payment_status=row['payment_status'], paid=row['paid'],
+                orders=row['order_count'], units=row['unit_count'], revenue=row['amount'],
+            )
+            for row in _daily_rows(start, end).iterator(chunk_size=BATCH_SIZE)
+        ))
+        written += _insert(ProductSales, (
+            ProductSales(
+                day=row['day'], product_id=row['product'], category_id=row['product__category'],
+                status=row['order__status'], payment_status=row['order__payment_status'], paid=row['order__paid'],
+                orders=row['order_count'], units=row['unit_count'], revenue=row['amount'],
+            )
+            for row in _product_rows(start, end).iterator(chunk_size=BATCH_SIZE)
+        ))
+    return written
+
+
+def _runs(days, length):
+    """Consecutive days grouped into (first, last) runs of at most `length` days."""
+    run = []
+    for day in sorted(days):
+        if run and day - run[-1] == timedelta(days=1) and len(run) < length:
+            run.append(day)
+            continue
+        if run:
+            yield run[0], run[-1]
+        run = [day]
+    if run:
+        yield run[0], run[-1]
+
+
+def _set_watermark(value):
+    RollupWatermark.objects.update_or_create(name=WATERMARK, defaults={'value': value})
+
+
+def backfill(since=None, until=None, chunk_days=CHUNK_DAYS, now=None, progress=None):
+    """
+    Rebuild every day from `since` (default: the first order's) to `until`
+    (default: today), chunk_days per transaction. A full backfill also sets
+    the watermark. Returns (days, rows written).
+    """
+    high = (now or timezone.now()) - LAG
+    full = since is None and until is None
+    if since is None:
+        first_order = Order.objects.order_by('created').values_list('created', flat=True).first()
+        since = timezone.localdate(first_order) if first_order else None
+    until = until or timezone.localdate(now or timezone.now())
+    days = rows = 0
+    day = since
+    while day is not None and day <= until:
+        last = min(day + timedelta(days=chunk_days - 1), until)
+        rows += rebuild_days(day, last)
+        days += (last - day).days + 1
+        if progress is not None:
+            progress(day, last, rows)
+        day = last + timedelta(days=1)
+    if full:
+        _set_watermark(high)
+    return days, rows
+
+
+def update_rollups(now=None, chunk_days=CHUNK_DAYS):
+    """
+    Rebuild the days of the orders changed since the watermark and move it
+    up; the first run backfills everything. Returns (days, rows written).
+    """
+    now = now or timezone.now()
+    watermark = RollupWatermark.objects.filter(name=WATERMARK).values_list('value', flat=True).first()
+    if watermark is None:
+        return backfill(chunk_days=chunk_days, now=now)
+    high = now - LAG
+    days = list(Order.objects.filter(updated__gt=watermark, updated__lte=high).dates('created', 'day'))
+    rows = sum(rebuild_days(first, last) for first, last in _runs(days, chunk_days))
+    _set_watermark(high)
+    return len(days), rows
+
+
+@task('rebuild_sales_day')
+def rebuild_sales_day(day):
+    rebuild_days(date.fromisoformat(day), date.fromisoformat(day))
+
+
+def queue_rebuild(created):
+    """
+    Rebuild the day of an order created at `created` in the background, once
+    the current transaction commits. A rebuild of that day that is still
+    queued will see the change, so many deletes queue one rebuild; a running
+    one may have read the day already and doesn't count.
+    """
+    day = timezone.localdate(created).isoformat()
+
+    def queue():
+        if not Task.objects.filter(name='rebuild_sales_day', status='queued', payload__day=day).exists():
+            enqueue('rebuild_sales_day', {'day': day})
+    transaction.on_commit(queue)
+
+
+# Dashboard
+
+def dashboard(first, last, top=10):
+    """Sales for days first..last, from the rollup tables alone."""
+    daily = DailySales.objects.filter(day__gte=first, day__lte=last)
+    products = ProductSales.objects.filter(day__gte=first, day__lte=last).filter(SOLD)
+    totals = {'order_count': Sum('orders'), 'unit_count': Sum('units'), 'amount': Sum('revenue')}
+    return {
+        'first': first,
+        'last': last,
+        'totals': daily.filter(SOLD).aggregate(**totals),
+        'days': list(daily.filter(SOLD).values('day').annotate(**totals).order_by('day')),
+        'by_status': list(daily.values('status', 'paid').annotate(**totals).order_by('status', 'paid')),
+        'by_payment_status': list(daily.values('payment_status').annotate(**totals).order_by('payment_status')),
+        'top_products': list(
+            products.values('product', 'product__name').annotate(unit_count=Sum('units'), amount=Sum('revenue')).order_by('-amount', 'product')[:top]
+        ),
+        'top_categories': list(
+            products.values('category', 'category__name').annotate(unit_count=Sum('units'), amount=Sum('revenue')).order_by('-amount', 'category')[:top]
+        ),
+    }
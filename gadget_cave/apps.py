@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class GadgetCaveConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'gadget_cave'
+
+    def ready(self):
+        from . import signals  # noqa: F401 (connects the cache invalidation receivers)
+        from . import catalog_io  # noqa: F401 (registers the import_catalog task)
@@ -0,0 +1,269 @@
+# gadget_cave/autocomplete.py
+#
+# Per-keystroke suggestions from an in-process prefix index, so typing in
+# the header search box never reaches the database.
+#
+# The index is two sorted lists of strings, "<normalized words>\0<ref>", one
+# for categories and one for products, with an entry starting at every word
+# of every category and available product name (so "wat" finds "Apple
+# Watch"); the key for the whole name has its ref marked with "^". A prefix
+# lookup is a bisect plus a short forward scan of each list.
+#
+# Requests only read the index. It is built, and kept current, by a
+# background thread (see start(), called from gadgetcave/wsgi.py and
+# asgi.py): changes made by other processes are picked up by a periodic
+# delta sync on Product.updated, and everything by an hourly rebuild.
+# Changes made in this process arrive straight away through signals (see
+# signals.py).
+import bisect
+import functools
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Category, Product
+
+logger = logging.getLogger(__name__)
+
+SUGGESTION_LIMIT = 8
+SYNC_SECONDS = getattr(settings, 'AUTOCOMPLETE_SYNC_SECONDS', 30)
+REBUILD_SECONDS = getattr(settings, 'AUTOCOMPLETE_REBUILD_SECONDS', 60 * 60)
+# Only entries for the first few words of a name; later words rarely start a search
+MAX_WORDS = 4
+SEPARATOR = '\0'
+NAME_START = '^'
+_WORD = re.compile(r'[^\W_]+')
+
+
+def normalize(text):
+    """Lowercase, strip accents and collapse everything but letters and digits to single spaces."""
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(_WORD.findall(text.lower()))
+
+
+class PrefixIndex:
+    def __init__(self):
+        self._keys = []
+        self._category_keys = []
+        # ref -> (kind, pk, label, slug); refs are 'p<pk>' and 'c<pk>'
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._built = False
+        self._synced_at = None
+        self._next_sync = self._next_rebuild = 0.0
+        self._thread = None
+        self._wake = threading.Event()
+        self._stopping = False
+
+    @staticmethod
+    def _keys_for(ref, label):
+        words = normalize(label).split()
+        return [
+            ' '.join(words[i:]) + SEPARATOR + (NAME_START if i == 0 else '') + ref
+            for i in range(min(len(words), MAX_WORDS))
+        ]
+
+    # Writes. Readers never take the lock: every change to the key lists is a
+    # single list operation (or a swap of the whole list), which is atomic under the GIL.
+
+    def _list_for(self, ref):
+        return self._category_keys if ref[0] == 'c' else self._keys
+
+    def _add(self, ref, entry):
+        self._remove(ref)
+        self._entries[ref] = entry
+        keys = self._list_for(ref)
+        for key in self._keys_for(ref, entry[2]):
+            bisect.insort(keys, key)
+
+    def _remove(self, ref):
+        entry = self._entries.pop(ref, None)
+        if entry is not None:
+            keys = self._list_for(ref)
+            for key in self._keys_for(ref, entry[2]):
+                i = bisect.bisect_left(keys, key)
+                if i < len(keys) and keys[i] == key:
+                    del keys[i]
+
+    def build(self):
+        """Load every available product and all categories; replaces the whole index."""
+        started = timezone.now()
+        entries = {f'c{pk}': ('category', pk, name, slug) for pk, name, slug in Category.objects.values_list('id', 'name', 'slug')}
+        products = Product.objects.filter(available=True).values_list('id', 'name', 'slug').iterator(chunk_size=5000)
+        entries.update((f'p{pk}', ('product', pk, name, slug)) for pk, name, slug in products)
+        self.load(entries, started)
+
+    def load(self, entries, synced_at=None):
+        """Replace the index with {ref: (kind, pk, label, slug)}."""
+        keys = sorted(key for ref, entry in entries.items() if ref[0] != 'c' for key in self._keys_for(ref, entry[2]))
+        category_keys = sorted(key for ref, entry in entries.items() if ref[0] == 'c' for key in self._keys_for(ref, entry[2]))
+        with self._lock:
+            self._entries, self._keys, self._category_keys = entries, keys, category_keys
+            self._built = True
+            self._synced_at = synced_at or timezone.now()
+            self._next_sync = time.monotonic() + SYNC_SECONDS
+            self._next_rebuild = time.monotonic() + REBUILD_SECONDS
+
+    def sync(self):
+        """
+        Apply product changes made since the last build/sync (by any process)
+        and reload the categories. Deleted products are only dropped by the
+        signals in the deleting process, or by the next full rebuild.
+        """
+        if not self._built:
+            return
+        started = timezone.now()
+        # Before the queries, so a sync requested while they run isn't lost
+        self._next_sync = time.monotonic() + SYNC_SECONDS
+        changed = Product.objects.filter(updated__gte=self._synced_at).values_list('id', 'name', 'slug', 'available')
+        categories = list(Category.objects.values_list('id', 'name', 'slug'))
+        with self._lock:
+            for pk, name, slug, available in changed:
+                if available:
+                    self._add(f'p{pk}', ('product', pk, name, slug))
+                else:
+                    self._remove(f'p{pk}')
+            current = {f'c{pk}' for pk, name, slug in categories}
+            for ref in [ref for ref in self._entries if ref[0] == 'c' and ref not in current]:
+                self._remove(ref)
+            for pk, name, slug in categories:
+                if self._entries.get(f'c{pk}') != ('category', pk, name, slug):
+                    self._add(f'c{pk}', ('category', pk, name, slug))
+            self._synced_at = started
+
+    def refresh(self):
+        """Build the index, or sync or rebuild it when that's due. Run by the background thread."""
+        with self._refresh_lock:
+            now = time.monotonic()
+            if not self._built or now >= self._next_rebuild:
+                self.build()
+            elif now >= self._next_sync:
+                self.sync()
+
+    def request_sync(self):
+        """Have the background thread sync now, e.g. after a bulk write that sent no signals."""
+        self._next_sync = 0.0
+        self._wake.set()
+
+    def start(self):
+        """Start the background thread that builds and refreshes the index (once per process)."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='autocomplete-index', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                self.refresh()
+            except DatabaseError as e:
+                logger.warning('Autocomplete index refresh failed: %s', e)
+            finally:
+                close_old_connections()
+            # Until the next sync, a requested sync, or a minute after a failed build
+            wait = (min(self._next_sync, self._next_rebuild) - time.monotonic()) if self._built else 60
+            self._wake.wait(max(wait, 0.1))
+            self._wake.clear()
+
+    def update_product(self, product):
+        if not self._built:
+            return
+        with self._lock:
+            if product.available:
+                self._add(f'p{product.pk}', ('product', product.pk, product.name, product.slug))
+            else:
+                self._remove(f'p{product.pk}')
+
+    def update_category(self, category):
+        if self._built:
+            with self._lock:
+                self._add(f'c{category.pk}', ('category', category.pk, category.name, category.slug))
+
+    def remove(self, kind, pk):
+        if self._built:
+            with self._lock:
+                self._remove(f'{kind[0]}{pk}')
+
+    def lookup(self, query, limit=SUGGESTION_LIMIT):
+        """
+        Up to `limit` (kind, pk, label, slug) entries with a word starting
+        with `query`: categories first, then names that start with it, then
+        shorter names.
+        """
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        found = {}
+        # Categories are scanned on their own, so they rank first however
+        # their names sort against the products'. Look a little past `limit`
+        # so the ordering below has something to choose from.
+        for keys in (self._category_keys, self._keys):
+            start = bisect.bisect_left(keys, prefix)
+            for key in keys[start:start + limit * 4]:
+                if not key.startswith(prefix):
+                    break
+                ref = key[key.rindex(SEPARATOR) + 1:]
+                name_start = ref[0] == NAME_START
+                ref = ref.lstrip(NAME_START)
+                entry = self._entries.get(ref)
+                if entry is not None and (ref not in found or name_start):
+                    found[ref] = (entry[0] != 'category', not name_start, len(entry[2]), entry)
+        return [rank[-1] for rank in sorted(found.values(), key=lambda rank: rank[:3])[:limit]]
+
+    def stats(self):
+        return {'entries': len(self._entries), 'keys': len(self._keys) + len(self._category_keys)}
+
+
+index = PrefixIndex()
+
+
+def start():
+    """Build and refresh the index in the background from server startup (see gadgetcave/wsgi.py)."""
+    index.start()
+
+
+def _restart_in_child():
+    # A server that forks its workers after loading the app (gunicorn --preload)
+    # leaves the thread behind in the parent; each worker starts its own
+    if index._thread is not None:
+        index._lock, index._refresh_lock = threading.Lock(), threading.Lock()
+        index._thread = None
+        index.start()
+
+
+os.register_at_fork(after_in_child=_restart_in_child)
+
+
+def suggestions(query, limit=SUGGESTION_LIMIT, prefix_index=None):
+    prefix_index = index if prefix_index is None else prefix_index
+    return [
+        {'type': kind, 'label': label, 'url': _url(kind, pk, slug)}
+        for kind, pk, label, slug in prefix_index.lookup(query, limit)
+    ]
+
+
+# reverse() costs more than the lookup itself; popular suggestions repeat a lot
+@functools.lru_cache(maxsize=4096)
+def _url(kind, pk, slug):
+    if kind == 'category':
+        return reverse('gadget_cave:product_list_by_category', args=[slug])
+    return reverse('gadget_cave:product_detail', args=[pk, slug])
@@ -0,0 +1,941 @@
+# gadget_cave/benchmarks.py
+#
+# Load/contention harnesses shared by the bench_* management commands and
+# the test suite. Nothing here is imported by the storefront itself.
+import csv
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import re
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.db import OperationalError, close_old_connections, connection, connections, transaction
+from django.db.models import Q, Sum
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils.crypto import get_random_string
+from django.utils.text import slugify
+
+from .autocomplete import PrefixIndex, suggestions
+from .catalog import CATALOG_SORTS, catalog_page
+from .catalog_io import CHUNK_SIZE as CATALOG_CHUNK_SIZE, COLUMNS as CATALOG_COLUMNS, export_catalog, import_catalog
+from .inventory import InsufficientStock, place_order
+from .models import Category, CustomUser, Order, OrderItem, Product, Task
+from .search import rebuild_index, search
+from .tasks import enqueue_many, run_worker, task
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def latency_summary(samples):
+    """p50/p95/p99 in milliseconds for a list of durations in seconds."""
+    return {f'p{pct}_ms': round(percentile(samples, pct) * 1000, 3) for pct in (50, 95, 99)}
+
+
+@contextmanager
+def scratch_database(path=None, keep=False):
+    """
+    Create (and afterwards destroy) a migrated, empty copy of the default
+    database, so benchmarks never touch real data. SQLite gets a file rather
+    than the usual in-memory test database so several processes can share it.
+    """
+    settings_dict = connection.settings_dict
+    cleanup_dir = None
+    if connection.vendor == 'sqlite':
+        if path is None:
+            cleanup_dir = tempfile.mkdtemp(prefix='gadget_cave_bench_')
+            path = os.path.join(cleanup_dir, 'bench.sqlite3')
+        settings_dict['TEST'] = {**settings_dict.get('TEST', {}), 'NAME': path}
+    old_name = settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False, keepdb=keep)
+    try:
+        yield settings_dict['NAME']
+    finally:
+        connections.close_all()
+        if not keep:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        else:
+            settings_dict['NAME'] = old_name
+        if cleanup_dir and not keep:
+            os.rmdir(cleanup_dir)
+
+
+LOCK_RETRIES = 8
+
+
+def _checkout_worker(product_id, price, attempts, quantity):
+    """
+    One buyer hammering a single SKU; returns (orders, rejected, errors,
+    retries, latencies). "database is locked" is retried with backoff, the
+    way a client would retry a 503.
+    """
+    product = Product(id=product_id, price=price)
+    orders = rejected = errors = retries = 0
+    latencies = []
+    try:
+        for i in range(attempts):
+            started = time.perf_counter()
+            for retry in range(LOCK_RETRIES):
+                order = Order(
+                    first_name='Bench', last_name='Buyer', email='bench@example.com',
+                    address='1 Bench Street', city='Kochi', postal_code='682001',
+                )
+                try:
+                    place_order(order, [(product, quantity, price)])
+                    orders += 1
+                except InsufficientStock:
+                    rejected += 1
+                except OperationalError as e:
+                    if 'locked' in str(e) and retry < LOCK_RETRIES - 1:
+                        retries += 1
+                        time.sleep(0.001 * 2 ** retry)
+                        continue
+                    errors += 1
+                break
+            latencies.append(time.perf_counter() - started)
+    finally:
+        connection.close()
+    return orders, rejected, errors, retries, latencies
+
+
+def _process_worker(args):
+    return _checkout_worker(*args)
+
+
+def stock_contention(product_id, workers=8, attempts=25, quantity=1, processes=False):
+    """
+    Run `workers` concurrent buyers (threads, or forked processes) that each
+    try to check out `attempts` orders of one product, then check the
+    books: units sold must equal the stock that disappeared, and stock
+    must never go negative.
+    """
+    product = Product.objects.get(id=product_id)
+    initial_stock = product.stock
+    args = [(product_id, product.price, attempts, quantity)] * workers
+    started = time.perf_counter()
+    if processes:
+        # Children inherit the parent's settings (including the scratch database) via fork
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            results = pool.map(_process_worker, args)
+    else:
+        results = [None] * workers
+
+        def run(i):
+            results[i] = _checkout_worker(*args[i])
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+
+    final_stock = Product.objects.get(id=product_id).stock
+    sold = OrderItem.objects.filter(product_id=product_id).aggregate(total=Sum('quantity'))['total'] or 0
+    orders = sum(r[0] for r in results)
+    latencies = [latency for r in results for latency in r[4]]
+    return {
+        'mode': 'processes' if processes else 'threads',
+        'workers': workers,
+        'attempts': workers * attempts,
+        'orders': orders,
+        'rejected': sum(r[1] for r in results),
+        'errors': sum(r[2] for r in results),
+        'lock_retries': sum(r[3] for r in results),
+        'initial_stock': initial_stock,
+        'final_stock': final_stock,
+        'units_sold': sold,
+        'oversold': final_stock < 0 or sold != initial_stock - final_stock or sold > initial_stock,
+        'elapsed_s': round(elapsed, 3),
+        'orders_per_s': round(orders / elapsed, 1) if elapsed else 0.0,
+        **latency_summary(latencies),
+    }
+
+
+# Stock Django database settings, to compare the configured ones against
+# (see settings.DATABASES): no pragmas, deferred transactions, a new
+# connection per request.
+STOCK_DATABASE = {'CONN_MAX_AGE': 0, 'CONN_HEALTH_CHECKS': False, 'OPTIONS': {}}
+
+
+@contextmanager
+def database_settings(**overrides):
+    """Run with some of the default database's settings replaced; connections are reopened."""
+    connections.close_all()
+    settings_dict = connection.settings_dict
+    saved = {key: settings_dict.get(key) for key in overrides}
+    settings_dict.update(overrides)
+    try:
+        yield
+    finally:
+        connections.close_all()
+        settings_dict.update(saved)
+
+
+def _workload_worker(role, products, categories, deadline, seed):
+    rng = random.Random(seed)
+    latencies = []
+    errors = 0
+    try:
+        while time.perf_counter() < deadline:
+            # Each operation is one "request": connections are closed or kept per CONN_MAX_AGE
+            close_old_connections()
+            started = time.perf_counter()
+            try:
+                if role == 'write':
+                    lines = [(Product(id=product_id, price=price), rng.randint(1, 3), price)
+                             for product_id, price in rng.sample(products, rng.randint(1, 3))]
+                    order = Order(first_name='Bench', last_name='Buyer', email='bench@example.com',
+                                  address='1 Bench Street', city='Kochi', postal_code='682001')
+                    place_order(order, lines)
+                else:
+                    list(catalog_page(category=rng.choice(categories), sort=rng.choice(list(CATALOG_SORTS))))
+                    Product.objects.select_related('category').get(id=rng.choice(products)[0])
+            except OperationalError as e:
+                # "database is locked": what a shopper would see as an error page
+                if 'locked' not in str(e):
+                    raise
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+    finally:
+        connection.close()
+    return role, latencies, errors
+
+
+def _workload_process(args):
+    return _workload_worker(*args)
+
+
+def checkout_workload(writers=4, readers=8, seconds=5.0, seed=9, processes=False):
+    """
+    `writers` threads (or forked processes) placing 1-3 line orders (stock
+    reservation plus order rows, see place_order) while `readers` load
+    catalog pages and product rows, for `seconds`. Returns throughput,
+    latency and "database is locked" errors for each side.
+    """
+    products = list(Product.objects.filter(available=True).order_by('id').values_list('id', 'price')[:2000])
+    Product.objects.filter(id__in=[product_id for product_id, price in products]).update(stock=10 ** 9)
+    categories = list(Category.objects.all())
+    deadline = time.perf_counter() + seconds
+    roles = ['write'] * writers + ['read'] * readers
+    args = [(role, products, categories, deadline, seed + i) for i, role in enumerate(roles)]
+    started = time.perf_counter()
+    if processes:
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(len(roles)) as pool:
+            results = pool.map(_workload_process, args)
+    else:
+        results = [None] * len(roles)
+
+        def run(i):
+            results[i] = _workload_worker(*args[i])
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(len(roles))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+
+    summary = {'mode': 'processes' if processes else 'threads', 'writers': writers, 'readers': readers, 'elapsed_s': round(elapsed, 3)}
+    for role, label in (('write', 'orders'), ('read', 'reads')):
+        latencies = [latency for r, role_latencies, errors in results if r == role for latency in role_latencies]
+        summary[label] = len(latencies)
+        summary[f'{label}_per_s'] = round(len(latencies) / elapsed, 1) if elapsed else 0.0
+        summary[f'{role}_errors'] = sum(errors for r, role_latencies, errors in results if r == role)
+        summary[role] = latency_summary(latencies)
+    summary['journal_mode'] = _journal_mode()
+    return summary
+
+
+def _journal_mode():
+    if connection.vendor != 'sqlite':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode')
+        return cursor.fetchone()[0]
+
+
+@task('bench.sleep')
+def _bench_task(ms=0):
+    if ms:
+        time.sleep(ms / 1000)
+
+
+def _queue_worker(concurrency, batch_size):
+    try:
+        return run_worker(concurrency=concurrency, batch_size=batch_size, once=True)
+    finally:
+        connection.close()
+
+
+def _queue_process_worker(args):
+    return _queue_worker(*args)
+
+
+def task_throughput(tasks=2000, workers=2, concurrency=1, batch_size=None, work_ms=0, processes=False):
+    """
+    Enqueue `tasks` no-op (or `work_ms` sleeping) tasks, then drain the queue
+    with `workers` competing run_worker loops and report enqueue and
+    processing rates. `duplicates` counts tasks that ran more than once;
+    it must be 0.
+    """
+    started = time.perf_counter()
+    for start in range(0, tasks, 1000):
+        enqueue_many([('bench.sleep', {'ms': work_ms}, None) for i in range(start, min(tasks, start + 1000))])
+    enqueue_elapsed = time.perf_counter() - started
+
+    args = [(concurrency, batch_size)] * workers
+    started = time.perf_counter()
+    if processes:
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            results = pool.map(_queue_process_worker, args)
+    else:
+        results = [None] * workers
+
+        def run(i):
+            results[i] = _queue_worker(*args[i])
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+
+    done = sum(r.get('done', 0) for r in results)
+    runs = Task.objects.filter(name='bench.sleep').aggregate(total=Sum('attempts'))['total'] or 0
+    return {
+        'mode': 'processes' if processes else 'threads',
+        'workers': workers,
+        'concurrency': concurrency,
+        'tasks': tasks,
+        'enqueue_s': round(enqueue_elapsed, 3),
+        'enqueued_per_s': round(tasks / enqueue_elapsed, 1) if enqueue_elapsed else 0.0,
+        'done': done,
+        'remaining': Task.objects.filter(name='bench.sleep').exclude(status='done').count(),
+        'duplicates': runs - tasks,
+        'elapsed_s': round(elapsed, 3),
+        'tasks_per_s': round(done / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+BRANDS = ['Apple', 'Samsung', 'Sony', 'Boat', 'Noise', 'OnePlus', 'Xiaomi', 'Marshall', 'JBL', 'Realme', 'Lenovo', 'Asus']
+KINDS = ['watch', 'headset', 'earbuds', 'speaker', 'charger', 'power bank', 'phone case', 'cable', 'tablet', 'keyboard']
+ADJECTIVES = ['wireless', 'smart', 'ultra', 'pro', 'mini', 'max', 'lite', 'sport', 'classic', 'neo', 'fast', 'rugged']
+SYLLABLES = ['ka', 'ro', 'mi', 'tel', 'van', 'su', 'dor', 'pe', 'lin', 'ga', 'zu', 'ble', 'qua', 'nox', 'ter']
+
+
+def _vocabulary(rng, size=5000):
+    # Pseudo-words, so that description terms are about as selective as real ones
+    return sorted({''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(size)})
+
+
+def seed_catalog(products=1000, categories=10, batch_size=5000, seed=42):
+    """
+    Fill an (empty, scratch) database with a synthetic catalog with
+    bulk_create, then build the search index. Returns the categories.
+    """
+    rng = random.Random(seed)
+    vocabulary = _vocabulary(rng)
+    category_objs = Category.objects.bulk_create(
+        [Category(name=f'{kind.title()}s {i}', slug=f'{slugify(kind)}s-{i}') for i, kind in
+         ((i, KINDS[i % len(KINDS)]) for i in range(categories))]
+    )
+    for start in range(0, products, batch_size):
+        batch = []
+        for i in range(start, min(products, start + batch_size)):
+            name = f'{rng.choice(BRANDS)} {rng.choice(ADJECTIVES)} {rng.choice(KINDS)} {i}'
+            batch.append(Product(
+                category=category_objs[i % categories], name=name, slug=slugify(name),
+                description=' '.join(rng.choice(vocabulary) for _ in range(30)),
+                price=rng.randint(199, 99999), stock=rng.randint(0, 50), available=rng.random() > 0.05,
+            ))
+        Product.objects.bulk_create(batch)
+    rebuild_index()
+    return category_objs
+
+
+def _timed(func, queries):
+    latencies = []
+    for query in queries:
+        started = time.perf_counter()
+        func(query)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def search_latency(queries=200, seed=7):
+    """
+    Latency of ranked search (with facets), typeahead prefix search, and
+    the old admin-style icontains scan, over random catalog words.
+    """
+    rng = random.Random(seed)
+    vocabulary = _vocabulary(random.Random(42))
+    # A mix of broad ("sony speaker", "wireless") and narrow (description word) queries
+    full = [
+        rng.choice([
+            f'{rng.choice(BRANDS)} {rng.choice(KINDS)}',
+            rng.choice(ADJECTIVES),
+            f'{rng.choice(vocabulary)} {rng.choice(KINDS)}',
+        ]).lower()
+        for _ in range(queries)
+    ]
+    names = [w.lower() for w in BRANDS + ADJECTIVES + KINDS]
+    prefixes = [rng.choice(names)[:rng.randint(2, 4)] for _ in range(queries)]
+
+    def icontains(query):
+        condition = Q()
+        for word in query.split():
+            condition &= Q(name__icontains=word) | Q(description__icontains=word)
+        list(Product.objects.filter(condition, available=True).order_by('name')[:24])
+        Product.objects.filter(condition, available=True).count()
+
+    return {
+        'products': Product.objects.count(),
+        'queries': queries,
+        'search': latency_summary(_timed(search, full)),
+        'typeahead': latency_summary(_timed(lambda q: search(q, per_page=10, prefix=True), prefixes)),
+        'icontains': latency_summary(_timed(icontains, full[:max(1, queries // 10)])),
+    }
+
+
+def autocomplete_latency(names=100000, queries=20000, seed=11):
+    """
+    Build a PrefixIndex over `names` synthetic product names (no database)
+    and time lookups, and whole JSON responses, for 1-6 character prefixes.
+    """
+    rng = random.Random(seed)
+    entries = {}
+    for i in range(names):
+        name = f'{rng.choice(BRANDS)} {rng.choice(ADJECTIVES)} {rng.choice(KINDS)} {i}'
+        entries[f'p{i}'] = ('product', i, name, slugify(name))
+    for i, kind in enumerate(KINDS):
+        entries[f'c{i}'] = ('category', i, f'{kind.title()}s', f'{slugify(kind)}s')
+
+    prefix_index = PrefixIndex()
+    started = time.perf_counter()
+    prefix_index.load(entries)
+    build_s = time.perf_counter() - started
+    # Memory of a second copy, traced separately so tracing doesn't slow the timed build
+    tracemalloc.start()
+    PrefixIndex().load(dict(entries))
+    memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    words = [w.lower() for w in BRANDS + ADJECTIVES + KINDS]
+    prefixes = [rng.choice(words)[:rng.randint(1, 6)] for _ in range(queries)]
+    prefixes += [f'{rng.choice(BRANDS)} {rng.choice(ADJECTIVES)[:2]}'.lower() for _ in range(queries // 4)]
+    lookups = _timed(prefix_index.lookup, prefixes)
+    responses = _timed(lambda q: json.dumps({'q': q, 'suggestions': suggestions(q, prefix_index=prefix_index)}), prefixes)
+    return {
+        'names': names,
+        **prefix_index.stats(),
+        'build_s': round(build_s, 3),
+        'build_peak_mb': round(memory / 2 ** 20, 1),
+        'queries': len(prefixes),
+        'lookup': latency_summary(lookups),
+        'json_response': latency_summary(responses),
+    }
+
+
+def _catalog_file(path, rows, categories, seed, start=0):
+    """Write a synthetic import file of `rows` products (CSV)."""
+    rng = random.Random(seed)
+    vocabulary = _vocabulary(rng)
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=CATALOG_COLUMNS)
+        writer.writeheader()
+        for i in range(start, start + rows):
+            kind = KINDS[i % categories % len(KINDS)]
+            name = f'{rng.choice(BRANDS)} {rng.choice(ADJECTIVES)} {rng.choice(KINDS)} {i}'
+            writer.writerow({
+                'category': f'{slugify(kind)}s-{i % categories}', 'category_name': f'{kind.title()}s {i % categories}',
+                'name': name, 'slug': slugify(name), 'description': ' '.join(rng.choice(vocabulary) for _ in range(30)),
+                'price': rng.randint(199, 99999), 'stock': rng.randint(0, 50), 'available': int(rng.random() > 0.05),
+            })
+
+
+def _save_rows(path):
+    # What adding the rows one at a time in the admin amounts to: a
+    # transaction and full signal handling per product
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            with transaction.atomic():
+                category = Category.objects.get_or_create(slug=row['category'], defaults={'name': row['category_name']})[0]
+                Product.objects.update_or_create(category=category, slug=row['slug'], defaults={
+                    'name': row['name'], 'description': row['description'], 'price': row['price'],
+                    'stock': row['stock'], 'available': row['available'] == '1',
+                })
+
+
+def catalog_import(rows=20000, categories=10, row_by_row=2000, chunk_size=CATALOG_CHUNK_SIZE, seed=21):
+    """
+    Import a synthetic CSV catalog of `rows` products into an (empty,
+    scratch) database with import_catalog, import it again (all updates),
+    export it, and save `row_by_row` more products one at a time for
+    comparison. Rates are in products per second.
+    """
+    directory = tempfile.mkdtemp(prefix='gadget_cave_import_')
+    catalog, sample = os.path.join(directory, 'catalog.csv'), os.path.join(directory, 'sample.csv')
+    try:
+        _catalog_file(catalog, rows, categories, seed)
+        _catalog_file(sample, row_by_row, categories, seed + 1, start=rows)
+        with open(catalog, newline='') as f:
+            created = import_catalog(f, 'csv', chunk_size=chunk_size)
+        with open(catalog, newline='') as f:
+            updated = import_catalog(f, 'csv', chunk_size=chunk_size)
+
+        started = time.perf_counter()
+        exported = sum(1 for _ in export_catalog('csv', chunk_size=chunk_size)) - 1
+        export_s = time.perf_counter() - started
+
+        started = time.perf_counter()
+        _save_rows(sample)
+        saves_s = time.perf_counter() - started
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+    saves_per_s = row_by_row / saves_s if saves_s else 0.0
+    return {
+        'rows': rows,
+        'chunk_size': chunk_size,
+        'import_s': created['seconds'],
+        'import_rows_per_s': created['rows_per_s'],
+        'reimport_rows_per_s': updated['rows_per_s'],
+        'export_rows_per_s': round(exported / export_s, 1) if export_s else 0.0,
+        'row_by_row': row_by_row,
+        'row_by_row_rows_per_s': round(saves_per_s, 1),
+        'speedup': round(created['rows_per_s'] / saves_per_s, 1) if saves_per_s else None,
+        'errors': created['errors'] + updated['errors'],
+    }
+
+
+# Storefront load test: virtual shoppers walking home -> category ->
+# product page -> add to cart -> cart -> checkout -> payment against the real
+# URLs, through the test client or a local HTTP server.
+
+PROFILES = {
+    'small': {'products': 1000, 'categories': 10, 'customers': 100, 'orders': 1000},
+    'medium': {'products': 100000, 'categories': 50, 'customers': 5000, 'orders': 50000},
+    'large': {'products': 1000000, 'categories': 200, 'customers': 50000, 'orders': 500000},
+}
+FLOW_STEPS = ['home', 'category', 'product_detail', 'cart_add', 'cart_detail', 'order_form', 'order_create', 'confirm_payment']
+SHIPPING = {
+    'first_name': 'Bench', 'last_name': 'Shopper', 'email': 'bench@example.com', 'phone': '9000000000',
+    'address': '1 Bench Street', 'city': 'Kochi', 'district': 'Ernakulam', 'state': 'Kerala', 'postal_code': '682001',
+}
+QUERY_HEADER = 'X-Bench-Queries'
+
+
+def seed_customers(customers=100, orders=1000, batch_size=5000, seed=43):
+    """
+    bulk_create `customers` users (all with one pre-hashed password) and
+    `orders` orders of 1-4 lines spread over them. Needs a seeded catalog.
+    """
+    rng = random.Random(seed)
+    password = make_password('bench-password')
+    for start in range(0, customers, batch_size):
+        CustomUser.objects.bulk_create([
+            CustomUser(username=f'bench{i}', email=f'bench{i}@example.com', password=password)
+            for i in range(start, min(customers, start + batch_size))
+        ])
+    user_ids = list(CustomUser.objects.filter(username__startswith='bench').values_list('id', flat=True))
+    products = list(Product.objects.values_list('id', 'price')[:20000])
+    statuses = ['pending', 'processing', 'shipped', 'delivered', 'cancelled']
+    for start in range(0, orders, batch_size):
+        batch = Order.objects.bulk_create([
+            Order(user_id=rng.choice(user_ids), paid=rng.random() > 0.3, status=rng.choice(statuses), **SHIPPING)
+            for _ in range(start, min(orders, start + batch_size))
+        ])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product_id=product_id, price=price, quantity=rng.randint(1, 3))
+            for order in batch
+            for product_id, price in rng.sample(products, min(len(products), rng.randint(1, 4)))
+        ])
+    return user_ids
+
+
+class _ClientDriver:
+    """Requests through django.test.Client, in the calling thread."""
+
+    def __init__(self, user):
+        self.client = Client(HTTP_HOST='localhost')
+        self.client.force_login(user)
+
+    def request(self, method, path, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            if method == 'GET':
+                response = self.client.get(path)
+            else:
+                response = self.client.post(path, data or {})
+        return response.status_code, response.get('Location', ''), len(queries)
+
+
+class _HTTPDriver:
+    """Requests over HTTP to a local server, with the shopper's cookies."""
+
+    def __init__(self, user, host, port):
+        self.host, self.port = host, port
+        # force_login creates the session row without hashing a password
+        client = Client()
+        client.force_login(user)
+        self.cookies = {name: morsel.value for name, morsel in client.cookies.items()}
+        # Django accepts an unmasked secret as the CSRF token
+        self.cookies[settings.CSRF_COOKIE_NAME] = get_random_string(32)
+
+    def request(self, method, path, data=None):
+        headers = {'Cookie': '; '.join(f'{name}={value}' for name, value in self.cookies.items())}
+        body = None
+        if method == 'POST':
+            body = urlencode(data or {})
+            headers.update({
+                'Content-Type': 'application/x-www-form-urlencoded',
+                'X-CSRFToken': self.cookies[settings.CSRF_COOKIE_NAME],
+            })
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+        finally:
+            conn.close()
+        for header in response.headers.get_all('Set-Cookie') or []:
+            for name, morsel in SimpleCookie(header).items():
+                if morsel.value:
+                    self.cookies[name] = morsel.value
+                else:
+                    self.cookies.pop(name, None)
+        queries = response.getheader(QUERY_HEADER)
+        if queries is None:
+            # Servers without the counting wrapper (ASGI): RequestMetricsMiddleware's header
+            match = re.search(r'desc="(\d+) queries"', response.getheader('Server-Timing', ''))
+            queries = match and match.group(1)
+        return response.status, response.getheader('Location', ''), int(queries) if queries else None
+
+
+def _counting(app):
+    """Wrap a WSGI app to report the queries each request ran in a response header."""
+    def counted(environ, start_response):
+        queries = [0]
+
+        def count(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        def start(status, headers, exc_info=None):
+            return start_response(status, headers + [(QUERY_HEADER, str(queries[0]))], exc_info)
+
+        with connection.execute_wrapper(count):
+            return app(environ, start)
+    return counted
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def local_server(kind='wsgi'):
+    """
+    Serve the project on 127.0.0.1 from a background thread and yield
+    (host, port): Django's threaded WSGI server (what runserver uses), or
+    uvicorn for ASGI if it is installed.
+    """
+    if kind == 'wsgi':
+        server = ThreadedWSGIServer(('127.0.0.1', 0), _QuietHandler)
+        server.set_app(_counting(WSGIHandler()))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            yield server.server_address[:2]
+        finally:
+            server.shutdown()
+            server.server_close()
+        return
+    try:
+        import uvicorn
+    except ImportError:
+        raise RuntimeError('The ASGI server needs uvicorn (pip install uvicorn).')
+    from django.core.asgi import get_asgi_application
+
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(
+        get_asgi_application(), host='127.0.0.1', port=port, log_level='warning', lifespan='off',
+    ))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started and thread.is_alive():
+        time.sleep(0.01)
+    try:
+        yield '127.0.0.1', port
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+def _flow(driver, product, record):
+    """One shopper's trip from the home page to a paid order; calls record(step, seconds, status, queries, ok)."""
+    def step(name, method, path, data=None, expect=200, location=None):
+        started = time.perf_counter()
+        status, redirect, queries = driver.request(method, path, data)
+        ok = status == expect and (location is None or location in redirect)
+        record(name, time.perf_counter() - started, status, queries, ok)
+        return redirect
+
+    category_id, category_slug, product_id, product_slug = product
+    step('home', 'GET', reverse('gadget_cave:home'))
+    step('category', 'GET', reverse('gadget_cave:product_list_by_category', args=[category_slug]))
+    step('product_detail', 'GET', reverse('gadget_cave:product_detail', args=[product_id, product_slug]))
+    step('cart_add', 'POST', reverse('gadget_cave:cart_add', args=[product_id]), {'quantity': 1}, expect=302)
+    step('cart_detail', 'GET', reverse('gadget_cave:cart_detail'))
+    step('order_form', 'GET', reverse('gadget_cave:order_create'))
+    payment = step('order_create', 'POST', reverse('gadget_cave:order_create'), SHIPPING, expect=302, location='/order/payment/')
+    match = re.search(r'/order/payment/(\d+)/', payment)
+    if match:
+        step('confirm_payment', 'POST', reverse('gadget_cave:confirm_payment', args=[int(match.group(1))]),
+             {'upi_transaction_id': 'BENCH'}, expect=302, location='/order/confirmation/')
+
+
+def storefront_load(driver='client', shoppers=8, flows=10, warmup=1, seed=5):
+    """
+    Run `shoppers` concurrent virtual shoppers (threads), each walking the
+    checkout flow `flows` times after `warmup` untimed trips, with
+    driver 'client' (django.test.Client), 'wsgi' or 'asgi' (a local server).
+    The shoppers are the first seeded customers (see seed_customers), or
+    new users. Returns throughput, per-step p50/p95/p99 latency and mean
+    queries per request.
+    """
+    rng = random.Random(seed)
+    users = list(CustomUser.objects.filter(is_staff=False).order_by('id')[:shoppers])
+    users += [
+        CustomUser.objects.create_user(f'shopper{i}', password=None)
+        for i in range(len(users), shoppers)
+    ]
+    candidates = list(
+        Product.objects.filter(available=True).order_by('id')
+        .values_list('category_id', 'category__slug', 'id', 'slug')[:5000]
+    )
+    products = rng.sample(candidates, min(len(candidates), 200))
+    # Plenty of stock, so checkouts measure the happy path rather than running out
+    Product.objects.filter(id__in=[p[2] for p in products]).update(stock=10 ** 6)
+
+    lock = threading.Lock()
+    samples = {name: [] for name in FLOW_STEPS}
+    failures = []
+
+    def shopper(user, server, index):
+        shopper_rng = random.Random(seed + index)
+        try:
+            session = _ClientDriver(user) if server is None else _HTTPDriver(user, *server)
+            for trip in range(warmup + flows):
+                timed = trip >= warmup
+
+                def record(name, seconds, status, queries, ok):
+                    if timed:
+                        with lock:
+                            samples[name].append((seconds, queries, ok))
+
+                _flow(session, shopper_rng.choice(products), record)
+        except Exception as e:
+            # A shopper that died (e.g. "database is locked" while logging in) is an error, not a silent gap
+            with lock:
+                failures.append(f'{user.username}: {e!r}')
+        finally:
+            connection.close()
+
+    def run(server=None):
+        threads = [threading.Thread(target=shopper, args=(user, server, i)) for i, user in enumerate(users)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+    # The test client's requests use Host: localhost; servers are on 127.0.0.1
+    hosts = [*settings.ALLOWED_HOSTS, 'localhost', '127.0.0.1', 'testserver']
+    with override_settings(ALLOWED_HOSTS=hosts):
+        if driver == 'client':
+            elapsed = run()
+        else:
+            connections.close_all()
+            with local_server(driver) as server:
+                elapsed = run(server)
+
+    requests = sum(len(s) for s in samples.values())
+    steps = {}
+    for name, step_samples in samples.items():
+        counted = [queries for seconds, queries, ok in step_samples if queries is not None]
+        steps[name] = {
+            'requests': len(step_samples),
+            'errors': sum(1 for seconds, queries, ok in step_samples if not ok),
+            **latency_summary([seconds for seconds, queries, ok in step_samples]),
+            'queries': round(sum(counted) / len(counted), 2) if counted else None,
+        }
+    return {
+        'driver': driver,
+        'debug': settings.DEBUG,
+        'products': Product.objects.count(),
+        'shoppers': len(users),
+        'flows': len(users) * flows,
+        'requests': requests,
+        'errors': sum(step['errors'] for step in steps.values()) + len(failures),
+        'failed_shoppers': failures,
+        'elapsed_s': round(elapsed, 3),
+        'requests_per_s': round(requests / elapsed, 1) if elapsed else 0.0,
+        'flows_per_s': round(len(users) * flows / elapsed, 2) if elapsed else 0.0,
+        **latency_summary([seconds for s in samples.values() for seconds, queries, ok in s]),
+        'steps': steps,
+    }
+
+
+def _http_get(host, port, path, cookie_header, timeout=120):
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request('GET', path, headers={'Cookie': cookie_header})
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def connection_capacity(server='wsgi', connections=200, hold=2.0, probes=20):
+    """
+    Hold `connections` concurrent payment-status long polls (each waits
+    `hold` seconds for a payment that never comes) against a local 'wsgi'
+    or 'asgi' server, and meanwhile time `probes` home page requests.
+    A WSGI server needs a thread per waiting connection; an ASGI server
+    parks them all in its event loop. Returns completions, errors, the
+    server's peak thread count and the probes' latency.
+    """
+    user = CustomUser.objects.create_user('capacity', password=None)
+    order = Order.objects.create(user=user, paid=False, **SHIPPING)
+    client = Client()
+    client.force_login(user)
+    cookie_header = '; '.join(f'{name}={morsel.value}' for name, morsel in client.cookies.items())
+    poll_path = f"{reverse('gadget_cave:order_status', args=[order.id])}?paid=0&status={order.status}&wait={hold}"
+
+    lock = threading.Lock()
+    statuses = []
+    probe_samples = []
+    peak_threads = [0]
+    done = threading.Event()
+
+    def server_threads():
+        return sum(1 for thread in threading.enumerate() if not thread.name.startswith('bench-client'))
+
+    def poll(host, port):
+        try:
+            status = _http_get(host, port, poll_path, cookie_header)
+        except Exception as e:
+            status = repr(e)
+        with lock:
+            statuses.append(status)
+
+    def sample():
+        while not done.wait(0.05):
+            peak_threads[0] = max(peak_threads[0], server_threads())
+
+    hosts = [*settings.ALLOWED_HOSTS, 'localhost', '127.0.0.1', 'testserver']
+    with override_settings(ALLOWED_HOSTS=hosts, ORDER_STATUS_WAIT=max(hold, 1)):
+        connection.close()
+        with local_server(server) as (host, port):
+            sampler = threading.Thread(target=sample, name='bench-client-sampler', daemon=True)
+            sampler.start()
+            pollers = [
+                threading.Thread(target=poll, args=(host, port), name=f'bench-client-{i}', daemon=True)
+                for i in range(connections)
+            ]
+            started = time.perf_counter()
+            for thread in pollers:
+                thread.start()
+            # Probe while the polls are parked on the server
+            time.sleep(min(hold / 4, 0.5))
+            for _ in range(probes):
+                probe_started = time.perf_counter()
+                try:
+                    ok = _http_get(host, port, reverse('gadget_cave:home'), cookie_header, timeout=hold * 4) == 200
+                except Exception:
+                    ok = False
+                probe_samples.append((time.perf_counter() - probe_started, ok))
+            for thread in pollers:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            done.set()
+            sampler.join()
+
+    return {
+        'server': server,
+        'connections': connections,
+        'hold_s': hold,
+        'completed': sum(1 for status in statuses if status == 200),
+        'errors': sum(1 for status in statuses if status != 200),
+        'elapsed_s': round(elapsed, 3),
+        'peak_server_threads': peak_threads[0],
+        'probes': len(probe_samples),
+        'probe_errors': sum(1 for seconds, ok in probe_samples if not ok),
+        **{f'probe_{key}': value for key, value in latency_summary([seconds for seconds, ok in probe_samples]).items()},
+    }
+
+
+# Latency differences below this are noise at any tolerance
+MIN_LATENCY_DELTA_MS = 2.0
+
+
+def compare_to_baseline(result, baseline, tolerance=0.25):
+    """
+    Regressions of `result` against a stored storefront_load() result, as
+    messages (empty if none): any new errors, more queries for a step, p50
+    or p95 more than `tolerance` slower, or throughput more than
+    `tolerance` lower.
+    """
+    regressions = []
+    if result['errors'] > baseline.get('errors', 0):
+        regressions.append(f"errors: {result['errors']} (baseline {baseline.get('errors', 0)})")
+    floor = baseline['requests_per_s'] * (1 - tolerance)
+    if result['requests_per_s'] < floor:
+        regressions.append(f"throughput: {result['requests_per_s']} requests/s (baseline {baseline['requests_per_s']})")
+    for name, step in result['steps'].items():
+        before = baseline['steps'].get(name)
+        if not before:
+            continue
+        if step['queries'] is not None and before['queries'] is not None and step['queries'] > before['queries'] + 0.5:
+            regressions.append(f"{name}: {step['queries']} queries per request (baseline {before['queries']})")
+        for key in ('p50_ms', 'p95_ms'):
+            limit = max(before[key] * (1 + tolerance), before[key] + MIN_LATENCY_DELTA_MS)
+            if step[key] > limit:
+                regressions.append(f'{name}: {key} {step[key]} (baseline {before[key]})')
+    return regressions
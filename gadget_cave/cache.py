@@ -0,0 +1,148 @@
+# gadget_cave/cache.py
+import hashlib
+import threading
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+
+from .models import Category, Product
+
+FRAGMENT_TIMEOUT = getattr(settings, 'CATALOG_FRAGMENT_TIMEOUT', 60 * 60 * 24)
+OBJECT_TIMEOUT = getattr(settings, 'CATALOG_OBJECT_TIMEOUT', 60 * 60)
+# Short, so a product that appears under a URL bots were already probing shows up quickly
+NEGATIVE_TIMEOUT = getattr(settings, 'CATALOG_NEGATIVE_TIMEOUT', 60 * 5)
+MISSING = 'catalog:missing'
+
+
+def catalog_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')]
+
+
+class CacheStats:
+    """Per-process hit/miss counters, keyed by fragment name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def record(self, name, hit):
+        with self._lock:
+            (self.hits if hit else self.misses)[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            names = sorted(set(self.hits) | set(self.misses))
+            return {
+                name: {
+                    'hits': self.hits[name],
+                    'misses': self.misses[name],
+                    'hit_rate': round(self.hits[name] / ((self.hits[name] + self.misses[name]) or 1), 4),
+                }
+                for name in names
+            }
+
+    def reset(self):
+        with self._lock:
+            self.hits.clear()
+            self.misses.clear()
+
+
+stats = CacheStats()
+
+
+# Generations: a random token per namespace, stored in the cache. Keys built
+# from a generation are orphaned (and left to expire) when it is bumped.
+
+def _generation_key(namespace):
+    return f'catalog:gen:{namespace}'
+
+
+def get_generations(*namespaces):
+    """Current generation of each namespace, fetched in one round trip."""
+    cache = catalog_cache()
+    keys = [_generation_key(ns) for ns in namespaces]
+    found = cache.get_many(keys)
+    generations = []
+    for key in keys:
+        generation = found.get(key)
+        if generation is None:
+            generation = uuid.uuid4().hex[:12]
+            # add() so two processes racing on an empty cache agree on one token
+            if not cache.add(key, generation, None):
+                generation = cache.get(key, generation)
+        generations.append(generation)
+    return generations
+
+
+def get_generation(namespace):
+    return get_generations(namespace)[0]
+
+
+def bump_generation(*namespaces):
+    if namespaces:
+        catalog_cache().set_many({_generation_key(ns): uuid.uuid4().hex[:12] for ns in namespaces}, None)
+
+
+def invalidate_products(product_ids):
+    """Drop the cached detail bundles of many products in one cache write."""
+    bump_generation(*[f'product:{product_id}' for product_id in product_ids])
+
+
+def fragment_key(name, vary_on=()):
+    digest = hashlib.md5(':'.join(str(v) for v in vary_on).encode(), usedforsecurity=False).hexdigest()
+    return f'catalog:fragment:{name}:{digest}'
+
+
+def product_fragment_keys(product):
+    """Keys of the fragments rendered for one product (see the product templates)."""
+    vary_on = (product.pk, product.updated.timestamp())
+    return [fragment_key('product_card', vary_on), fragment_key('product_gallery', vary_on)]
+
+
+# Read-through object cache. Entries are keyed on generations, so
+# invalidation is a single generation bump (see gadget_cave/signals.py).
+# Fills read the primary: a lagging replica read right after a bump would
+# otherwise be cached under the fresh generation.
+
+def get_categories():
+    cache = catalog_cache()
+    key = f'catalog:categories:{get_generation("categories")}'
+    categories = cache.get(key)
+    if categories is None:
+        categories = list(Category.objects.using(DEFAULT_DB_ALIAS))
+        cache.set(key, categories, OBJECT_TIMEOUT)
+    return categories
+
+
+def get_category(slug):
+    for category in get_categories():
+        if category.slug == slug:
+            return category
+    return None
+
+
+def get_product_bundle(product_id, slug):
+    """
+    An available product with its category and images already loaded, or
+    None. Misses are cached too (for NEGATIVE_TIMEOUT), so repeated hits on
+    dead URLs never reach the database.
+    """
+    cache = catalog_cache()
+    product_generation, category_generation = get_generations(f'product:{product_id}', 'categories')
+    key = f'catalog:product:{product_id}:{slug}:{product_generation}:{category_generation}'
+    product = cache.get(key)
+    if product is None:
+        try:
+            product = (
+                Product.objects.using(DEFAULT_DB_ALIAS).select_related('category').prefetch_related('images')
+                .get(id=product_id, slug=slug, available=True)
+            )
+            cache.set(key, product, OBJECT_TIMEOUT)
+        except Product.DoesNotExist:
+            cache.set(key, MISSING, NEGATIVE_TIMEOUT)
+            return None
+    return None if isinstance(product, str) else product
@@ -0,0 +1,233 @@
+# gadget_cave/carts.py
+#
+# Cart mutations for logged-in users. Each change is a single statement
+# that checks stock and writes together: an INSERT ... ON CONFLICT DO UPDATE
+# on the (cart, product) unique constraint, so two quick clicks on "Add to
+# cart" both count and neither can push a line past the product's stock.
+# Stock is only checked here, not reserved; checkout reserves it (see
+# inventory.reserve_stock).
+#
+# Every change also rewrites the user's cached cart summary (item count and
+# subtotal) once the transaction commits, so the header badge on every page
+# is a cache read (see context_processors.cart_summary).
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, OuterRef, Prefetch, Subquery, Value
+
+from .cache import catalog_cache
+from .inventory import InsufficientStock, Shortfall
+from .models import Cart, CartItem, Product
+
+MAX_BATCH = 100
+SUMMARY_TIMEOUT = getattr(settings, 'CART_SUMMARY_TIMEOUT', 60 * 60 * 24 * 7)
+
+ITEM_TABLE = CartItem._meta.db_table
+PRODUCT_TABLE = Product._meta.db_table
+# The row proposed for insert only exists if the product is available and
+# has the stock; an existing line is only updated if the new quantity fits.
+UPSERT = f"""
+    INSERT INTO {ITEM_TABLE} (cart_id, product_id, quantity)
+    SELECT %s, id, %s FROM {PRODUCT_TABLE} WHERE id = %s AND available AND stock >= %s
+    ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = {{quantity}}
+    WHERE {{quantity}} <= (SELECT stock FROM {PRODUCT_TABLE} WHERE id = excluded.product_id)
+"""
+UPSERT_ADD = UPSERT.format(quantity=f'{ITEM_TABLE}.quantity + excluded.quantity')
+UPSERT_SET = UPSERT.format(quantity='excluded.quantity')
+
+
+def cart_id_for(user):
+    return Cart.objects.get_or_create(user=user)[0].id
+
+
+def _upsert(cart_id, product_id, quantity, increment):
+    if connection.features.supports_update_conflicts_with_target:
+        with connection.cursor() as cursor:
+            cursor.execute(UPSERT_ADD if increment else UPSERT_SET, [cart_id, quantity, product_id, quantity])
+            return cursor.rowcount == 1
+    # No ON CONFLICT (...) DO UPDATE (MySQL): a conditional F() update, else an insert
+    new_quantity = F('quantity') + quantity if increment else Value(quantity)
+    stock = Product.objects.filter(id=OuterRef('product_id'), available=True).values('stock')
+    updated = (
+        CartItem.objects.filter(cart_id=cart_id, product_id=product_id)
+        .alias(stock=Subquery(stock), new_quantity=new_quantity)
+        .filter(new_quantity__lte=F('stock'))
+        .update(quantity=new_quantity)
+    )
+    if updated or CartItem.objects.filter(cart_id=cart_id, product_id=product_id).exists():
+        return bool(updated)
+    if not Product.objects.filter(id=product_id, available=True, stock__gte=quantity).exists():
+        return False
+    CartItem.objects.create(cart_id=cart_id, product_id=product_id, quantity=quantity)
+    return True
+
+
+def _shortfall(cart_id, product_id, quantity, increment):
+    # Only read when an upsert was refused, to say why
+    stock = Product.objects.filter(id=product_id, available=True).values_list('stock', flat=True).first() or 0
+    in_cart = 0
+    if increment:
+        in_cart = CartItem.objects.filter(cart_id=cart_id, product_id=product_id).values_list('quantity', flat=True).first() or 0
+    return InsufficientStock([Shortfall(product_id, in_cart + quantity, stock)])
+
+
+def add_item(user, product_id, quantity):
+    """
+    Add `quantity` of a product to the user's cart. Raises InsufficientStock
+    (with the quantity the line would have reached) when it doesn't fit.
+    """
+    cart_id = cart_id_for(user)
+    if not _upsert(cart_id, product_id, quantity, increment=True):
+        raise _shortfall(cart_id, product_id, quantity, increment=True)
+    summary_changed(user.pk)
+
+
+def set_quantity(user, product_id, quantity):
+    """Set the quantity of a line, adding it if needed; 0 removes it."""
+    if quantity <= 0:
+        return remove_item(user, product_id)
+    cart_id = cart_id_for(user)
+    if not _upsert(cart_id, product_id, quantity, increment=False):
+        raise _shortfall(cart_id, product_id, quantity, increment=False)
+    summary_changed(user.pk)
+    return 1
+
+
+def remove_item(user, product_id):
+    """Delete the line with one DELETE; returns the number of lines removed (0 or 1)."""
+    removed = CartItem.objects.filter(cart__user=user, product_id=product_id).delete()[0]
+    if removed:
+        summary_changed(user.pk)
+    return removed
+
+
+def check_stock(quantities, lock=False):
+    """
+    Shortfalls for {product_id: quantity} against current stock, from one
+    query. lock=True (inside a transaction) holds the product rows until it
+    commits, so the stock can't change between the check and the write.
+    """
+    products = Product.objects.filter(id__in=quantities, available=True)
+    if lock and connection.features.has_select_for_update:
+        products = products.order_by('id').select_for_update()
+    stock = dict(products.values_list('id', 'stock'))
+    return [
+        Shortfall(product_id, quantity, stock.get(product_id, 0))
+        for product_id, quantity in sorted(quantities.items())
+        if quantity > stock.get(product_id, 0)
+    ]
+
+
+def apply_changes(user, changes):
+    """
+    Set the quantities in {product_id: quantity} (0 removes the line) in one
+    transaction: a DELETE for the removals and one upsert for the rest.
+    All or nothing: if any line exceeds stock, InsufficientStock lists every
+    short line and the cart is left as it was.
+    """
+    removals = [product_id for product_id, quantity in changes.items() if quantity <= 0]
+    quantities = {product_id: quantity for product_id, quantity in changes.items() if quantity > 0}
+    with transaction.atomic():
+        shortfalls = check_stock(quantities, lock=True) if quantities else []
+        if shortfalls:
+            raise InsufficientStock(shortfalls)
+        cart_id = cart_id_for(user)
+        if removals:
+            CartItem.objects.filter(cart_id=cart_id, product_id__in=removals).delete()
+        if quantities:
+            CartItem.objects.bulk_create(
+                [CartItem(cart_id=cart_id, product_id=product_id, quantity=quantity)
+                 for product_id, quantity in quantities.items()],
+                update_conflicts=True, unique_fields=['cart', 'product'], update_fields=['quantity'],
+            )
+        summary_changed(user.pk)
+
+
+def apply_guest_changes(guest_cart, changes):
+    """apply_changes() for a GuestCart: the same stock check, then all the cookie lines or none."""
+    shortfalls = check_stock({product_id: quantity for product_id, quantity in changes.items() if quantity > 0})
+    if shortfalls:
+        raise InsufficientStock(shortfalls)
+    guest_cart.update(changes)
+
+
+def _cart_with_lines(user):
+    return (
+        Cart.objects.with_totals()
+        .prefetch_related(Prefetch('items', queryset=CartItem.objects.select_related('product').order_by('id')))
+        .filter(user=user)
+    )
+
+
+def load_cart(user):
+    """The user's cart with totals and its lines in two queries, or None."""
+    return _cart_with_lines(user).first()
+
+
+async def aload_cart(user):
+    return await _cart_with_lines(user).afirst()
+
+
+def cart_json(cart, items):
+    return {
+        'items': [
+            {
+                'product': item.product.id,
+                'name': item.product.name,
+                'url': item.product.get_absolute_url(),
+                'price': str(item.product.price),
+                'quantity': item.quantity,
+                'cost': str(item.get_cost()),
+            }
+            for item in items
+        ],
+        'item_count': cart.item_count if cart else 0,
+        'total_cost': str(cart.get_total_cost()) if cart else '0.00',
+    }
+
+
+# Cached summaries for the header badge. They are rewritten after every
+# change made through this module, and by order_create and the admin;
+# a product edit (its price may have changed) drops those of the carts
+# holding it.
+
+EMPTY_SUMMARY = {'count': 0, 'subtotal': Decimal('0.00')}
+
+
+def _summary_key(user_id):
+    return f'cart:summary:{user_id}'
+
+
+def compute_summaries(user_ids):
+    """{user_id: {'count', 'subtotal'}} from one aggregate query."""
+    rows = Cart.objects.with_totals().filter(user_id__in=user_ids).values_list('user_id', 'item_count', 'total_cost')
+    summaries = {user_id: dict(EMPTY_SUMMARY) for user_id in user_ids}
+    summaries.update({user_id: {'count': count, 'subtotal': total} for user_id, count, total in rows})
+    return summaries
+
+
+def get_summary(user_id):
+    """The cached summary; only computed (and cached) if it was evicted."""
+    summary = catalog_cache().get(_summary_key(user_id))
+    if summary is None:
+        summary = refresh_summaries([user_id])[user_id]
+    return summary
+
+
+def refresh_summaries(user_ids):
+    summaries = compute_summaries(list(user_ids))
+    catalog_cache().set_many({_summary_key(user_id): summary for user_id, summary in summaries.items()}, SUMMARY_TIMEOUT)
+    return summaries
+
+
+def summary_changed(*user_ids):
+    # After the commit, so a rolled-back change never reaches the cache
+    transaction.on_commit(lambda: refresh_summaries(user_ids))
+
+
+def forget_summaries_for_products(product_ids):
+    """Drop the summaries of every cart holding one of the products, in one query and one cache write."""
+    user_ids = set(CartItem.objects.filter(product_id__in=product_ids).values_list('cart__user_id', flat=True))
+    if user_ids:
+        catalog_cache().delete_many([_summary_key(user_id) for user_id in user_ids])
@@ -0,0 +1,42 @@
+# gadget_cave/catalog.py
+from .models import Product
+from .pagination import KeysetPaginator
+
+CATALOG_PAGE_SIZE = 24
+
+# Every ordering ends in 'id' so the keyset is unique; each one is backed by
+# an index on Product, with and without the category (see Product.Meta.indexes).
+CATALOG_SORTS = {
+    'name': ('name', 'id'),
+    'price': ('price', 'id'),
+    'price_desc': ('-price', '-id'),
+    'newest': ('-created', '-id'),
+}
+DEFAULT_SORT = 'name'
+SORT_CHOICES = [
+    ('name', 'Name'),
+    ('price', 'Price: Low to High'),
+    ('price_desc', 'Price: High to Low'),
+    ('newest', 'Newest'),
+]
+
+# Only the columns a product card needs; description can be large. 'updated'
+# keys the cached card fragment.
+CARD_FIELDS = ('id', 'name', 'slug', 'price', 'main_image', 'created', 'updated')
+
+
+def _paginator(category, sort, per_page):
+    if sort not in CATALOG_SORTS:
+        sort = DEFAULT_SORT
+    products = Product.objects.filter(available=True).only(*CARD_FIELDS)
+    if category is not None:
+        products = products.filter(category=category)
+    return KeysetPaginator(products, CATALOG_SORTS[sort], per_page=per_page)
+
+
+def catalog_page(category=None, sort=DEFAULT_SORT, cursor=None, per_page=CATALOG_PAGE_SIZE):
+    return _paginator(category, sort, per_page).page(cursor)
+
+
+async def acatalog_page(category=None, sort=DEFAULT_SORT, cursor=None, per_page=CATALOG_PAGE_SIZE):
+    return await _paginator(category, sort, per_page).apage(cursor)
@@ -0,0 +1,380 @@
+# gadget_cave/catalog_io.py
+#
+# Bulk catalog import and export, as CSV or JSON Lines with one product per
+# row (see COLUMNS). `category` is the category's slug; `image` and `images`
+# ('|'-separated in CSV, a list in JSON) are paths under a local directory.
+#
+# Imports stream the file a chunk at a time, so memory stays flat whatever
+# its size. Each chunk is one transaction: categories are upserted by slug
+# and products by (category, slug) with INSERT ... ON CONFLICT DO UPDATE, so
+# running the same file again updates the products instead of duplicating
+# them. bulk_create sends no signals, so each chunk also does in bulk what
+# the Product signals do for one save: reindex for search, drop the cached
+# bundles and cart summaries, and queue image processing.
+#
+# Image files are stored under the hash of their bytes; an image whose file
+# is already attached to the product (processed or not) is not copied again.
+#
+# `stock` in a file is the on-hand count, like a supplier feed's (see
+# gadget_cave/inventory_feed.py): exports write stock + reserved, and
+# imports leave max(stock - reserved, 0) to sell.
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F, Prefetch, Value
+from django.db.models.functions import Greatest
+from django.utils.text import slugify
+
+from . import autocomplete, carts, search
+from .cache import bump_generation, invalidate_products
+from .images import queue_processing_many
+from .models import Category, Product, ProductImage
+from .tasks import task
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ('category', 'category_name', 'name', 'slug', 'sku', 'description', 'price', 'stock', 'available', 'image', 'images')
+FORMATS = {'csv': 'csv', 'jsonl': 'jsonl', 'ndjson': 'jsonl'}
+CHUNK_SIZE = getattr(settings, 'CATALOG_IMPORT_CHUNK_SIZE', 2000)
+IMAGE_PREFIX = 'products/import'
+IMAGE_SEPARATOR = '|'
+# Fields an import overwrites on an existing product (stock from the on-hand
+# count, then less its reserved units; see import_chunk). The SKU and main
+# image are only overwritten by rows that have one.
+UPDATE_FIELDS = ['name', 'description', 'price', 'stock', 'available', 'updated']
+# Error messages kept in the result; past this they are only counted
+MAX_ERRORS = 50
+TRUE_VALUES = {'1', 'true', 'yes', 'y', 't'}
+FALSE_VALUES = {'0', 'false', 'no', 'n', 'f'}
+
+_PRODUCT_FIELDS = {name: Product._meta.get_field(name) for name in ('name', 'slug', 'sku', 'description', 'price', 'stock')}
+_CATEGORY_FIELDS = {'category': Category._meta.get_field('slug'), 'category_name': Category._meta.get_field('name')}
+
+
+class RowError(ValueError):
+    """A row that can't be imported; the rest of the file still is."""
+
+
+def detect_format(filename):
+    extension = os.path.splitext(filename)[1].lower().lstrip('.')
+    if extension not in FORMATS:
+        raise ValueError(f'Unknown catalog format {extension!r}; use .csv or .jsonl.')
+    return FORMATS[extension]
+
+
+def read_rows(stream, fmt):
+    """Yield (line number, row dict) from a text stream, one row at a time."""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line, text in enumerate(stream, 1):
+        if text.strip():
+            try:
+                yield line, json.loads(text)
+            except ValueError:
+                yield line, None
+
+
+def _text(row, key):
+    value = row.get(key)
+    if value is None:
+        return ''
+    return str(value).strip()
+
+
+def parse_boolean(value):
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in TRUE_VALUES or value is None or text == '':
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise RowError(f'available: {value!r} is not true or false')
+
+
+def _paths(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(IMAGE_SEPARATOR)
+    return [path.strip() for path in value if path and path.strip()]
+
+
+def clean_row(row):
+    """A row's values checked and converted the way the model fields would; raises RowError."""
+    if not isinstance(row, dict):
+        raise RowError('not a JSON object')
+    name = _text(row, 'name')
+    values = {
+        'category': _text(row, 'category'),
+        'category_name': _text(row, 'category_name'),
+        'name': name,
+        'slug': _text(row, 'slug') or slugify(name),
+        'sku': _text(row, 'sku') or None,
+        'description': _text(row, 'description'),
+        'price': _text(row, 'price'),
+        'stock': _text(row, 'stock') or 0,
+    }
+    for key, field in [*_CATEGORY_FIELDS.items(), *_PRODUCT_FIELDS.items()]:
+        if key in ('category_name', 'sku') and not values[key]:
+            continue
+        try:
+            values[key] = field.clean(values[key], None)
+        except ValidationError as e:
+            raise RowError(f"{key}: {' '.join(e.messages)}")
+    values['available'] = parse_boolean(row.get('available'))
+    values['image'] = _text(row, 'image')
+    values['images'] = _paths(row.get('images'))
+    return values
+
+
+class _Importer:
+    def __init__(self, images_dir=None):
+        self.images_dir = os.path.realpath(images_dir) if images_dir else None
+        # slug: (id, name) of every category seen so far; there are few of them
+        self.categories = {}
+        self.rows = self.created = self.categories_written = self.images = 0
+        self.errors = []
+        self.error_count = 0
+
+    def error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append(f'line {line}: {message}')
+
+    def import_chunk(self, rows):
+        with transaction.atomic():
+            category_ids = self._upsert_categories(rows)
+            # The last row wins when a chunk has the same product twice
+            # (one statement can't upsert a row twice)
+            products = {(category_ids[values['category']], values['slug']): (line, values) for line, values in rows}
+            products = self._claim_skus(products)
+            existing = self._existing(products)
+            saved = self._upsert_products(products, existing)
+            images = self._add_images(saved)
+
+            ids = [product.pk for product, line, values in saved]
+            # Units held by unpaid orders come off the on-hand counts just written
+            Product.objects.filter(id__in=ids, reserved__gt=0).update(stock=Greatest(F('stock') - F('reserved'), Value(0)))
+            updated_ids = [pk for pk, main_image in existing.values()]
+            search.index_products(ids)
+            invalidate_products(updated_ids)
+            carts.forget_summaries_for_products(updated_ids)
+            queue_processing_many([product for product, line, values in saved if product.main_image] + images)
+        self.rows += len(products)
+        self.created += len(products) - len(existing)
+
+    def _upsert_categories(self, rows):
+        unknown = {values['category'] for line, values in rows} - self.categories.keys()
+        if unknown:
+            for slug, pk, name in Category.objects.filter(slug__in=unknown).values_list('slug', 'id', 'name'):
+                self.categories[slug] = (pk, name)
+        names = {}
+        for line, values in rows:
+            slug = values['category']
+            if values['category_name']:
+                names[slug] = values['category_name']
+            elif slug not in self.categories and slug not in names:
+                names[slug] = slug.replace('-', ' ').title()
+        changed = [Category(slug=slug, name=name) for slug, name in names.items() if self.categories.get(slug, (None, None))[1] != name]
+        if changed:
+            Category.objects.bulk_create(changed, update_conflicts=True, unique_fields=['slug'], update_fields=['name'])
+            for category in changed:
+                self.categories[category.slug] = (category.pk, category.name)
+            self.categories_written += len(changed)
+        return {slug: pk for slug, (pk, name) in self.categories.items()}
+
+    def _claim_skus(self, products):
+        """The chunk's products less (reported) rows whose SKU another product holds, here or earlier in the chunk."""
+        skus = {values['sku'] for line, values in products.values() if values['sku']}
+        if not skus:
+            return products
+        owners = {sku: (category_id, slug) for sku, category_id, slug in
+                  Product.objects.filter(sku__in=skus).values_list('sku', 'category_id', 'slug')}
+        claimed = {}
+        for key, (line, values) in products.items():
+            sku = values['sku']
+            if sku and owners.setdefault(sku, key) != key:
+                self.error(line, f'sku: {sku!r} already belongs to the product {owners[sku][1]!r}')
+                continue
+            claimed[key] = (line, values)
+        return claimed
+
+    def _existing(self, products):
+        """{(category_id, slug): (id, main_image)} of the chunk's products that are already there."""
+        rows = Product.objects.filter(
+            category_id__in={category_id for category_id, slug in products},
+            slug__in={slug for category_id, slug in products},
+        ).values_list('category_id', 'slug', 'id', 'main_image')
+        return {(category_id, slug): (pk, main_image) for category_id, slug, pk, main_image in rows
+                if (category_id, slug) in products}
+
+    def _upsert_products(self, products, existing):
+        batches, saved = {}, []
+        for (category_id, slug), (line, values) in products.items():
+            product = Product(
+                category_id=category_id, slug=slug, sku=values['sku'], name=values['name'],
+                description=values['description'], price=values['price'], stock=values['stock'],
+                available=values['available'],
+            )
+            if values['image']:
+                current = existing.get((category_id, slug), (None, None))[1]
+                product.main_image = self._attach(line, values['image'], [current])
+            # Rows without a SKU or an image keep the product's
+            fields = (*UPDATE_FIELDS, *(['sku'] if product.sku else []), *(['main_image'] if product.main_image else []))
+            batches.setdefault(fields, []).append(product)
+            saved.append((product, line, values))
+        for fields, batch in batches.items():
+            Product.objects.bulk_create(batch, update_conflicts=True, unique_fields=['category', 'slug'], update_fields=fields)
+        return saved
+
+    def _add_images(self, saved):
+        """Create the ProductImages for extra images the products don't have yet."""
+        wanted = [(product, line, values['images']) for product, line, values in saved if values['images']]
+        if not wanted:
+            return []
+        attached = {}
+        for product_id, name in ProductImage.objects.filter(product_id__in=[product.pk for product, line, paths in wanted]).values_list('product_id', 'image'):
+            attached.setdefault(product_id, []).append(name)
+        images = []
+        for product, line, paths in wanted:
+            current = attached.setdefault(product.pk, [])
+            for path in paths:
+                name = self._attach(line, path, current)
+                if name is not None and name not in current:
+                    current.append(name)
+                    images.append(ProductImage(product_id=product.pk, image=name))
+        return ProductImage.objects.bulk_create(images)
+
+    def _attach(self, line, path, current):
+        """The storage name for a local image file: one of `current` if it holds the same bytes, else a new copy."""
+        try:
+            data = self._read(path)
+        except (OSError, RowError) as e:
+            self.error(line, f'{path}: {e}')
+            return None
+        digest = hashlib.sha256(data).hexdigest()[:32]
+        # Processing re-encodes a file under its old name's stem, so the hash survives it
+        for name in current:
+            if name and os.path.basename(name).startswith(digest):
+                return name
+        # A copy per product: processing deletes the file it replaces
+        self.images += 1
+        return default_storage.save(f'{IMAGE_PREFIX}/{digest}{os.path.splitext(path)[1].lower()}', ContentFile(data))
+
+    def _read(self, path):
+        if self.images_dir is None:
+            raise RowError('no image directory was given')
+        full_path = os.path.realpath(os.path.join(self.images_dir, path))
+        if os.path.commonpath([full_path, self.images_dir]) != self.images_dir:
+            raise RowError('outside the image directory')
+        with open(full_path, 'rb') as f:
+            return f.read()
+
+    def finish(self):
+        if self.categories_written:
+            bump_generation('categories')
+        if self.rows:
+            transaction.on_commit(autocomplete.index.request_sync)
+
+
+def import_catalog(stream, fmt, images_dir=None, chunk_size=CHUNK_SIZE):
+    """
+    Upsert the categories and products of a CSV/JSONL text stream, a chunk
+    per transaction. Bad rows are skipped and reported. Returns the counts,
+    up to MAX_ERRORS error messages and the rows imported per second.
+    """
+    importer = _Importer(images_dir)
+    started = time.perf_counter()
+    chunk = []
+    for line, row in read_rows(stream, fmt):
+        try:
+            chunk.append((line, clean_row(row)))
+        except RowError as e:
+            importer.error(line, e)
+        if len(chunk) >= chunk_size:
+            importer.import_chunk(chunk)
+            chunk = []
+    if chunk:
+        importer.import_chunk(chunk)
+    importer.finish()
+    elapsed = time.perf_counter() - started
+    return {
+        'rows': importer.rows,
+        'created': importer.created,
+        'updated': importer.rows - importer.created,
+        'categories': importer.categories_written,
+        'images': importer.images,
+        'errors': importer.error_count,
+        'error_messages': importer.errors,
+        'seconds': round(elapsed, 2),
+        'rows_per_s': round(importer.rows / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+@task('import_catalog')
+def import_catalog_file(name, fmt, images_dir=None):
+    """Import a catalog file uploaded to storage (from the admin), then delete it."""
+    with default_storage.open(name, 'rb') as f:
+        result = import_catalog(io.TextIOWrapper(f, encoding='utf-8-sig', newline=''), fmt, images_dir)
+    default_storage.delete(name)
+    logger.info('Imported %s: %s', name, result)
+
+
+# Export
+
+class Echo:
+    # csv.writer "file" that hands each formatted row back instead of storing it
+    def write(self, value):
+        return value
+
+
+def _export_row(product):
+    return {
+        'category': product.category.slug,
+        'category_name': product.category.name,
+        'name': product.name,
+        'slug': product.slug,
+        'sku': product.sku or '',
+        'description': product.description,
+        'price': str(product.price),
+        'stock': product.stock + product.reserved,
+        'available': product.available,
+        'image': product.main_image.name if product.main_image else '',
+        'images': [image.image.name for image in product.images.all()],
+    }
+
+
+def export_catalog(fmt, products=None, chunk_size=CHUNK_SIZE):
+    """
+    Yield the catalog (or the `products` queryset) as CSV/JSONL text, a row
+    at a time, reading the products chunk_size at a time with their images
+    prefetched per chunk. Image paths are storage names, so the output
+    imports again with MEDIA_ROOT as the image directory.
+    """
+    products = (Product.objects.all() if products is None else products).select_related('category').prefetch_related(
+        Prefetch('images', queryset=ProductImage.objects.only('product', 'image').order_by('id'))
+    ).order_by('id')
+    writer = csv.writer(Echo())
+    if fmt == 'csv':
+        yield writer.writerow(COLUMNS)
+    for product in products.iterator(chunk_size=chunk_size):
+        row = _export_row(product)
+        if fmt == 'csv':
+            row['images'] = IMAGE_SEPARATOR.join(row['images'])
+            yield writer.writerow([row[column] for column in COLUMNS])
+        else:
+            yield json.dumps(row) + '\n'
@@ -0,0 +1,19 @@
+# gadget_cave/context_processors.py
+from django.utils.functional import SimpleLazyObject
+
+from . import carts
+
+
+def cart_summary(request):
+    """
+    `cart_summary` ({'count', 'subtotal'}) for the header badge. For users
+    it is one cache read (kept current by gadget_cave/carts.py); for guests
+    the count comes from the cart cookie and there is no subtotal.
+    """
+    def summary():
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            return carts.get_summary(user.pk)
+        guest_cart = getattr(request, 'guest_cart', None)
+        return {'count': guest_cart.count if guest_cart is not None else 0, 'subtotal': None}
+    return {'cart_summary': SimpleLazyObject(summary)}
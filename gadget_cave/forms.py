@@ -1,5 +1,6 @@
 from django import forms
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm
+from .catalog_io import detect_format
 from .models import CustomUser, Product, Cart, Order # Corrected import
 import re # For phone number validation
 
@@ -65,4 +66,15 @@ class CustomUserCreationForm(UserCreationForm):
 class CustomUserChangeForm(UserChangeForm):
     class Meta:
         model = CustomUser
-        fields = UserChangeForm.Meta.fields
\ No newline at end of file
+        fields = UserChangeForm.Meta.fields
+
+class CatalogImportForm(forms.Form):
+    file = forms.FileField(help_text="A .csv or .jsonl catalog, one product per row.")
+
+    def clean_file(self):
+        upload = self.cleaned_data['file']
+        try:
+            upload.catalog_format = detect_format(upload.name)
+        except ValueError as e:
+            raise forms.ValidationError(str(e))
+        return upload
@@ -0,0 +1,161 @@
+# gadget_cave/guest_cart.py
+#
+# The cart of a visitor who isn't logged in. It lives entirely in a signed
+# cookie ("<product id>:<quantity>,..."), so browsing and adding to the cart
+# as a guest never writes to the database. AnonymousCartMiddleware puts it on
+# request.guest_cart; at login it is merged into the user's Cart with a
+# single bulk upsert (see merge_into_user_cart).
+from decimal import Decimal
+
+from django.conf import settings
+from django.core import signing
+from django.db import transaction
+
+from .carts import summary_changed
+from .models import Cart, CartItem, Product
+
+COOKIE_NAME = getattr(settings, 'GUEST_CART_COOKIE_NAME', 'gadget_cave_cart')
+COOKIE_AGE = getattr(settings, 'GUEST_CART_COOKIE_AGE', 60 * 60 * 24 * 30)
+COOKIE_SALT = 'gadget_cave.guest_cart'
+MAX_LINES = 50
+
+
+class GuestCart:
+    def __init__(self, lines=None):
+        # {product_id: quantity}, in the order the products were added
+        self.lines = dict(lines or {})
+        self.modified = False
+        self._items = None
+
+    @classmethod
+    def from_request(cls, request):
+        value = request.get_signed_cookie(COOKIE_NAME, default='', salt=COOKIE_SALT, max_age=COOKIE_AGE)
+        return cls(cls.decode(value))
+
+    @staticmethod
+    def decode(value):
+        lines = {}
+        for part in value.split(',')[:MAX_LINES]:
+            product_id, _, quantity = part.partition(':')
+            if product_id.isdigit() and quantity.isdigit() and int(quantity) > 0:
+                lines[int(product_id)] = int(quantity)
+        return lines
+
+    def encode(self):
+        return ','.join(f'{product_id}:{quantity}' for product_id, quantity in self.lines.items())
+
+    def save(self, response):
+        if not self.modified:
+            return
+        if self.lines:
+            response.set_signed_cookie(
+                COOKIE_NAME, self.encode(), salt=COOKIE_SALT, max_age=COOKIE_AGE,
+                secure=settings.SESSION_COOKIE_SECURE, httponly=True, samesite='Lax',
+            )
+        else:
+            response.delete_cookie(COOKIE_NAME, samesite='Lax')
+
+    def _changed(self):
+        self.modified = True
+        self._items = None
+
+    def quantity(self, product_id):
+        return self.lines.get(product_id, 0)
+
+    def add(self, product_id, quantity):
+        if product_id not in self.lines and len(self.lines) >= MAX_LINES:
+            raise ValueError(f'A guest cart holds at most {MAX_LINES} different products.')
+        self.lines[product_id] = self.lines.get(product_id, 0) + quantity
+        self._changed()
+
+    def set(self, product_id, quantity):
+        if quantity <= 0:
+            return self.remove(product_id)
+        if product_id not in self.lines and len(self.lines) >= MAX_LINES:
+            raise ValueError(f'A guest cart holds at most {MAX_LINES} different products.')
+        self.lines[product_id] = quantity
+        self._changed()
+
+    def update(self, changes):
+        """set() for every line of {product_id: quantity}, applied only if the result fits."""
+        lines = dict(self.lines)
+        for product_id, quantity in changes.items():
+            if quantity <= 0:
+                lines.pop(product_id, None)
+            else:
+                lines[product_id] = quantity
+        if len(lines) > MAX_LINES:
+            raise ValueError(f'A guest cart holds at most {MAX_LINES} different products.')
+        if lines != self.lines:
+            self.lines = lines
+            self._changed()
+
+    def remove(self, product_id):
+        if self.lines.pop(product_id, None) is not None:
+            self._changed()
+
+    def clear(self):
+        if self.lines:
+            self.lines = {}
+            self._changed()
+
+    @property
+    def count(self):
+        """Items in the cart, straight from the cookie (no query; may include products gone unavailable)."""
+        return sum(self.lines.values())
+
+    def __bool__(self):
+        return bool(self.lines)
+
+    # The same interface the cart template uses on Cart.objects.with_totals()
+
+    def items(self):
+        """Unsaved CartItems for the available products in the cart, from one query."""
+        if self._items is None:
+            self._items = self._build_items(Product.objects.filter(id__in=self.lines, available=True).in_bulk())
+        return self._items
+
+    async def aitems(self):
+        if self._items is None:
+            self._items = self._build_items(await Product.objects.filter(id__in=self.lines, available=True).ain_bulk())
+        return self._items
+
+    def _build_items(self, products):
+        return [
+            CartItem(product=products[product_id], quantity=quantity)
+            for product_id, quantity in self.lines.items() if product_id in products
+        ]
+
+    @property
+    def item_count(self):
+        return sum(item.quantity for item in self.items())
+
+    def get_total_cost(self):
+        return sum((item.get_cost() for item in self.items()), Decimal('0.00'))
+
+
+def merge_into_user_cart(guest_cart, user):
+    """
+    Add the guest cart's lines to the user's Cart and empty the guest cart.
+    Quantities of products already in the Cart are summed (and capped at the
+    current stock); all lines are written with one INSERT ... ON CONFLICT
+    DO UPDATE on the (cart, product) unique constraint.
+    """
+    if not guest_cart:
+        return
+    with transaction.atomic():
+        cart, created = Cart.objects.get_or_create(user=user)
+        existing = {} if created else dict(
+            CartItem.objects.filter(cart=cart, product_id__in=guest_cart.lines).values_list('product_id', 'quantity')
+        )
+        stock = dict(Product.objects.filter(id__in=guest_cart.lines, available=True).values_list('id', 'stock'))
+        items = [
+            CartItem(cart=cart, product_id=product_id, quantity=min(existing.get(product_id, 0) + quantity, stock[product_id]))
+            for product_id, quantity in guest_cart.lines.items()
+            if stock.get(product_id)
+        ]
+        CartItem.objects.bulk_create(
+            items, update_conflicts=True, unique_fields=['cart', 'product'], update_fields=['quantity'],
+        )
+        summary_changed(user.pk)
+    guest_cart.clear()
@@ -0,0 +1,307 @@
+# gadget_cave/images.py
+#
+# Resized WebP/JPEG renditions of product images, for <img srcset>, and the
+# background task that cleans up new uploads.
+#
+# Renditions are content-addressed: they are stored under the SHA-256 of the
+# original file's bytes, so re-uploads of the same photo share them. The
+# mapping from an upload's name to its renditions (the "manifest") is a
+# small JSON file in storage next to them, keyed by the upload's name, with
+# the catalog cache in front. Requests only ever read manifests (no writes,
+# so pages can be served from a replica): an image without one is served as
+# the original file until its upload processing or `manage.py
+# backfill_renditions` generates its renditions.
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from django.db.models import CharField, OuterRef, Subquery, Value
+from django.db.models.functions import Cast, Concat
+from django.utils import timezone
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .cache import catalog_cache, invalidate_products
+from .models import Product, ProductImage, Task
+from .tasks import enqueue, enqueue_many, task
+
+logger = logging.getLogger(__name__)
+
+RENDITION_WIDTHS = tuple(getattr(settings, 'IMAGE_RENDITION_WIDTHS', (160, 320, 640, 1280)))
+RENDITION_FORMATS = {
+    # format: (extension, Pillow save options)
+    'webp': ('webp', {'quality': 75, 'method': 4}),
+    'jpeg': ('jpg', {'quality': 80, 'optimize': True, 'progressive': True}),
+}
+RENDITION_PREFIX = 'renditions'
+# Uploads are scaled down to fit this box when they are processed
+MAX_DIMENSION = getattr(settings, 'IMAGE_MAX_DIMENSION', 2048)
+
+
+def _manifest_key(name):
+    return 'renditions:' + hashlib.md5(name.encode(), usedforsecurity=False).hexdigest()
+
+
+def rendition_name(digest, width, fmt):
+    return f'{RENDITION_PREFIX}/{digest[:2]}/{digest}-{width}w.{RENDITION_FORMATS[fmt][0]}'
+
+
+def target_widths(original_width):
+    # Never upscale: keep the configured widths up to the original, or the
+    # original width itself for images smaller than all of them.
+    widths = [width for width in RENDITION_WIDTHS if width <= original_width]
+    return widths or [original_width]
+
+
+def open_image(data):
+    image = Image.open(io.BytesIO(data))
+    # Apply the EXIF orientation, since the renditions carry no EXIF
+    return ImageOps.exif_transpose(image)
+
+
+def encode(image, width, fmt):
+    if image.width > width:
+        height = max(1, round(image.height * width / image.width))
+        image = image.resize((width, height), Image.LANCZOS)
+    if fmt == 'jpeg' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    elif image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        image = image.convert('RGBA')
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt.upper(), **RENDITION_FORMATS[fmt][1])
+    return buffer.getvalue()
+
+
+def generate_renditions(name, storage=default_storage):
+    """
+    Create any missing renditions of the stored image `name` and return its
+    manifest: {'digest', 'width', 'height', 'webp': [(width, name)], 'jpeg': [...]}.
+    """
+    with storage.open(name, 'rb') as source:
+        data = source.read()
+    digest = hashlib.sha256(data).hexdigest()
+    image = open_image(data)
+    image.load()
+    manifest = {'digest': digest, 'width': image.width, 'height': image.height}
+    for fmt in RENDITION_FORMATS:
+        manifest[fmt] = []
+        for width in target_widths(image.width):
+            path = rendition_name(digest, width, fmt)
+            if not storage.exists(path):
+                storage.save(path, ContentFile(encode(image, width, fmt)))
+            manifest[fmt].append((width, path))
+    return manifest
+
+
+def manifest_name(name):
+    return f'{RENDITION_PREFIX}/manifests/{hashlib.sha256(name.encode()).hexdigest()}.json'
+
+
+def store_manifest(name, manifest, storage=default_storage):
+    path = manifest_name(name)
+    # Storage.save() would pick a new name rather than overwrite
+    if storage.exists(path):
+        storage.delete(path)
+    storage.save(path, ContentFile(json.dumps(manifest).encode()))
+    catalog_cache().set(_manifest_key(name), manifest, None)
+
+
+def _read_manifest(name, storage):
+    try:
+        with storage.open(manifest_name(name), 'rb') as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def get_manifest(name, storage=default_storage):
+    """
+    The stored manifest for `name`, or None if its renditions haven't been
+    made yet. Never decodes the image or writes to the database.
+    """
+    cache = catalog_cache()
+    manifest = cache.get(_manifest_key(name))
+    if manifest is None:
+        manifest = _read_manifest(name, storage)
+        # Missing ones too, briefly, so page views don't ask storage every time
+        cache.set(_manifest_key(name), manifest or False, None if manifest else 60)
+    return manifest or None
+
+
+def queue_renditions(names):
+    """Queue a render_image task per stored image name, in one INSERT."""
+    enqueue_many([('render_image', {'name': name}, f'render_image:{name}') for name in dict.fromkeys(names)])
+
+
+@task('render_image')
+def render_image(name):
+    try:
+        store_manifest(name, generate_renditions(name))
+    except (UnidentifiedImageError, ValueError) as e:
+        # Not an image: retrying won't help, pages keep showing the original
+        logger.warning('Could not create renditions of %s: %s', name, e)
+        return
+    # Pages cached with the original file in place of the renditions
+    product_ids = set(Product.objects.filter(main_image=name).values_list('id', flat=True))
+    product_ids.update(ProductImage.objects.filter(image=name).values_list('product_id', flat=True))
+    if product_ids:
+        Product.objects.filter(id__in=product_ids).update(updated=timezone.now())
+        transaction.on_commit(lambda: invalidate_products(product_ids))
+
+
+def srcset(manifest, fmt, storage=default_storage):
+    return ', '.join(f'{storage.url(path)} {width}w' for width, path in manifest[fmt])
+
+
+def pick(manifest, min_width, fmt='jpeg', storage=default_storage):
+    """URL of the smallest rendition at least min_width wide (or the largest one)."""
+    for width, path in manifest[fmt]:
+        if width >= min_width:
+            return storage.url(path)
+    return storage.url(manifest[fmt][-1][1])
+
+
+def responsive_image(field_file, width=320):
+    """
+    Template data for an ImageField value: {'src', 'full', 'webp', 'jpeg'},
+    where src is the JPEG rendition closest to `width`, full the largest one,
+    and webp/jpeg are srcset strings. Falls back to the original file (with
+    empty srcsets) until its renditions exist, and returns None for no file.
+    """
+    if not field_file:
+        return None
+    manifest = get_manifest(field_file.name)
+    if manifest is None:
+        return {'src': field_file.url, 'full': field_file.url, 'webp': '', 'jpeg': ''}
+    return {
+        'src': pick(manifest, width),
+        'full': pick(manifest, RENDITION_WIDTHS[-1]),
+        'webp': srcset(manifest, 'webp'),
+        'jpeg': srcset(manifest, 'jpeg'),
+    }
+
+
+def _backfill_one(name):
+    try:
+        return name, generate_renditions(name), None
+    except (OSError, UnidentifiedImageError, ValueError) as e:
+        return name, None, str(e)
+
+
+def backfill_renditions(names, workers=None):
+    """
+    Generate renditions for many stored images in a process pool (Pillow's
+    resizing holds the GIL) and store their manifests. Yields
+    (name, manifest, error) as each image finishes.
+    """
+    names = list(dict.fromkeys(names))
+    if workers == 1:
+        yield from _store_results(map(_backfill_one, names))
+        return
+    # Children inherit the configured storage via fork and only touch files,
+    # never the database; manifests are stored here in the parent.
+    connections.close_all()
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as pool:
+        yield from _store_results(pool.map(_backfill_one, names, chunksize=4))
+
+
+def _store_results(results):
+    for name, manifest, error in results:
+        if manifest is not None:
+            store_manifest(name, manifest)
+        yield name, manifest, error
+
+
+# Upload processing. Saving a product image only stores the uploaded file;
+# a `process_image` task then decodes it, applies and strips the EXIF data,
+# scales it down to MAX_DIMENSION, re-encodes it, swaps the field over to
+# the new file and generates its renditions (see `manage.py run_tasks`).
+
+IMAGE_FIELDS = {'gadget_cave.product': 'main_image', 'gadget_cave.productimage': 'image'}
+
+
+def _task_key(model, pk, name):
+    return f'process_image:{model}:{pk}:{name}'
+
+
+def _processing_task(instance):
+    model = instance._meta.label_lower
+    field = IMAGE_FIELDS[model]
+    field_file = getattr(instance, field)
+    if not field_file:
+        return None
+    payload = {'model': model, 'pk': instance.pk, 'field': field, 'name': field_file.name}
+    return 'process_image', payload, _task_key(model, instance.pk, field_file.name)
+
+
+def queue_processing(instance):
+    """Queue processing of a saved Product/ProductImage's image, once per file."""
+    processing = _processing_task(instance)
+    if processing is None:
+        return None
+    name, payload, key = processing
+    return enqueue(name, payload, key=key)
+
+
+def queue_processing_many(instances):
+    """queue_processing for many rows in one INSERT (bulk_create sends no post_save)."""
+    tasks = [processing for processing in map(_processing_task, instances) if processing is not None]
+    if tasks:
+        enqueue_many(tasks)
+
+
+def processing_status(model):
+    """Subquery of the processing task status of each row's current image, for annotate()."""
+    field = IMAGE_FIELDS[model]
+    key = Concat(Value(f'process_image:{model}:'), Cast(OuterRef('pk'), CharField()), Value(':'), OuterRef(field))
+    return Subquery(Task.objects.filter(key=key).values('status')[:1])
+
+
+def reencode(data):
+    """The image in `data` scaled to fit MAX_DIMENSION, without EXIF: (bytes, extension)."""
+    image = open_image(data)
+    image.thumbnail((MAX_DIMENSION, MAX_DIMENSION), Image.LANCZOS)
+    buffer = io.BytesIO()
+    if 'A' in image.getbands() or 'transparency' in image.info:
+        image.save(buffer, format='PNG', optimize=True)
+        return buffer.getvalue(), 'png'
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.save(buffer, format='JPEG', quality=85, optimize=True, progressive=True)
+    return buffer.getvalue(), 'jpg'
+
+
+@task('process_image')
+def process_image(model, pk, field, name):
+    Model = apps.get_model(model)
+    # The image was replaced or its row deleted since this task was queued
+    if not Model.objects.filter(pk=pk, **{field: name}).exists():
+        return
+    with default_storage.open(name, 'rb') as source:
+        data, extension = reencode(source.read())
+    new_name = default_storage.save(f'{os.path.splitext(name)[0]}.{extension}', ContentFile(data))
+    if not Model.objects.filter(pk=pk, **{field: name}).update(**{field: new_name}):
+        default_storage.delete(new_name)
+        return
+    # The processed file is final: record it so saving the row again doesn't requeue it
+    Task.objects.get_or_create(key=_task_key(model, pk, new_name), defaults={
+        'name': 'process_image', 'status': 'done',
+        'payload': {'model': model, 'pk': pk, 'field': field, 'name': new_name},
+    })
+    # A queryset update, so touch the product and drop its cached pages by hand
+    product_id = pk if Model is Product else Model.objects.filter(pk=pk).values_list('product_id', flat=True).get()
+    Product.objects.filter(pk=product_id).update(updated=timezone.now())
+    store_manifest(new_name, generate_renditions(new_name))
+
+    def cleanup():
+        default_storage.delete(name)
+        invalidate_products([product_id])
+    transaction.on_commit(cleanup)
@@ -0,0 +1,203 @@
+# gadget_cave/inventory.py
+from collections import Counter, namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, Exists, F, OuterRef, PositiveIntegerField, Sum, Value, When
+from django.utils import timezone
+
+from .cache import invalidate_products
+from .models import Order, OrderItem, Product, StockReservation
+
+Shortfall = namedtuple('Shortfall', ['product_id', 'requested', 'available'])
+
+
+class InsufficientStock(Exception):
+    def __init__(self, shortfalls):
+        self.shortfalls = shortfalls
+        super().__init__(', '.join(
+            f'product {s.product_id}: requested {s.requested}, available {s.available}' for s in shortfalls
+        ))
+
+
+class _NotAllReserved(Exception):
+    pass
+
+
+def _invalidate_on_commit(product_ids):
+    # Stock is shown on the cached product page; these are queryset updates,
+    # so no post_save signal fires for them.
+    transaction.on_commit(lambda: invalidate_products(product_ids))
+
+
+def _per_product(quantities):
+    return Case(
+        *[When(id=product_id, then=Value(quantity)) for product_id, quantity in quantities.items()],
+        default=Value(0),
+        output_field=PositiveIntegerField(),
+    )
+
+
+def reserve_stock(quantities):
+    """
+    Move {product_id: quantity} from stock to reserved in a single
+    conditional UPDATE.
+
+    Either every line is decremented or none is: if any product is short
+    (or unavailable) the update is rolled back and InsufficientStock lists
+    the short lines. Safe against concurrent checkouts because the stock
+    check and the decrement are the same statement.
+    """
+    quantities = {product_id: quantity for product_id, quantity in quantities.items() if quantity > 0}
+    if not quantities:
+        return
+    ids = sorted(quantities)
+    needed = _per_product(quantities)
+    # A retry only happens if stock came back between the failed UPDATE and
+    # the read that explains it, i.e. nothing is actually short any more.
+    for attempt in range(3):
+        try:
+            with transaction.atomic():
+                if connection.features.has_select_for_update:
+                    # Lock rows in id order so two multi-line checkouts can't deadlock.
+                    # (SQLite has no row locks; its write lock already serializes this.)
+                    list(Product.objects.select_for_update().filter(id__in=ids).order_by('id').values_list('id', flat=True))
+                updated = (
+                    Product.objects.filter(id__in=ids, available=True, stock__gte=needed)
+                    .update(stock=F('stock') - needed, reserved=F('reserved') + needed)
+                )
+                if updated != len(ids):
+                    raise _NotAllReserved
+            _invalidate_on_commit(ids)
+            return
+        except _NotAllReserved:
+            available = dict(Product.objects.filter(id__in=ids, available=True).values_list('id', 'stock'))
+            shortfalls = [
+                Shortfall(product_id, quantity, available.get(product_id, 0))
+                for product_id, quantity in sorted(quantities.items())
+                if available.get(product_id, 0) < quantity
+            ]
+            if shortfalls:
+                raise InsufficientStock(shortfalls)
+    raise InsufficientStock([Shortfall(product_id, quantity, None) for product_id, quantity in sorted(quantities.items())])
+
+
+def release_stock(quantities):
+    """Give reserved {product_id: quantity} back to stock in one UPDATE."""
+    quantities = {product_id: quantity for product_id, quantity in quantities.items() if quantity > 0}
+    if quantities:
+        needed = _per_product(quantities)
+        Product.objects.filter(id__in=quantities).update(stock=F('stock') + needed, reserved=F('reserved') - needed)
+        _invalidate_on_commit(list(quantities))
+
+
+def reservation_ttl():
+    return timedelta(minutes=getattr(settings, 'STOCK_RESERVATION_MINUTES', 30))
+
+
+def place_order(order, lines):
+    """
+    Save an unsaved Order together with its lines: [(product, quantity, price), ...].
+
+    Stock for all lines is reserved first (see reserve_stock), then the
+    OrderItems and the order's StockReservations are written with one bulk
+    INSERT each. Raises InsufficientStock without writing anything if any
+    line can't be filled.
+    """
+    quantities = Counter()
+    for product, quantity, price in lines:
+        quantities[product.id] += quantity
+    with transaction.atomic():
+        reserve_stock(quantities)
+        order.save()
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, price=price, quantity=quantity)
+            for product, quantity, price in lines
+        ])
+        expires_at = timezone.now() + reservation_ttl()
+        StockReservation.objects.bulk_create([
+            StockReservation(order=order, product_id=product_id, quantity=quantity, expires_at=expires_at)
+            for product_id, quantity in quantities.items()
+        ])
+    return order
+
+
+def _reserved_quantities(order_ids):
+    rows = (
+        StockReservation.objects.filter(order_id__in=order_ids)
+        .values('product_id').annotate(quantity=Sum('quantity')).order_by()
+    )
+    return {row['product_id']: row['quantity'] for row in rows}
+
+
+def commit_reservations(order):
+    """Payment received: the order's reserved units become sold units."""
+    commit_order_reservations([order.id])
+
+
+def commit_order_reservations(order_ids):
+    """commit_reservations for many orders: one grouped SELECT, one UPDATE, one DELETE."""
+    with transaction.atomic():
+        quantities = _reserved_quantities(order_ids)
+        if quantities:
+            Product.objects.filter(id__in=quantities).update(reserved=F('reserved') - _per_product(quantities))
+            StockReservation.objects.filter(order_id__in=order_ids).delete()
+
+
+def restock_orders(order_ids):
+    """
+    Put the units of cancelled orders back on sale in one UPDATE: units
+    still reserved go from reserved to stock, and units already sold (paid
+    orders, whose reservations were committed) go back to stock. Returns
+    the units restocked.
+    """
+    with transaction.atomic():
+        released = _reserved_quantities(order_ids)
+        sold = (
+            OrderItem.objects.filter(order_id__in=order_ids, order__paid=True)
+            .exclude(Exists(StockReservation.objects.filter(order=OuterRef('order'))))
+            .values('product_id').annotate(quantity=Sum('quantity')).order_by()
+        )
+        restocked = Counter(released)
+        restocked.update({row['product_id']: row['quantity'] for row in sold})
+        if restocked:
+            Product.objects.filter(id__in=restocked).update(
+                stock=F('stock') + _per_product(restocked), reserved=F('reserved') - _per_product(released),
+            )
+            StockReservation.objects.filter(order_id__in=order_ids).delete()
+            _invalidate_on_commit(list(restocked))
+    return sum(restocked.values())
+
+
+def release_expired_reservations(batch_size=500, now=None):
+    """
+    Cancel unpaid orders whose reservations have expired and put their units
+    back on sale, batch_size orders per transaction. Each batch is one SELECT
+    (an index range scan on (payment_status, created)), one grouped SELECT of
+    the reservations, and one UPDATE/DELETE each for products, reservations
+    and orders. Returns (orders_cancelled, units_released).
+    """
+    now = now or timezone.now()
+    # Reservations are created together with the order, so nothing created
+    # after now - ttl can have expired yet.
+    candidates = (
+        Order.objects.filter(payment_status='pending', paid=False, created__lte=now - reservation_ttl())
+        .filter(Exists(StockReservation.objects.filter(order=OuterRef('pk'), expires_at__lte=now)))
+        .order_by('created')
+    )
+    if connection.features.has_select_for_update_skip_locked:
+        candidates = candidates.select_for_update(skip_locked=True)
+    orders_cancelled = units_released = 0
+    while True:
+        with transaction.atomic():
+            order_ids = list(candidates.values_list('id', flat=True)[:batch_size])
+            if not order_ids:
+                break
+            quantities = _reserved_quantities(order_ids)
+            release_stock(quantities)
+            StockReservation.objects.filter(order_id__in=order_ids).delete()
+            Order.objects.filter(id__in=order_ids).update(status='cancelled', payment_status='failed', updated=now)
+        orders_cancelled += len(order_ids)
+        units_released += sum(quantities.values())
+    return orders_cancelled, units_released
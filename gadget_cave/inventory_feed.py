@@ -0,0 +1,153 @@
+# gadget_cave/inventory_feed.py
+#
+# Bulk price, stock and availability updates: supplier feeds keyed by SKU
+# (`manage.py apply_inventory_feed`) and the product changelist's
+# list_editable, keyed by id.
+#
+# Product.stock is what is left to sell; units held by unpaid orders sit in
+# Product.reserved. A feed's stock is the supplier's on-hand count, so the
+# product's stock becomes that count less its reserved units (never below
+# zero). The admin edits stock itself.
+#
+# Updates go in batches. Each batch reads the current values of its
+# products in one query, writes only the products whose values really
+# change (bulk_update, one UPDATE per combination of changed fields, so a
+# price change never writes back a stale stock count) and records every
+# changed field in InventoryChange. Queryset writes send no signals, so the
+# cached bundles, cart summaries and search rows of the changed products
+# are dropped together per batch.
+import itertools
+import time
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+
+from . import autocomplete, carts, search
+from .cache import invalidate_products
+from .catalog_io import MAX_ERRORS, RowError, parse_boolean, read_rows
+from .models import InventoryChange, Product
+
+FIELDS = ('price', 'stock', 'available')
+BATCH_SIZE = getattr(settings, 'INVENTORY_FEED_BATCH_SIZE', 1000)
+
+_MODEL_FIELDS = {name: Product._meta.get_field(name) for name in ('sku', 'price', 'stock')}
+
+
+def clean_feed_row(row):
+    """(sku, {field: value}) for a feed row; blank fields are left as they are. Raises RowError."""
+    if not isinstance(row, dict):
+        raise RowError('not a JSON object')
+    values = {}
+    for field in ('sku', *FIELDS):
+        value = row.get(field)
+        if value is None or str(value).strip() == '':
+            continue
+        if field == 'available':
+            values[field] = parse_boolean(value)
+            continue
+        try:
+            values[field] = _MODEL_FIELDS[field].clean(str(value).strip(), None)
+        except ValidationError as e:
+            raise RowError(f"{field}: {' '.join(e.messages)}")
+    if 'sku' not in values:
+        raise RowError('sku is required')
+    return values.pop('sku'), values
+
+
+def _batches(items, size):
+    items = iter(items)
+    while batch := dict(itertools.islice(items, size)):
+        yield batch
+
+
+def _apply_batch(updates, key, on_hand, source, user, batch_id, result):
+    with transaction.atomic():
+        products = Product.objects.select_for_update().filter(**{f'{key}__in': updates}).only('id', 'sku', 'reserved', *FIELDS)
+        found = {getattr(product, key): product for product in products}
+        now = timezone.now()
+        groups, changes = {}, []
+        for value, product in found.items():
+            new = dict(updates[value])
+            if on_hand and 'stock' in new:
+                new['stock'] = max(new['stock'] - product.reserved, 0)
+            changed = [field for field in FIELDS if field in new and getattr(product, field) != new[field]]
+            for field in changed:
+                changes.append(InventoryChange(
+                    product_id=product.pk, field=field, old_value=str(getattr(product, field)), new_value=str(new[field]),
+                    on_hand=updates[value]['stock'] if on_hand and field == 'stock' else None,
+                    source=source, user=user, batch=batch_id,
+                ))
+                setattr(product, field, new[field])
+            if changed:
+                product.updated = now
+                groups.setdefault(tuple(changed), []).append(product)
+        for fields, group in groups.items():
+            Product.objects.bulk_update(group, [*fields, 'updated'])
+        InventoryChange.objects.bulk_create(changes)
+
+        changed_ids = [product.pk for group in groups.values() for product in group]
+        price_ids = [product.pk for fields, group in groups.items() if 'price' in fields for product in group]
+        available_ids = [product.pk for fields, group in groups.items() if 'available' in fields for product in group]
+        carts.forget_summaries_for_products(price_ids)
+        search.index_products(available_ids)
+        transaction.on_commit(lambda: invalidate_products(changed_ids))
+        if available_ids:
+            transaction.on_commit(autocomplete.index.request_sync)
+
+    result['rows'] += len(updates)
+    result['changed'] += len(changed_ids)
+    result['changes'] += len(changes)
+    unknown = [value for value in updates if value not in found]
+    result['unknown'] += len(unknown)
+    result['unknown_keys'].extend(unknown[:MAX_ERRORS - len(result['unknown_keys'])])
+
+
+def update_products(updates, key='sku', on_hand=True, source='', user=None, batch_size=BATCH_SIZE):
+    """
+    Apply {sku: {field: value}} (or {id: ...} with key='id'), where each
+    value dict holds any of FIELDS; also takes an iterable of such pairs.
+    Stock values are on-hand counts, or the stock to sell with on_hand=False.
+    Returns the counts: rows, changed products, changed fields and unknown
+    keys (with the first few of them).
+    """
+    result = {'rows': 0, 'changed': 0, 'changes': 0, 'unknown': 0, 'unknown_keys': []}
+    batch_id = uuid.uuid4()
+    items = updates.items() if hasattr(updates, 'items') else updates
+    # A key repeated within a batch takes its last values
+    for batch in _batches(items, batch_size):
+        _apply_batch(batch, key, on_hand, source, user, batch_id, result)
+    result['batch'] = str(batch_id)
+    return result
+
+
+def apply_feed(stream, fmt, source='', user=None, batch_size=BATCH_SIZE):
+    """
+    Apply a CSV/JSONL feed with the columns sku, price, stock (on hand) and
+    available, streamed a batch at a time. Bad rows are skipped and reported.
+    """
+    errors = []
+    error_count = 0
+
+    def updates():
+        nonlocal error_count
+        for line, row in read_rows(stream, fmt):
+            try:
+                yield clean_feed_row(row)
+            except RowError as e:
+                error_count += 1
+                if len(errors) < MAX_ERRORS:
+                    errors.append(f'line {line}: {e}')
+
+    started = time.perf_counter()
+    result = update_products(updates(), 'sku', True, source, user, batch_size)
+    elapsed = time.perf_counter() - started
+    return {
+        **result,
+        'errors': error_count,
+        'error_messages': errors,
+        'seconds': round(elapsed, 2),
+        'rows_per_s': round(result['rows'] / elapsed, 1) if elapsed else 0.0,
+    }
@@ -0,0 +1,43 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gadget_cave.catalog_io import FORMATS, detect_format
+from gadget_cave.inventory_feed import BATCH_SIZE, apply_feed
+
+
+class Command(BaseCommand):
+    help = (
+        "Apply a supplier feed (CSV or JSON Lines with sku, price, stock and available "
+        "columns; blank means unchanged) to the products with those SKUs. stock is the "
+        "on-hand count: units reserved by unpaid orders are taken off it. Only real "
+        "changes are written, in batches, and each is recorded as an InventoryChange."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='The .csv or .jsonl feed.')
+        parser.add_argument('--format', choices=sorted(set(FORMATS.values())), help='Instead of guessing from the extension.')
+        parser.add_argument('--source', help='Recorded with each change (default: the file name).')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='SKUs per transaction.')
+        parser.add_argument('--json', action='store_true', help='Print the result as JSON.')
+
+    def handle(self, *args, **options):
+        source = options['source'] or f"feed:{options['path']}"
+        try:
+            fmt = options['format'] or detect_format(options['path'])
+            with open(options['path'], encoding='utf-8-sig', newline='') as f:
+                result = apply_feed(f, fmt, source[:200], batch_size=options['batch_size'])
+        except (OSError, ValueError) as e:
+            raise CommandError(e)
+        if options['json']:
+            self.stdout.write(json.dumps(result))
+            return
+        for message in result.pop('error_messages'):
+            self.stderr.write(message)
+        if result['unknown_keys']:
+            self.stderr.write(f"Unknown SKUs: {', '.join(result['unknown_keys'])}")
+        self.stdout.write(
+            f"Read {result['rows']} SKUs in {result['seconds']}s ({result['rows_per_s']} rows/s): "
+            f"{result['changed']} products changed ({result['changes']} fields), "
+            f"{result['unknown']} unknown SKUs, {result['errors']} bad rows. Batch {result['batch']}."
+        )
@@ -0,0 +1,49 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from gadget_cave.images import backfill_renditions, get_manifest, queue_renditions
+from gadget_cave.models import Product, ProductImage
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate the resized WebP/JPEG renditions of every product image that "
+        "has no stored manifest yet, using a pool of worker processes (or, with "
+        "--queue, as render_image tasks for `manage.py run_tasks`)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes (1 runs in-process).')
+        parser.add_argument('--force', action='store_true', help='Re-check images that already have a stored manifest.')
+        parser.add_argument('--queue', action='store_true', help='Queue render_image tasks instead of rendering here.')
+
+    def handle(self, *args, **options):
+        names = list(Product.objects.exclude(main_image='').values_list('main_image', flat=True).distinct())
+        names += ProductImage.objects.exclude(image='').values_list('image', flat=True).distinct()
+        if not options['force']:
+            names = [name for name in names if get_manifest(name) is None]
+        if not names:
+            self.stdout.write('All product images already have renditions.')
+            return
+        if options['queue']:
+            queue_renditions(names)
+            self.stdout.write(self.style.SUCCESS(f'Queued renditions of {len(names)} images.'))
+            return
+
+        started = time.perf_counter()
+        done = failed = 0
+        for name, manifest, error in backfill_renditions(names, workers=options['workers']):
+            if manifest is None:
+                failed += 1
+                self.stderr.write(f'{name}: {error}')
+            else:
+                done += 1
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'{name}: {manifest["width"]}x{manifest["height"]}')
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Rendered {done} images ({failed} failed) in {elapsed:.1f}s '
+            f'with {options["workers"]} workers.'
+        ))
@@ -0,0 +1,22 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from gadget_cave.benchmarks import autocomplete_latency
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark the in-memory autocomplete index: build time, memory and p50/p95/p99 lookup latency."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--names', type=int, default=100000)
+        parser.add_argument('--queries', type=int, default=20000)
+        parser.add_argument('--json', action='store_true', help='Print the result as JSON.')
+
+    def handle(self, *args, **options):
+        result = autocomplete_latency(options['names'], options['queries'])
+        if options['json']:
+            self.stdout.write(json.dumps(result))
+        else:
+            for key, value in result.items():
+                self.stdout.write(f'{key:>14}: {value}')
@@ -0,0 +1,45 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gadget_cave.benchmarks import connection_capacity, scratch_database, seed_catalog
+
+
+class Command(BaseCommand):
+    help = (
+        "Hold many concurrent payment-status long polls against a local WSGI server "
+        "(Django's threaded server) and an ASGI server (uvicorn), timing home page "
+        "requests meanwhile, and compare completions, server threads and latency."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--server', choices=['wsgi', 'asgi', 'both'], default='both')
+        parser.add_argument('--connections', type=int, default=200, help='Concurrent long polls.')
+        parser.add_argument('--hold', type=float, default=2.0, help='Seconds each poll waits.')
+        parser.add_argument('--probes', type=int, default=20, help='Home page requests timed while the polls wait.')
+        parser.add_argument('--products', type=int, default=1000)
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+
+    def handle(self, *args, **options):
+        servers = ['wsgi', 'asgi'] if options['server'] == 'both' else [options['server']]
+        results, failed = {}, None
+        for server in servers:
+            with scratch_database():
+                seed_catalog(options['products'], 10)
+                try:
+                    results[server] = connection_capacity(
+                        server, connections=options['connections'], hold=options['hold'], probes=options['probes'],
+                    )
+                except RuntimeError as e:
+                    failed = e
+                    break
+
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+        elif results:
+            keys = list(next(iter(results.values())))
+            self.stdout.write(f"{'':>20}" + ''.join(f'{server:>14}' for server in results))
+            for key in keys[1:]:
+                self.stdout.write(f'{key:>20}' + ''.join(f'{str(result[key]):>14}' for result in results.values()))
+        if failed is not None:
+            raise CommandError(failed)
@@ -0,0 +1,42 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from gadget_cave.benchmarks import STOCK_DATABASE, checkout_workload, database_settings, scratch_database, seed_catalog
+
+
+class Command(BaseCommand):
+    help = (
+        "Run concurrent checkouts alongside catalog reads in a scratch database, first "
+        "with stock Django database settings and then with the configured ones "
+        "(settings.DATABASES: WAL and pragmas, IMMEDIATE transactions, persistent or "
+        "pooled connections), and compare throughput and lock errors."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=10000)
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--writers', type=int, default=4)
+        parser.add_argument('--readers', type=int, default=8)
+        parser.add_argument('--seconds', type=float, default=5.0)
+        parser.add_argument('--processes', action='store_true', help='Use forked processes instead of threads.')
+        parser.add_argument('--json', action='store_true', help='Print the result as JSON.')
+
+    def run(self, options):
+        with scratch_database():
+            seed_catalog(options['products'], options['categories'])
+            return checkout_workload(options['writers'], options['readers'], options['seconds'], processes=options['processes'])
+
+    def handle(self, *args, **options):
+        with database_settings(**STOCK_DATABASE):
+            before = self.run(options)
+        after = self.run(options)
+        if options['json']:
+            self.stdout.write(json.dumps({'before': before, 'after': after}))
+            return
+        self.stdout.write(f"{'':>16}{'stock settings':>18}{'configured':>18}")
+        for key in before:
+            self.stdout.write(f'{key:>16}{str(before[key]):>18}{str(after[key]):>18}' if not isinstance(before[key], dict) else f'{key:>16}')
+            if isinstance(before[key], dict):
+                for pct in before[key]:
+                    self.stdout.write(f'{pct:>16}{before[key][pct]:>18}{after[key][pct]:>18}')
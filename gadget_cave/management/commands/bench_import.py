@@ -0,0 +1,29 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from gadget_cave.benchmarks import catalog_import, scratch_database
+from gadget_cave.catalog_io import CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = (
+        "In a scratch database, import a synthetic CSV catalog with import_catalog, "
+        "re-import and export it, and compare the rate with saving products one at a time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000)
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--row-by-row', type=int, default=2000, help='Products saved one at a time for comparison.')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+        parser.add_argument('--json', action='store_true', help='Print the result as JSON.')
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            result = catalog_import(options['rows'], options['categories'], options['row_by_row'], options['chunk_size'])
+        if options['json']:
+            self.stdout.write(json.dumps(result))
+        else:
+            for key, value in result.items():
+                self.stdout.write(f'{key:>22}: {value}')
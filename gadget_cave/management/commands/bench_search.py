@@ -0,0 +1,31 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from gadget_cave.benchmarks import scratch_database, search_latency, seed_catalog
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a scratch database with a synthetic catalog and measure full-text "
+        "search, typeahead and icontains latency (p50/p95/p99)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100000)
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--json', action='store_true', help='Print the result as JSON.')
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            started = time.perf_counter()
+            seed_catalog(options['products'], options['categories'])
+            seeded = time.perf_counter() - started
+            result = {'seed_s': round(seeded, 2), **search_latency(options['queries'])}
+        if options['json']:
+            self.stdout.write(json.dumps(result))
+        else:
+            for key, value in result.items():
+                self.stdout.write(f'{key:>10}: {value}')
@@ -0,0 +1,42 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gadget_cave.benchmarks import scratch_database, stock_contention
+from gadget_cave.models import Category, Product
+
+
+class Command(BaseCommand):
+    help = (
+        "Hammer one product from many concurrent checkouts in a scratch database "
+        "and verify that stock is never oversold."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--attempts', type=int, default=50, help='Checkouts attempted per worker.')
+        parser.add_argument('--stock', type=int, default=200)
+        parser.add_argument('--quantity', type=int, default=1, help='Units per order.')
+        parser.add_argument('--processes', action='store_true', help='Use forked processes instead of threads.')
+        parser.add_argument('--json', action='store_true', help='Print the result as JSON.')
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            category = Category.objects.create(name='Bench', slug='bench')
+            product = Product.objects.create(
+                category=category, name='Hot SKU', slug='hot-sku', price='999.00', stock=options['stock'],
+            )
+            result = stock_contention(
+                product.id,
+                workers=options['workers'],
+                attempts=options['attempts'],
+                quantity=options['quantity'],
+                processes=options['processes'],
+            )
+        if options['json']:
+            self.stdout.write(json.dumps(result))
+        else:
+            for key, value in result.items():
+                self.stdout.write(f'{key:>14}: {value}')
+        if result['oversold']:
+            raise CommandError('Stock was oversold.')
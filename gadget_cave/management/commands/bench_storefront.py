@@ -0,0 +1,79 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gadget_cave.benchmarks import (
+    PROFILES, compare_to_baseline, scratch_database, seed_catalog, seed_customers, storefront_load,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a scratch database with a synthetic catalog, customers and orders, then "
+        "run concurrent shoppers through browse -> product -> cart -> checkout -> payment "
+        "and report throughput, p50/p95/p99 latency and queries per request. With "
+        "--baseline, exits non-zero on a regression."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profile', choices=sorted(PROFILES), default='small',
+                            help='Catalog size: small (1k products), medium (100k) or large (1M).')
+        for name in ('products', 'categories', 'customers', 'orders'):
+            parser.add_argument(f'--{name}', type=int, help=f'Override the profile\'s number of {name}.')
+        parser.add_argument('--driver', choices=['client', 'wsgi', 'asgi'], default='client',
+                            help='Django test client in-process, or a local WSGI/ASGI (uvicorn) server.')
+        parser.add_argument('--shoppers', type=int, default=8, help='Concurrent virtual shoppers.')
+        parser.add_argument('--flows', type=int, default=10, help='Timed checkout flows per shopper.')
+        parser.add_argument('--baseline', help='Compare against this stored result (JSON).')
+        parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown against the baseline.')
+        parser.add_argument('--save-baseline', help='Write the result to this file.')
+        parser.add_argument('--json', action='store_true', help='Print the result as JSON.')
+
+    def handle(self, *args, **options):
+        sizes = {name: options[name] if options[name] is not None else default
+                 for name, default in PROFILES[options['profile']].items()}
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+        if baseline is not None:
+            current = {'profile': options['profile'], 'driver': options['driver'], 'shoppers': options['shoppers'], **sizes}
+            different = [f'{key}={baseline.get(key)}' for key, value in current.items() if baseline.get(key) != value]
+            if different:
+                raise CommandError(f"The baseline was recorded with {', '.join(different)}; run with the same options.")
+
+        with scratch_database():
+            started = time.perf_counter()
+            seed_catalog(sizes['products'], sizes['categories'])
+            seed_customers(sizes['customers'], sizes['orders'])
+            seeded = time.perf_counter() - started
+            try:
+                result = storefront_load(options['driver'], shoppers=options['shoppers'], flows=options['flows'])
+            except RuntimeError as e:
+                raise CommandError(e)
+        result = {'profile': options['profile'], **sizes, 'seed_s': round(seeded, 2), **result}
+
+        if options['json']:
+            self.stdout.write(json.dumps(result))
+        else:
+            steps = result.pop('steps')
+            for key, value in result.items():
+                self.stdout.write(f'{key:>15}: {value}')
+            self.stdout.write(f"\n{'step':<16}{'requests':>9}{'errors':>7}{'p50_ms':>10}{'p95_ms':>10}{'p99_ms':>10}{'queries':>9}")
+            for name, step in steps.items():
+                self.stdout.write(
+                    f"{name:<16}{step['requests']:>9}{step['errors']:>7}{step['p50_ms']:>10}"
+                    f"{step['p95_ms']:>10}{step['p99_ms']:>10}{str(step['queries']):>9}"
+                )
+            result['steps'] = steps
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump(result, f, indent=2)
+        if baseline is not None:
+            regressions = compare_to_baseline(result, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError('Regressions against the baseline:\n  ' + '\n  '.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline.'))
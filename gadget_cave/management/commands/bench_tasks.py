@@ -0,0 +1,36 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gadget_cave.benchmarks import scratch_database, task_throughput
+
+
+class Command(BaseCommand):
+    help = "Measure background task queue throughput (tasks per second) in a scratch database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tasks', type=int, default=2000)
+        parser.add_argument('--workers', type=int, default=2, help='Competing worker loops.')
+        parser.add_argument('--concurrency', type=int, default=1, help='Threads per worker.')
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--work-ms', type=float, default=0, help='Simulated work per task.')
+        parser.add_argument('--processes', action='store_true', help='Use forked processes instead of threads.')
+        parser.add_argument('--json', action='store_true', help='Print the result as JSON.')
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            result = task_throughput(
+                tasks=options['tasks'],
+                workers=options['workers'],
+                concurrency=options['concurrency'],
+                batch_size=options['batch_size'],
+                work_ms=options['work_ms'],
+                processes=options['processes'],
+            )
+        if options['json']:
+            self.stdout.write(json.dumps(result))
+        else:
+            for key, value in result.items():
+                self.stdout.write(f'{key:>14}: {value}')
+        if result['duplicates'] or result['remaining']:
+            raise CommandError('Some tasks ran twice or never ran.')
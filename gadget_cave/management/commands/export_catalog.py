@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from gadget_cave.catalog_io import CHUNK_SIZE, FORMATS, detect_format, export_catalog
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the catalog as CSV or JSON Lines, streaming the products from the "
+        "database a chunk at a time. The output can be imported again with "
+        "import_catalog --images-dir <MEDIA_ROOT>."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help='Output file (default: standard output).')
+        parser.add_argument('--format', choices=sorted(set(FORMATS.values())), help='Instead of guessing from the extension.')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Products read per query.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        try:
+            fmt = options['format'] or (detect_format(path) if path else 'csv')
+        except ValueError as e:
+            raise CommandError(e)
+        if not path:
+            for text in export_catalog(fmt, chunk_size=options['chunk_size']):
+                self.stdout.write(text, ending='')
+            return
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            f.writelines(export_catalog(fmt, chunk_size=options['chunk_size']))
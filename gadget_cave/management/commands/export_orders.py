@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from gadget_cave.models import Order
+from gadget_cave.order_export import CHUNK_SIZE, KINDS, export_orders, parse_moment
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream orders created in [--since, --until) as CSV or JSON Lines: one row per "
+        "order with SQL-computed totals, or per order line with --kind items."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help='Output file (default: standard output).')
+        parser.add_argument('--kind', choices=KINDS, default='orders')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], default='csv')
+        parser.add_argument('--since', help='Date or datetime (inclusive).')
+        parser.add_argument('--until', help='Date or datetime (exclusive).')
+        parser.add_argument('--status', choices=[value for value, label in Order.STATUS_CHOICES])
+        parser.add_argument('--paid', action='store_true', default=None, help='Only paid orders.')
+        parser.add_argument('--unpaid', action='store_false', dest='paid', help='Only unpaid orders.')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Rows fetched at a time.')
+
+    def handle(self, *args, **options):
+        try:
+            since, until = parse_moment(options['since']), parse_moment(options['until'])
+        except ValueError as e:
+            raise CommandError(e)
+        lines = export_orders(
+            options['format'], options['kind'], since, until, options['status'], options['paid'], options['chunk_size'],
+        )
+        if not options['path']:
+            for text in lines:
+                self.stdout.write(text, ending='')
+            return
+        with open(options['path'], 'w', encoding='utf-8', newline='') as f:
+            f.writelines(lines)
@@ -0,0 +1,38 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gadget_cave.catalog_io import CHUNK_SIZE, FORMATS, detect_format, import_catalog
+
+
+class Command(BaseCommand):
+    help = (
+        "Upsert categories and products from a CSV or JSON Lines file, streamed in "
+        "chunks (one transaction each). Images are read from --images-dir. Re-running "
+        "a file updates the products it already created."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='The .csv or .jsonl file.')
+        parser.add_argument('--format', choices=sorted(set(FORMATS.values())), help='Instead of guessing from the extension.')
+        parser.add_argument('--images-dir', help='Directory the image and images columns are relative to.')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Rows per transaction.')
+        parser.add_argument('--json', action='store_true', help='Print the result as JSON.')
+
+    def handle(self, *args, **options):
+        try:
+            fmt = options['format'] or detect_format(options['path'])
+            with open(options['path'], encoding='utf-8-sig', newline='') as f:
+                result = import_catalog(f, fmt, options['images_dir'], chunk_size=options['chunk_size'])
+        except (OSError, ValueError) as e:
+            raise CommandError(e)
+        if options['json']:
+            self.stdout.write(json.dumps(result))
+            return
+        for message in result.pop('error_messages'):
+            self.stderr.write(message)
+        self.stdout.write(
+            f"Imported {result['rows']} products ({result['created']} new, {result['updated']} updated), "
+            f"{result['categories']} categories and {result['images']} images in {result['seconds']}s "
+            f"({result['rows_per_s']} rows/s); {result['errors']} rows or images skipped."
+        )
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from gadget_cave.inventory import release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = (
+        "Cancel unpaid orders whose stock reservations have expired and return "
+        "the reserved units to stock. Run it from cron every few minutes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Orders released per transaction.')
+
+    def handle(self, *args, **options):
+        orders, units = release_expired_reservations(batch_size=options['batch_size'])
+        self.stdout.write(f'Released {units} units from {orders} expired orders.')
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from gadget_cave.analytics import CHUNK_DAYS, backfill, update_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Bring the daily sales rollups up to date: rebuild the days of orders changed "
+        "since the last run (the first run backfills everything). With --backfill, "
+        "rebuild a date range, --chunk-days per transaction."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backfill', action='store_true', help='Rebuild [--since, --until] (default: all history).')
+        parser.add_argument('--since', help='First day to backfill (YYYY-MM-DD).')
+        parser.add_argument('--until', help='Last day to backfill (YYYY-MM-DD).')
+        parser.add_argument('--chunk-days', type=int, default=CHUNK_DAYS, help='Days rebuilt per transaction.')
+        parser.add_argument('--interval', type=float, default=None, help='Keep updating, this many seconds apart.')
+
+    def handle(self, *args, **options):
+        if options['backfill']:
+            since, until = (parse_date(options[name]) if options[name] else None for name in ('since', 'until'))
+            if (options['since'] and since is None) or (options['until'] and until is None):
+                raise CommandError('--since and --until take YYYY-MM-DD dates.')
+            started = time.perf_counter()
+            days, rows = backfill(
+                since, until, options['chunk_days'],
+                progress=lambda first, last, rows: self.stdout.write(f'{first} to {last}: {rows} rows so far'),
+            )
+            self.stdout.write(f'Rebuilt {days} days ({rows} rollup rows) in {time.perf_counter() - started:.2f}s.')
+            return
+        while True:
+            started = time.perf_counter()
+            days, rows = update_rollups(chunk_days=options['chunk_days'])
+            self.stdout.write(f'Rebuilt {days} days ({rows} rollup rows) in {time.perf_counter() - started:.2f}s.')
+            if options['interval'] is None:
+                return
+            time.sleep(options['interval'])
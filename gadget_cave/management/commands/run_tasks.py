@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from gadget_cave.tasks import run_worker
+
+
+class Command(BaseCommand):
+    help = (
+        "Run background tasks (image processing, ...) from the database queue. "
+        "Start as many of these as you like; each claims its own tasks."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=2, help='Tasks run at the same time by this worker.')
+        parser.add_argument('--batch-size', type=int, default=None, help='Tasks claimed per query (default 10 x concurrency).')
+        parser.add_argument('--once', action='store_true', help='Exit when no task is due instead of polling.')
+        parser.add_argument('--max-tasks', type=int, default=None, help='Exit after running this many tasks.')
+        parser.add_argument('--poll', type=float, default=1.0, help='Seconds to sleep when the queue is empty.')
+
+    def handle(self, *args, **options):
+        counts = run_worker(
+            concurrency=options['concurrency'],
+            batch_size=options['batch_size'],
+            once=options['once'],
+            idle_sleep=options['poll'],
+            max_tasks=options['max_tasks'],
+        )
+        self.stdout.write(', '.join(f'{count} {status}' for status, count in counts.items()))
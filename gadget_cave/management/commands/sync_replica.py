@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gadget_cave.routers import replica_aliases, sync_replicas
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy the default SQLite database onto the SQLite read replicas "
+        "(GADGET_CAVE_REPLICAS), once or every --interval seconds. For trying "
+        "replica routing locally; PostgreSQL replicas use streaming replication."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=None, help='Keep copying, this many seconds apart.')
+        parser.add_argument('--alias', action='append', help='Only this replica alias (repeatable).')
+
+    def handle(self, *args, **options):
+        aliases = options['alias'] or replica_aliases()
+        if not aliases:
+            raise CommandError('No replicas configured; set GADGET_CAVE_REPLICAS.')
+        unknown = set(aliases) - set(replica_aliases())
+        if unknown:
+            raise CommandError(f"Not replica aliases: {', '.join(sorted(unknown))}")
+        while True:
+            started = time.perf_counter()
+            try:
+                sync_replicas(aliases)
+            except ValueError as e:
+                raise CommandError(e)
+            self.stdout.write(f"Copied to {', '.join(aliases)} in {time.perf_counter() - started:.2f}s.")
+            if options['interval'] is None:
+                return
+            time.sleep(options['interval'])
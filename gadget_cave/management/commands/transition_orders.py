@@ -0,0 +1,52 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gadget_cave.models import Order
+from gadget_cave.order_export import parse_moment
+from gadget_cave.order_status import BATCH_SIZE, TRANSITIONS, transition
+
+
+class Command(BaseCommand):
+    help = (
+        "Move orders through the order state machine: the given ids, or the orders "
+        "matching --status/--payment-status/--before. Orders the action isn't allowed "
+        "from are skipped; every move is recorded as an OrderTransition."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=list(TRANSITIONS))
+        parser.add_argument('ids', nargs='*', type=int, help='Order ids.')
+        parser.add_argument('--status', choices=[value for value, label in Order.STATUS_CHOICES])
+        parser.add_argument('--payment-status', choices=[value for value, label in Order.PAYMENT_STATUS_CHOICES])
+        parser.add_argument('--before', help='Only orders created before this date or datetime.')
+        parser.add_argument('--source', default='command', help='Recorded with each transition.')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Orders per transaction.')
+        parser.add_argument('--json', action='store_true', help='Print the result as JSON.')
+
+    def handle(self, *args, **options):
+        if not (options['ids'] or options['status'] or options['payment_status'] or options['before']):
+            raise CommandError('Give order ids or at least one of --status, --payment-status and --before.')
+        orders = Order.objects.all()
+        if options['ids']:
+            orders = orders.filter(id__in=options['ids'])
+        if options['status']:
+            orders = orders.filter(status=options['status'])
+        if options['payment_status']:
+            orders = orders.filter(payment_status=options['payment_status'])
+        try:
+            before = parse_moment(options['before'])
+        except ValueError as e:
+            raise CommandError(e)
+        if before is not None:
+            orders = orders.filter(created__lt=before)
+        result = transition(orders, options['action'], options['source'][:200], batch_size=options['batch_size'])
+        if options['json']:
+            self.stdout.write(json.dumps(result))
+            return
+        if result['skipped_ids']:
+            self.stderr.write(f"Skipped: {', '.join(map(str, result['skipped_ids']))}")
+        self.stdout.write(
+            f"{result['changed']} of {result['orders']} orders moved ({options['action']}) in {result['seconds']}s, "
+            f"{result['skipped']} skipped, {result['units_restocked']} units restocked. Batch {result['batch']}."
+        )
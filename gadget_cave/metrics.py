@@ -0,0 +1,237 @@
+# gadget_cave/metrics.py
+#
+# Per-request instrumentation: SQL count and time (a connection
+# execute_wrapper), template render time (the TimedDjangoTemplates backend)
+# and total latency, recorded per view name by RequestMetricsMiddleware.
+# Each response gets a Server-Timing header, and every request lands in an
+# in-process histogram served in Prometheus text format by views.metrics.
+# The counters are per process: with several workers, scrape each one.
+import bisect
+import contextvars
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.template.backends.django import DjangoTemplates, Template
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised in strict mode (QUERY_BUDGET_STRICT) so a test that hits the view fails."""
+
+
+class RequestMetrics:
+    __slots__ = ('view', 'sql_count', 'sql_time', 'template_time')
+
+    def __init__(self):
+        self.view = None
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+
+
+_current = contextvars.ContextVar('gadget_cave_request_metrics', default=None)
+
+
+def current():
+    """The metrics of the request being handled, or None."""
+    return _current.get()
+
+
+def _record_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.sql_count += 1
+        metrics.sql_time += time.perf_counter() - started
+
+
+# The wrapper stays installed on every connection and only counts while a
+# request's metrics are current. Connections are per thread, and under ASGI
+# queries run in sync_to_async threads; the contextvar follows them there.
+# It goes first in the list because execute_wrapper() blocks pop the last.
+
+def _instrument(conn):
+    if _record_query not in conn.execute_wrappers:
+        conn.execute_wrappers.insert(0, _record_query)
+
+
+@receiver(connection_created)
+def _instrument_new_connection(sender, connection, **kwargs):
+    _instrument(connection)
+
+
+class measure:
+    """Collect RequestMetrics for the block, from every database connection."""
+
+    def __enter__(self):
+        self.metrics = RequestMetrics()
+        self._token = _current.set(self.metrics)
+        for conn in connections.all(initialized_only=True):
+            _instrument(conn)
+        return self.metrics
+
+    def __exit__(self, *exc_info):
+        _current.reset(self._token)
+
+
+# Templates. Only top-level renders go through the backend ({% include %}
+# and {% extends %} don't), so nothing is counted twice. Queries run by
+# lazy querysets while rendering count towards both SQL and template time.
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None:
+            return super().render(context, request)
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.template_time += time.perf_counter() - started
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name).template, self)
+
+
+def server_timing(metrics, total):
+    return (
+        f'sql;dur={metrics.sql_time * 1000:.1f};desc="{metrics.sql_count} queries", '
+        f'tpl;dur={metrics.template_time * 1000:.1f}, '
+        f'total;dur={total * 1000:.1f}'
+    )
+
+
+def query_budget(view):
+    return getattr(settings, 'QUERY_BUDGETS', {}).get(view)
+
+
+class _ViewStats:
+    __slots__ = ('count', 'duration', 'duration_buckets', 'queries', 'query_buckets', 'sql_time', 'template_time', 'over_budget')
+
+    def __init__(self):
+        self.count = 0
+        self.duration = self.sql_time = self.template_time = 0.0
+        self.queries = 0
+        self.duration_buckets = [0] * len(DURATION_BUCKETS)
+        self.query_buckets = [0] * len(QUERY_BUCKETS)
+        self.over_budget = 0
+
+
+class Registry:
+    """Cumulative per-view histograms and counters (Prometheus computes rates from them)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = {}
+
+    def observe(self, view, duration, metrics, over_budget=False):
+        # Each observation lands in one bucket; buckets are made cumulative on export
+        duration_bucket = bisect.bisect_left(DURATION_BUCKETS, duration)
+        query_bucket = bisect.bisect_left(QUERY_BUCKETS, metrics.sql_count)
+        with self._lock:
+            stats = self._views.get(view)
+            if stats is None:
+                stats = self._views[view] = _ViewStats()
+            stats.count += 1
+            stats.duration += duration
+            stats.queries += metrics.sql_count
+            stats.sql_time += metrics.sql_time
+            stats.template_time += metrics.template_time
+            stats.over_budget += over_budget
+            if duration_bucket < len(DURATION_BUCKETS):
+                stats.duration_buckets[duration_bucket] += 1
+            if query_bucket < len(QUERY_BUCKETS):
+                stats.query_buckets[query_bucket] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                view: {
+                    'requests': stats.count,
+                    'queries': stats.queries,
+                    'sql_seconds': stats.sql_time,
+                    'template_seconds': stats.template_time,
+                    'duration_seconds': stats.duration,
+                    'over_budget': stats.over_budget,
+                    'duration_buckets': list(stats.duration_buckets),
+                    'query_buckets': list(stats.query_buckets),
+                }
+                for view, stats in self._views.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._views.clear()
+
+    def prometheus(self):
+        """The registry in the Prometheus text exposition format (version 0.0.4)."""
+        views = sorted(self.snapshot().items())
+        lines = []
+
+        def histogram(name, help_text, buckets, key, sum_key, total_key='requests'):
+            lines.extend([f'# HELP {name} {help_text}', f'# TYPE {name} histogram'])
+            for view, stats in views:
+                label = _label(view)
+                cumulative = 0
+                for bound, count in zip(buckets, stats[key]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{view="{label}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{view="{label}",le="+Inf"}} {stats[total_key]}')
+                lines.append(f'{name}_sum{{view="{label}"}} {stats[sum_key]}')
+                lines.append(f'{name}_count{{view="{label}"}} {stats[total_key]}')
+
+        def counter(name, help_text, key):
+            lines.extend([f'# HELP {name} {help_text}', f'# TYPE {name} counter'])
+            lines.extend(f'{name}{{view="{_label(view)}"}} {stats[key]}' for view, stats in views)
+
+        histogram('gadget_cave_request_duration_seconds', 'Request latency by view.',
+                  DURATION_BUCKETS, 'duration_buckets', 'duration_seconds')
+        histogram('gadget_cave_request_queries', 'SQL queries per request by view.',
+                  QUERY_BUCKETS, 'query_buckets', 'queries')
+        counter('gadget_cave_request_sql_seconds_total', 'Time spent in SQL by view.', 'sql_seconds')
+        counter('gadget_cave_request_template_seconds_total', 'Time spent rendering templates by view.', 'template_seconds')
+        counter('gadget_cave_query_budget_exceeded_total', 'Requests over the view\'s QUERY_BUDGETS entry.', 'over_budget')
+        return '\n'.join(lines) + '\n'
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = Registry()
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else '<unresolved>'
+
+
+def record(request, metrics, total):
+    """Add a finished request to the registry; enforce its view's query budget."""
+    view = metrics.view or view_name(request)
+    budget = query_budget(view)
+    over_budget = budget is not None and metrics.sql_count > budget
+    registry.observe(view, total, metrics, over_budget)
+    if over_budget:
+        message = f'{view} ran {metrics.sql_count} queries (budget {budget}) for {request.method} {request.path}'
+        if getattr(settings, 'QUERY_BUDGET_STRICT', False):
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
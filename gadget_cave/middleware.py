@@ -0,0 +1,107 @@
+# gadget_cave/middleware.py
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from . import metrics, routers
+from .guest_cart import GuestCart
+
+
+class _AsyncCapable:
+    # Runs in the event loop under ASGI (no thread hop before async views),
+    # in the request thread under WSGI
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+
+class RequestMetricsMiddleware(_AsyncCapable):
+    """
+    Record SQL count/time, template time and latency per view (see
+    gadget_cave/metrics.py) and report them in a Server-Timing header.
+    Goes first in MIDDLEWARE so the other middleware is timed too.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.server_timing = getattr(settings, 'METRICS_SERVER_TIMING', True)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        with metrics.measure() as measured:
+            response = self.get_response(request)
+        return self._finish(request, response, measured, started)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        with metrics.measure() as measured:
+            response = await self.get_response(request)
+        return self._finish(request, response, measured, started)
+
+    def _finish(self, request, response, measured, started):
+        total = time.perf_counter() - started
+        if self.server_timing:
+            response['Server-Timing'] = metrics.server_timing(measured, total)
+        metrics.record(request, measured, total)
+        return response
+
+
+class AnonymousCartMiddleware(_AsyncCapable):
+    """
+    Attach the signed-cookie guest cart as request.guest_cart and write the
+    cookie back only when the cart changed. No database access.
+    """
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        request.guest_cart = GuestCart.from_request(request)
+        response = self.get_response(request)
+        request.guest_cart.save(response)
+        return response
+
+    async def __acall__(self, request):
+        request.guest_cart = GuestCart.from_request(request)
+        response = await self.get_response(request)
+        request.guest_cart.save(response)
+        return response
+
+
+class ReplicaStickinessMiddleware(_AsyncCapable):
+    """
+    After a request that writes (or any POST), keep the visitor's reads on
+    the primary for REPLICA_STICKY_SECONDS, so they see their own changes
+    despite replica lag. Goes before SessionMiddleware to see session saves.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.sticky_seconds = getattr(settings, 'REPLICA_STICKY_SECONDS', 15)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not routers.replica_aliases():
+            return self.get_response(request)
+        with routers.track_writes() as wrote:
+            response = self.get_response(request)
+        return self._finish(request, response, wrote)
+
+    async def __acall__(self, request):
+        if not routers.replica_aliases():
+            return await self.get_response(request)
+        with routers.track_writes() as wrote:
+            response = await self.get_response(request)
+        return self._finish(request, response, wrote)
+
+    def _finish(self, request, response, wrote):
+        if wrote or request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            response.set_cookie(routers.STICKY_COOKIE, '1', max_age=self.sticky_seconds, httponly=True, samesite='Lax')
+        return response
@@ -0,0 +1,60 @@
+# Full-text index for gadget_cave/search.py. The index tables live outside
+# Django's models: an FTS5 virtual table on SQLite, a tsvector table with a
+# GIN index on PostgreSQL. Other databases get nothing (search falls back to
+# icontains).
+
+from django.db import migrations
+
+SQLITE_CREATE = [
+    """
+    CREATE VIRTUAL TABLE gadget_cave_product_fts USING fts5(
+        name, description, category_id UNINDEXED, available UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3 4'
+    )
+    """,
+    """
+    INSERT INTO gadget_cave_product_fts (rowid, name, description, category_id, available)
+    SELECT id, name, description, category_id, available FROM gadget_cave_product
+    """,
+]
+SQLITE_DROP = ['DROP TABLE IF EXISTS gadget_cave_product_fts']
+
+POSTGRES_CREATE = [
+    """
+    CREATE TABLE gadget_cave_product_search (
+        product_id bigint PRIMARY KEY REFERENCES gadget_cave_product (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        category_id bigint NOT NULL,
+        available boolean NOT NULL,
+        document tsvector NOT NULL
+    )
+    """,
+    'CREATE INDEX gadget_cave_product_search_document ON gadget_cave_product_search USING GIN (document)',
+    """
+    INSERT INTO gadget_cave_product_search (product_id, category_id, available, document)
+    SELECT id, category_id, available,
+           setweight(to_tsvector('simple', name), 'A') || setweight(to_tsvector('simple', coalesce(description, '')), 'B')
+    FROM gadget_cave_product
+    """,
+]
+POSTGRES_DROP = ['DROP TABLE IF EXISTS gadget_cave_product_search']
+
+
+def _run(statements):
+    def run(apps, schema_editor):
+        for sql in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gadget_cave', '0004_tasks'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            _run({'sqlite': SQLITE_CREATE, 'postgresql': POSTGRES_CREATE}),
+            _run({'sqlite': SQLITE_DROP, 'postgresql': POSTGRES_DROP}),
+        ),
+    ]
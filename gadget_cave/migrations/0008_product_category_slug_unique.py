@@ -0,0 +1,33 @@
+# Generated by Django 5.2.4 on 2026-10-18 03:08
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def rename_duplicate_slugs(apps, schema_editor):
+    # Products can share a slug within a category today; the first keeps
+    # it and the others get their id appended (their URLs carry the id too).
+    Product = apps.get_model('gadget_cave', 'Product')
+    duplicates = (
+        Product.objects.values('category', 'slug')
+        .annotate(products=Count('id'), keep=Min('id'))
+        .filter(products__gt=1)
+    )
+    for row in duplicates:
+        for product in Product.objects.filter(category=row['category'], slug=row['slug']).exclude(id=row['keep']):
+            Product.objects.filter(id=product.id).update(slug=f"{product.slug[:180]}-{product.id}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gadget_cave', '0007_order_user_created_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_duplicate_slugs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='product',
+            constraint=models.UniqueConstraint(fields=('category', 'slug'), name='product_category_slug_unique'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.4 on 2026-10-18 03:12
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gadget_cave', '0008_product_category_slug_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='sku',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True, verbose_name='SKU'),
+        ),
+        migrations.CreateModel(
+            name='InventoryChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(choices=[('price', 'Price'), ('stock', 'Stock'), ('available', 'Available')], max_length=20)),
+                ('old_value', models.CharField(max_length=64)),
+                ('new_value', models.CharField(max_length=64)),
+                ('source', models.CharField(blank=True, max_length=200)),
+                ('batch', models.UUIDField(db_index=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inventory_changes', to='gadget_cave.product')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ('-created', '-id'),
+                'indexes': [models.Index(fields=['product', '-created'], name='inventorychange_product_idx')],
+            },
+        ),
+    ]
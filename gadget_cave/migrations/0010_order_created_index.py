@@ -0,0 +1,17 @@
+# Generated by Django 5.2.4 on 2026-10-18 03:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gadget_cave', '0009_inventory_feed'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['created', 'id'], name='order_created_idx'),
+        ),
+    ]
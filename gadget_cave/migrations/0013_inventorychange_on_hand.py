@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 03:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gadget_cave', '0012_order_transitions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inventorychange',
+            name='on_hand',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
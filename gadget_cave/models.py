@@ -1,8 +1,13 @@
 # gadget_cave/models.py
 
+from decimal import Decimal
+
 from django.db import models
+from django.db.models import F, Sum, Value
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import AbstractUser, Group, Permission
 from django.urls import reverse # Import reverse here as it's used in get_absolute_url
+from django.utils import timezone
 
 
 class CustomUser(AbstractUser):
@@ -56,11 +61,14 @@ class Product(models.Model):
     category = models.ForeignKey(Category, related_name='products', on_delete=models.CASCADE)
     name = models.CharField(max_length=200, db_index=True)
     slug = models.SlugField(max_length=200, db_index=True)
+    # The supplier's stock-keeping unit; inventory feeds match products on it
+    sku = models.CharField('SKU', max_length=64, unique=True, null=True, blank=True)
     # Direct main_image field on Product model as per your current code
     main_image = models.ImageField(upload_to='products/%Y/%m/%d', blank=True, null=True)
     description = models.TextField(blank=True)
     price = models.DecimalField(max_digits=10, decimal_places=2)
-    stock = models.PositiveIntegerField()
+    stock = models.PositiveIntegerField() # Available to sell; units held by unpaid orders are in 'reserved'
+    reserved = models.PositiveIntegerField(default=0, editable=False)
     available = models.BooleanField(default=True)
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
@@ -70,6 +78,17 @@ class Product(models.Model):
         # Use 'indexes' instead of 'index_together' for Django 4.0+
         indexes = [
             models.Index(fields=['id', 'slug']),
+            # Keyset pagination for the catalog (see gadget_cave/catalog.py)
+            models.Index(fields=['available', 'category', 'name', 'id'], name='product_cat_name_idx'),
+            models.Index(fields=['available', 'category', 'price', 'id'], name='product_cat_price_idx'),
+            models.Index(fields=['available', 'category', 'created', 'id'], name='product_cat_created_idx'),
+            models.Index(fields=['available', 'name', 'id'], name='product_name_idx'),
+            models.Index(fields=['available', 'price', 'id'], name='product_price_idx'),
+            models.Index(fields=['available', 'created', 'id'], name='product_created_idx'),
+        ]
+        constraints = [
+            # Catalog imports upsert on this (see gadget_cave/catalog_io.py)
+            models.UniqueConstraint(fields=['category', 'slug'], name='product_category_slug_unique'),
         ]
 
     def __str__(self):
@@ -90,15 +109,47 @@ class ProductImage(models.Model):
         return f"Image for {self.product.name}"
 
 
+class GroupConcat(models.Aggregate):
+    # GROUP_CONCAT on SQLite, STRING_AGG on PostgreSQL
+    function = 'GROUP_CONCAT'
+    output_field = models.TextField()
+
+    def __init__(self, expression, delimiter=', ', **extra):
+        super().__init__(expression, Value(delimiter), **extra)
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, function='STRING_AGG', **extra_context)
+
+
+def _totals(price):
+    """Annotations shared by Cart and Order: totals, item counts and product names, all in SQL."""
+    money = models.DecimalField(max_digits=12, decimal_places=2)
+    return {
+        'total_cost': Coalesce(Sum(price * F('items__quantity'), output_field=money), Value(Decimal('0.00')), output_field=money),
+        'item_count': Coalesce(Sum('items__quantity'), 0),
+        'product_names': Coalesce(GroupConcat('items__product__name'), Value(''), output_field=models.TextField()),
+    }
+
+
+class CartQuerySet(models.QuerySet):
+    def with_totals(self):
+        return self.annotate(**_totals(F('items__product__price')))
+
+
 class Cart(models.Model):
     user = models.OneToOneField(CustomUser, on_delete=models.CASCADE, related_name='cart')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = CartQuerySet.as_manager()
+
     def __str__(self):
         return f"Cart of {self.user.username}"
 
     def get_total_cost(self):
+        # Cart.objects.with_totals() computes this in the same query that loads the cart
+        if hasattr(self, 'total_cost'):
+            return self.total_cost
         return sum(item.get_cost() for item in self.items.all())
 
 
@@ -107,6 +158,12 @@ class CartItem(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
 
+    class Meta:
+        constraints = [
+            # One line per product; merging a guest cart upserts on this
+            models.UniqueConstraint(fields=['cart', 'product'], name='cartitem_cart_product_unique'),
+        ]
+
     def __str__(self):
         return f"{self.quantity} x {self.product.name} in {self.cart.user.username}'s cart"
 
@@ -114,6 +171,11 @@ class CartItem(models.Model):
         return self.product.price * self.quantity
 
 
+class OrderQuerySet(models.QuerySet):
+    def with_totals(self):
+        return self.annotate(**_totals(F('items__price')))
+
+
 class Order(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='orders', null=True, blank=True,) # Changed to null=True, blank=True for guest orders
     created = models.DateTimeField(auto_now_add=True)
@@ -156,15 +218,32 @@ class Order(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     payment_status = models.CharField(max_length=20, choices=PAYMENT_STATUS_CHOICES, default='pending')
 
+    objects = OrderQuerySet.as_manager()
+
     class Meta:
         ordering = ('-created',)
+        indexes = [
+            # Pending-payment scans, e.g. the reservation reaper
+            models.Index(fields=['payment_status', 'created'], name='order_payment_created_idx'),
+            # A customer's order history, newest first (see orders.history_page)
+            models.Index(fields=['user', '-created', '-id'], name='order_user_created_idx'),
+            # Date-range exports in created order (see gadget_cave/order_export.py)
+            models.Index(fields=['created', 'id'], name='order_created_idx'),
+            # The sales rollup job's watermark scan (see gadget_cave/analytics.py)
+            models.Index(fields=['updated'], name='order_updated_idx'),
+        ]
 
     def __str__(self):
         return f'Order {self.id}'
 
+    # Both read the Order.objects.with_totals() annotations when present
     def get_total_cost(self):
+        if hasattr(self, 'total_cost'):
+            return self.total_cost
         return sum(item.get_cost() for item in self.items.all())
     def get_product_names(self):
+        if hasattr(self, 'product_names'):
+            return self.product_names
         return ", ".join([item.product.name for item in self.items.all()])
     get_product_names.short_description = "Products"
 
@@ -179,4 +258,164 @@ class OrderItem(models.Model):
         return str(self.id)
 
     def get_cost(self):
-        return self.price * self.quantity
\ No newline at end of file
+        return self.price * self.quantity
+
+
+# Stock held for an unpaid order. The units have already moved from
+# Product.stock to Product.reserved; payment turns them into a sale and the
+# reap_reservations command gives them back once expires_at has passed.
+class StockReservation(models.Model):
+    order = models.ForeignKey(Order, related_name='reservations', on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, related_name='reservations', on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} for order {self.order_id}"
+
+
+# A unit of background work for `manage.py run_tasks` (see gadget_cave/tasks.py).
+# `key` makes enqueueing idempotent; a running task holds a lease
+# (locked_by/locked_until) that another worker may take over once it lapses.
+class Task(models.Model):
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    name = models.CharField(max_length=100)
+    key = models.CharField(max_length=255, unique=True)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ('run_after', 'id')
+        indexes = [
+            # The worker's claim query: due tasks in run_after order
+            models.Index(fields=['status', 'run_after'], name='task_status_run_after_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.name} ({self.key})'
+
+
+# One field of one product changed by a bulk inventory update: a supplier
+# feed or a list_editable save in the admin (see gadget_cave/inventory_feed.py).
+# Rows written by the same update share a `batch`.
+class InventoryChange(models.Model):
+    FIELD_CHOICES = [
+        ('price', 'Price'),
+        ('stock', 'Stock'),
+        ('available', 'Available'),
+    ]
+
+    product = models.ForeignKey(Product, related_name='inventory_changes', on_delete=models.CASCADE)
+    field = models.CharField(max_length=20, choices=FIELD_CHOICES)
+    old_value = models.CharField(max_length=64)
+    new_value = models.CharField(max_length=64)
+    # For stock set from a supplier's on-hand count: that count. new_value is
+    # what was left to sell once the units reserved by unpaid orders were taken off.
+    on_hand = models.PositiveIntegerField(null=True, blank=True)
+    source = models.CharField(max_length=200, blank=True)
+    user = models.ForeignKey(CustomUser, null=True, blank=True, on_delete=models.SET_NULL)
+    batch = models.UUIDField(db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('-created', '-id')
+        indexes = [
+            models.Index(fields=['product', '-created'], name='inventorychange_product_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.product_id} {self.field}: {self.old_value} -> {self.new_value}'
+
+
+# One order's move through the state machine in gadget_cave/order_status.py;
+# append-only, written a batch at a time alongside the orders' UPDATE.
+class OrderTransition(models.Model):
+    order = models.ForeignKey(Order, related_name='transitions', on_delete=models.CASCADE)
+    action = models.CharField(max_length=20)
+    from_status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    to_status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    from_payment_status = models.CharField(max_length=20, choices=Order.PAYMENT_STATUS_CHOICES)
+    to_payment_status = models.CharField(max_length=20, choices=Order.PAYMENT_STATUS_CHOICES)
+    source = models.CharField(max_length=200, blank=True)
+    user = models.ForeignKey(CustomUser, null=True, blank=True, on_delete=models.SET_NULL)
+    batch = models.UUIDField(db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('-created', '-id')
+        indexes = [
+            models.Index(fields=['order', '-created'], name='ordertransition_order_idx'),
+        ]
+
+    def __str__(self):
+        return f'Order {self.order_id} {self.action}: {self.from_status}/{self.from_payment_status} -> {self.to_status}/{self.to_payment_status}'
+
+
+# Daily sales rollups, rebuilt a day at a time from Order/OrderItem by
+# `manage.py rollup_sales` (see gadget_cave/analytics.py), per status,
+# payment_status and paid. DailySales counts each order once however many
+# lines it has; ProductSales breaks the same sales down by product (and the
+# product's category when rolled up).
+class DailySales(models.Model):
+    day = models.DateField()
+    status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    payment_status = models.CharField(max_length=20, choices=Order.PAYMENT_STATUS_CHOICES)
+    paid = models.BooleanField()
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+
+    class Meta:
+        ordering = ('-day',)
+        verbose_name_plural = 'daily sales'
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'status', 'payment_status', 'paid'], name='dailysales_day_status_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.day} {self.status}/{self.payment_status}{" (paid)" if self.paid else ""}'
+
+
+class ProductSales(models.Model):
+    day = models.DateField()
+    product = models.ForeignKey(Product, related_name='+', on_delete=models.CASCADE)
+    category = models.ForeignKey(Category, related_name='+', on_delete=models.CASCADE)
+    status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    payment_status = models.CharField(max_length=20, choices=Order.PAYMENT_STATUS_CHOICES)
+    paid = models.BooleanField()
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+
+    class Meta:
+        ordering = ('-day',)
+        verbose_name_plural = 'product sales'
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'product', 'status', 'payment_status', 'paid'], name='productsales_day_product_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.day} {self.product_id} {self.status}/{self.payment_status}{" (paid)" if self.paid else ""}'
+
+
+# How far an incremental job has read a table, e.g. Order.updated for the sales rollups
+class RollupWatermark(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    value = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.name}: {self.value}'
@@ -0,0 +1,121 @@
+# gadget_cave/order_export.py
+#
+# Order data for finance, as CSV or JSON Lines: one row per order (totals,
+# item counts and product names computed in SQL, see Order.with_totals) or
+# one row per order line. Rows come straight from values_list() through
+# iterator(), a server-side cursor on PostgreSQL and fetchmany() chunks on
+# SQLite, in (created, id) order on order_created_idx; memory stays the
+# same whether the range holds a day of orders or a year.
+import csv
+import json
+from datetime import datetime, time as dt_time
+from decimal import Decimal
+
+from django.db.models import DecimalField, ExpressionWrapper, F
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .catalog_io import Echo
+from .models import Order, OrderItem
+
+CHUNK_SIZE = 2000
+KINDS = ('orders', 'items')
+ORDER_COLUMNS = {
+    # column: field or annotation
+    'id': 'id',
+    'created': 'created',
+    'customer': 'user__username',
+    'first_name': 'first_name',
+    'last_name': 'last_name',
+    'email': 'email',
+    'phone': 'phone',
+    'city': 'city',
+    'state': 'state',
+    'postal_code': 'postal_code',
+    'status': 'status',
+    'paid': 'paid',
+    'payment_status': 'payment_status',
+    'transaction_id': 'transaction_id',
+    'item_count': 'item_count',
+    'total_cost': 'total_cost',
+    'products': 'product_names',
+}
+ITEM_COLUMNS = {
+    'order_id': 'order_id',
+    'created': 'order__created',
+    'status': 'order__status',
+    'paid': 'order__paid',
+    'product_id': 'product_id',
+    'sku': 'product__sku',
+    'product': 'product__name',
+    'price': 'price',
+    'quantity': 'quantity',
+    'line_total': 'line_total',
+}
+
+
+def parse_moment(value):
+    """A datetime from an ISO date or datetime string (dates mean midnight, local time), or None."""
+    if not value:
+        return None
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f'{value!r} is not a date or a datetime.')
+        moment = datetime.combine(day, dt_time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def _orders(since, until, status, paid):
+    orders = Order.objects.all()
+    if since is not None:
+        orders = orders.filter(created__gte=since)
+    if until is not None:
+        orders = orders.filter(created__lt=until)
+    if status:
+        orders = orders.filter(status=status)
+    if paid is not None:
+        orders = orders.filter(paid=paid)
+    return orders
+
+
+def rows(kind='orders', since=None, until=None, status=None, paid=None):
+    """(columns, values_list queryset) for orders created in [since, until)."""
+    orders = _orders(since, until, status, paid)
+    if kind == 'orders':
+        columns = ORDER_COLUMNS
+        queryset = orders.with_totals().order_by('created', 'id')
+    else:
+        columns = ITEM_COLUMNS
+        money = DecimalField(max_digits=12, decimal_places=2)
+        queryset = (
+            OrderItem.objects.filter(order__in=orders.values('id'))
+            .annotate(line_total=ExpressionWrapper(F('price') * F('quantity'), output_field=money))
+            .order_by('order__created', 'order_id', 'id')
+        )
+    return list(columns), queryset.values_list(*columns.values())
+
+
+def _value(value):
+    if isinstance(value, Decimal):
+        return f'{value:.2f}'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def export_orders(fmt, kind='orders', since=None, until=None, status=None, paid=None, chunk_size=CHUNK_SIZE):
+    """Yield the orders (or order lines) as CSV/JSONL text, a row at a time."""
+    columns, queryset = rows(kind, since, until, status, paid)
+    writer = csv.writer(Echo())
+    if fmt == 'csv':
+        yield writer.writerow(columns)
+    for row in queryset.iterator(chunk_size=chunk_size):
+        values = [_value(value) for value in row]
+        if fmt == 'csv':
+            yield writer.writerow(['' if value is None else value for value in values])
+        else:
+            yield json.dumps(dict(zip(columns, values))) + '\n'
@@ -0,0 +1,111 @@
+# gadget_cave/order_status.py
+#
+# The order state machine: the allowed moves between Order.STATUS_CHOICES
+# and PAYMENT_STATUS_CHOICES, applied to many orders at once (admin actions,
+# `manage.py transition_orders`).
+#
+# Each batch locks the orders the move is allowed from and reads their
+# current state in one SELECT, moves them all with one UPDATE (setting
+# `updated`, which the sales rollups follow), runs the move's stock side
+# effect once for the batch and appends one OrderTransition per order with
+# bulk_create. Orders the move isn't allowed from are left alone and
+# reported as skipped.
+import itertools
+import time
+import uuid
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .catalog_io import MAX_ERRORS
+from .inventory import commit_order_reservations, restock_orders
+from .models import Order, OrderTransition
+
+BATCH_SIZE = 500
+# action: (the states it's allowed from, the fields it sets)
+TRANSITIONS = {
+    'process': (Q(status='pending'), {'status': 'processing'}),
+    'ship': (Q(status__in=('pending', 'processing'), paid=True), {'status': 'shipped'}),
+    'deliver': (Q(status='shipped'), {'status': 'delivered'}),
+    'cancel': (Q(status__in=('pending', 'processing')), {'status': 'cancelled'}),
+    'mark_paid': (~Q(status='cancelled') & Q(payment_status__in=('pending', 'failed')), {'paid': True, 'payment_status': 'completed'}),
+    'refund': (Q(paid=True) & ~Q(payment_status='refunded'), {'payment_status': 'refunded'}),
+}
+
+
+def allowed(action):
+    """The orders `action` may move, as a Q."""
+    return TRANSITIONS[action][0]
+
+
+def _batches(ids, size):
+    # A list or iterable of ids: dropping the ones already seen
+    seen = set()
+    ids = iter(ids)
+    while chunk := list(itertools.islice(ids, size)):
+        batch = [order_id for order_id in dict.fromkeys(chunk) if order_id not in seen]
+        seen.update(batch)
+        if batch:
+            yield batch
+
+
+def _queryset_batches(queryset, size):
+    # Keyset over id, one query per batch: no id list in memory, and orders
+    # earlier batches moved out of the queryset don't shift the rest
+    ids = queryset.order_by('id').values_list('id', flat=True).distinct()
+    last = 0
+    while batch := list(ids.filter(id__gt=last)[:size]):
+        yield batch
+        last = batch[-1]
+
+
+def _apply_batch(order_ids, action, source, user, batch_id, result):
+    when, fields = TRANSITIONS[action]
+    with transaction.atomic():
+        orders = Order.objects.filter(when, id__in=order_ids).order_by('id')
+        if connection.features.has_select_for_update:
+            orders = orders.select_for_update()
+        rows = list(orders.values_list('id', 'status', 'payment_status'))
+        ids = [row[0] for row in rows]
+        if ids:
+            Order.objects.filter(id__in=ids).update(**fields, updated=timezone.now())
+            if action == 'cancel':
+                result['units_restocked'] += restock_orders(ids)
+            elif action == 'mark_paid':
+                commit_order_reservations(ids)
+            OrderTransition.objects.bulk_create([
+                OrderTransition(
+                    order_id=order_id, action=action,
+                    from_status=status, to_status=fields.get('status', status),
+                    from_payment_status=payment_status, to_payment_status=fields.get('payment_status', payment_status),
+                    source=source, user=user, batch=batch_id,
+                )
+                for order_id, status, payment_status in rows
+            ])
+    result['orders'] += len(order_ids)
+    result['changed'] += len(ids)
+    moved = set(ids)
+    skipped = [order_id for order_id in order_ids if order_id not in moved]
+    result['skipped'] += len(skipped)
+    result['skipped_ids'].extend(skipped[:MAX_ERRORS - len(result['skipped_ids'])])
+
+
+def transition(orders, action, source='', user=None, batch_size=BATCH_SIZE):
+    """
+    Apply `action` (a key of TRANSITIONS) to an Order queryset or an
+    iterable of order ids, batch_size orders per transaction. Returns the
+    counts: orders, changed, skipped (with the first few skipped ids) and
+    units_restocked by cancellations.
+    """
+    if action not in TRANSITIONS:
+        raise ValueError(f'Unknown order action {action!r}; expected one of {", ".join(TRANSITIONS)}.')
+    batches = _queryset_batches(orders, batch_size) if hasattr(orders, 'values_list') else _batches(orders, batch_size)
+    result = {'orders': 0, 'changed': 0, 'skipped': 0, 'skipped_ids': [], 'units_restocked': 0}
+    batch_id = uuid.uuid4()
+    started = time.perf_counter()
+    for batch in batches:
+        _apply_batch(batch, action, source, user, batch_id, result)
+    result['batch'] = str(batch_id)
+    result['seconds'] = round(time.perf_counter() - started, 2)
+    return result
@@ -0,0 +1,63 @@
+# gadget_cave/orders.py
+#
+# A customer's order history, a page at a time: the orders with their
+# totals annotated in SQL (one query, an index range scan on
+# order_user_created_idx) and all their lines and products prefetched in a
+# second one, whatever the page size.
+from django.db.models import Prefetch
+
+from .models import Order, OrderItem
+from .pagination import KeysetPaginator
+
+HISTORY_PAGE_SIZE = 10
+HISTORY_ORDERING = ('-created', '-id')
+# What the order card shows of each line's product
+ITEM_FIELDS = ('order', 'price', 'quantity', 'product', 'product__name', 'product__slug')
+
+
+def _paginator(user, per_page):
+    orders = (
+        Order.objects.with_totals()
+        .filter(user=user)
+        .prefetch_related(Prefetch('items', queryset=OrderItem.objects.select_related('product').only(*ITEM_FIELDS).order_by('id')))
+    )
+    return KeysetPaginator(orders, HISTORY_ORDERING, per_page=per_page)
+
+
+def history_page(user, cursor=None, per_page=HISTORY_PAGE_SIZE):
+    return _paginator(user, per_page).page(cursor)
+
+
+async def ahistory_page(user, cursor=None, per_page=HISTORY_PAGE_SIZE):
+    return await _paginator(user, per_page).apage(cursor)
+
+
+def order_json(order):
+    return {
+        'id': order.id,
+        'created': order.created.isoformat(),
+        'paid': order.paid,
+        'status': order.status,
+        'status_display': order.get_status_display(),
+        'total_cost': f'{order.get_total_cost():.2f}',
+        'transaction_id': order.transaction_id,
+        'shipping': {
+            'name': f'{order.first_name} {order.last_name}',
+            'address': order.address,
+            'city': order.city,
+            'postal_code': order.postal_code,
+            'email': order.email,
+            'phone': order.phone,
+        },
+        'items': [
+            {
+                'product': item.product.id,
+                'name': item.product.name,
+                'url': item.product.get_absolute_url(),
+                'price': str(item.price),
+                'quantity': item.quantity,
+                'cost': str(item.get_cost()),
+            }
+            for item in order.items.all()
+        ],
+    }
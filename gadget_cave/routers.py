@@ -0,0 +1,133 @@
+# gadget_cave/routers.py
+#
+# Read replicas (settings.DATABASE_REPLICAS) for the read-only storefront
+# pages. Only views wrapped in @replica_reads read from a replica, and only
+# for the catalog and order models; sessions, users and carts always come
+# from the primary, and every write goes to the primary (the admin too).
+#
+# A replica lags behind the primary, so a visitor who just wrote something
+# (placed an order, logged in, changed their cart) would not see it there.
+# ReplicaStickinessMiddleware notices writes and sets a short-lived cookie;
+# while it is present the visitor's reads stay on the primary.
+import contextvars
+import functools
+import random
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+STICKY_COOKIE = 'gadget_cave_primary'
+REPLICA_MODELS = {
+    'gadget_cave.category', 'gadget_cave.product', 'gadget_cave.productimage',
+    'gadget_cave.order', 'gadget_cave.orderitem',
+}
+
+_replica_reads = contextvars.ContextVar('gadget_cave_replica_reads', default=False)
+# A one-item list per request, set to True by the first write
+_wrote = contextvars.ContextVar('gadget_cave_wrote', default=None)
+
+
+def replica_aliases():
+    return list(getattr(settings, 'DATABASE_REPLICAS', ()))
+
+
+def is_sticky(request):
+    return STICKY_COOKIE in request.COOKIES
+
+
+class use_replicas:
+    """Send the block's catalog and order reads to a replica (when there is one)."""
+
+    def __enter__(self):
+        self._token = _replica_reads.set(True)
+
+    def __exit__(self, *exc_info):
+        _replica_reads.reset(self._token)
+
+
+def replica_reads(view):
+    """Serve a read-only view (sync or async) from a replica, unless the visitor has just written."""
+    if iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def awrapped(request, *args, **kwargs):
+            if is_sticky(request) or not replica_aliases():
+                return await view(request, *args, **kwargs)
+            # The async ORM runs queries in a thread with a copy of this context
+            with use_replicas():
+                return await view(request, *args, **kwargs)
+        return awrapped
+
+    @functools.wraps(view)
+    def wrapped(request, *args, **kwargs):
+        if is_sticky(request) or not replica_aliases():
+            return view(request, *args, **kwargs)
+        with use_replicas():
+            return view(request, *args, **kwargs)
+    return wrapped
+
+
+class track_writes:
+    """Note whether the block wrote to the database (through the ORM or a session save)."""
+
+    def __enter__(self):
+        self.wrote = [False]
+        self._token = _wrote.set(self.wrote)
+        return self
+
+    def __exit__(self, *exc_info):
+        _wrote.reset(self._token)
+
+    def __bool__(self):
+        return self.wrote[0]
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _replica_reads.get() and model._meta.label_lower in REPLICA_MODELS:
+            replicas = replica_aliases()
+            if replicas:
+                return random.choice(replicas)
+        # Outside a replica view, related lookups on a replica-loaded instance
+        # go to the primary (Django would follow the instance to the replica)
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in replica_aliases() and not _replica_reads.get():
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def db_for_write(self, model, **hints):
+        wrote = _wrote.get()
+        if wrote is not None:
+            wrote[0] = True
+        # Always the primary, including for instances that were read from a replica
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *replica_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas are copies of the primary; they are never migrated directly
+        if db in replica_aliases():
+            return False
+        return None
+
+
+def sync_replicas(aliases=None):
+    """
+    Copy the primary onto SQLite replicas with SQLite's online backup API
+    (readers of the replica see the old or the new copy, never a mix).
+    Returns the aliases copied.
+    """
+    aliases = replica_aliases() if aliases is None else aliases
+    source = connections[DEFAULT_DB_ALIAS]
+    for alias in aliases:
+        target = connections[alias]
+        if source.vendor != 'sqlite' or target.vendor != 'sqlite':
+            raise ValueError(f'{alias}: only SQLite replicas can be copied; use the database\'s own replication.')
+        source.ensure_connection()
+        target.ensure_connection()
+        source.connection.backup(target.connection)
+    return aliases
@@ -0,0 +1,231 @@
+# gadget_cave/search.py
+#
+# Ranked full-text product search for the storefront and the admin. SQLite
+# uses an FTS5 table, PostgreSQL a GIN-indexed tsvector table (both created
+# by migration 0005); they are kept current from the Product signals, and
+# `manage.py rebuild_search_index` refills them. Other databases fall back to
+# icontains.
+import re
+
+from django.db import connection
+from django.db.models import Count, Q
+from django.db.models.expressions import RawSQL
+
+from .cache import get_categories
+from .catalog import CARD_FIELDS
+from .models import Product
+
+FTS_TABLE = 'gadget_cave_product_fts'
+TSVECTOR_TABLE = 'gadget_cave_product_search'
+SEARCH_PAGE_SIZE = 24
+MAX_TERMS = 8
+# A match in the name ranks ten times higher than one in the description
+SQLITE_RANK = f'bm25({FTS_TABLE}, 10.0, 1.0)'
+POSTGRES_RANK = "ts_rank('{0, 0, 0.1, 1.0}', document, query)"
+POSTGRES_DOCUMENT = (
+    "setweight(to_tsvector('simple', name), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(description, '')), 'B')"
+)
+
+
+class SearchResults:
+    def __init__(self, query, products=(), total=0, facets=(), page=1, per_page=SEARCH_PAGE_SIZE):
+        self.query = query
+        self.object_list = list(products)
+        self.total = total
+        # [(category, count)], most matches first
+        self.facets = list(facets)
+        self.page = page
+        self.per_page = per_page
+
+    @property
+    def match_count(self):
+        """Matches in all categories (total only counts the selected one)."""
+        return sum(count for category, count in self.facets)
+
+    @property
+    def has_next(self):
+        return self.page * self.per_page < self.total
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def search_backend():
+    return connection.vendor if connection.vendor in ('sqlite', 'postgresql') else None
+
+
+def terms(query):
+    return re.findall(r'\w+', query.lower())[:MAX_TERMS]
+
+
+def match_expression(words, prefix=False, names_only=True):
+    """
+    The FTS5 MATCH / to_tsquery() string for `words`: every term must match.
+    With `prefix` (typeahead) the last term may be incomplete and, unless
+    names_only is off, only product names are searched, which keeps the
+    match set small. Terms are \\w+ only, so user input can't inject query
+    syntax.
+    """
+    if connection.vendor == 'postgresql':
+        if not prefix:
+            return ' & '.join(words)
+        # Weight A is the name (see POSTGRES_DOCUMENT)
+        weight = 'A' if names_only else ''
+        return ' & '.join([f'{word}:{weight}' if weight else word for word in words[:-1]] + [f'{words[-1]}:*{weight}'])
+    expression = ' '.join(f'"{word}"' for word in words)
+    if not prefix:
+        return expression
+    return f'name : ({expression}*)' if names_only else f'{expression}*'
+
+
+def _matches(available_only):
+    """SQL selecting (id, category_id, rank) of the matching products; lower rank is better."""
+    if connection.vendor == 'postgresql':
+        sql = (
+            f"SELECT product_id AS id, category_id, -{POSTGRES_RANK} AS rank "
+            f"FROM {TSVECTOR_TABLE}, to_tsquery('simple', %s) query WHERE document @@ query"
+        )
+        return sql + (' AND available' if available_only else '')
+    sql = f'SELECT rowid AS id, category_id, {SQLITE_RANK} AS rank FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s'
+    return sql + (' AND available = 1' if available_only else '')
+
+
+def search(query, category=None, page=1, per_page=SEARCH_PAGE_SIZE, prefix=False):
+    """
+    Available products matching `query`, best first, with per-category match
+    counts. One query ranks the page of hits and counts the facets (both read
+    the same CTE); a second loads the products on the page.
+    """
+    words = terms(query)
+    if not words:
+        return SearchResults(query, page=page, per_page=per_page)
+    if search_backend() is None:
+        return _search_icontains(query, words, category, page, per_page)
+
+    offset = (page - 1) * per_page
+    params = [match_expression(words, prefix)]
+    in_category = ''
+    if category is not None:
+        in_category = 'WHERE category_id = %s'
+        params.append(category.id)
+    params += [per_page, offset]
+    sql = f"""
+        WITH matches AS ({_matches(available_only=True)})
+        SELECT * FROM (
+            SELECT 0 AS kind, id, rank FROM matches {in_category} ORDER BY rank, id LIMIT %s OFFSET %s
+        ) hits
+        UNION ALL
+        SELECT 1 AS kind, category_id, COUNT(*) FROM matches GROUP BY category_id
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    ids = [row[1] for row in rows if row[0] == 0]
+    counts = {row[1]: int(row[2]) for row in rows if row[0] == 1}
+    products = Product.objects.filter(id__in=ids).only(*CARD_FIELDS).in_bulk()
+    return _results(query, [products[i] for i in ids if i in products], counts, category, page, per_page)
+
+
+def _results(query, products, counts, category, page, per_page):
+    categories = {c.id: c for c in get_categories()}
+    facets = sorted(
+        ((categories[category_id], count) for category_id, count in counts.items() if category_id in categories),
+        key=lambda facet: (-facet[1], facet[0].name),
+    )
+    total = counts.get(category.id, 0) if category is not None else sum(counts.values())
+    return SearchResults(query, products, total, facets, page, per_page)
+
+
+def _search_icontains(query, words, category, page, per_page):
+    condition = Q()
+    for word in words:
+        condition &= Q(name__icontains=word) | Q(description__icontains=word)
+    matches = Product.objects.filter(condition, available=True)
+    counts = dict(matches.order_by().values_list('category').annotate(n=Count('id')))
+    if category is not None:
+        matches = matches.filter(category=category)
+    offset = (page - 1) * per_page
+    products = matches.only(*CARD_FIELDS).order_by('name', 'id')[offset:offset + per_page]
+    return _results(query, products, counts, category, page, per_page)
+
+
+def search_filter(query, prefix=True):
+    """
+    A Q() limiting a Product queryset to products matching `query` (any
+    availability) in any indexed column, the last term as a prefix, for
+    ProductAdmin's search box; None when there is no full-text index to use.
+    """
+    words = terms(query)
+    if not words or search_backend() is None:
+        return None
+    if connection.vendor == 'postgresql':
+        sql = f"SELECT product_id FROM {TSVECTOR_TABLE} WHERE document @@ to_tsquery('simple', %s)"
+    else:
+        sql = f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s'
+    return Q(id__in=RawSQL(sql, [match_expression(words, prefix, names_only=False)]))
+
+
+# Index maintenance
+
+def index_products(product_ids):
+    """(Re)index the given products from the product table, in two statements."""
+    product_ids = list(product_ids)
+    if not product_ids or search_backend() is None:
+        return
+    placeholders = ', '.join(['%s'] * len(product_ids))
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(f'DELETE FROM {TSVECTOR_TABLE} WHERE product_id IN ({placeholders})', product_ids)
+            cursor.execute(
+                f'INSERT INTO {TSVECTOR_TABLE} (product_id, category_id, available, document) '
+                f'SELECT id, category_id, available, {POSTGRES_DOCUMENT} '
+                f'FROM gadget_cave_product WHERE id IN ({placeholders})',
+                product_ids,
+            )
+        else:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})', product_ids)
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE} (rowid, name, description, category_id, available) '
+                f'SELECT id, name, description, category_id, available '
+                f'FROM gadget_cave_product WHERE id IN ({placeholders})',
+                product_ids,
+            )
+
+
+def unindex_products(product_ids):
+    product_ids = list(product_ids)
+    if not product_ids or search_backend() is None:
+        return
+    placeholders = ', '.join(['%s'] * len(product_ids))
+    table, column = (TSVECTOR_TABLE, 'product_id') if connection.vendor == 'postgresql' else (FTS_TABLE, 'rowid')
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table} WHERE {column} IN ({placeholders})', product_ids)
+
+
+def rebuild_index():
+    """Refill the whole index from the product table; returns the number of products indexed."""
+    if search_backend() is None:
+        return 0
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(f'DELETE FROM {TSVECTOR_TABLE}')
+            cursor.execute(
+                f'INSERT INTO {TSVECTOR_TABLE} (product_id, category_id, available, document) '
+                f'SELECT id, category_id, available, {POSTGRES_DOCUMENT} FROM gadget_cave_product'
+            )
+            count = cursor.rowcount
+            cursor.execute(f'ANALYZE {TSVECTOR_TABLE}')
+        else:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE} (rowid, name, description, category_id, available) '
+                f'SELECT id, name, description, category_id, available FROM gadget_cave_product'
+            )
+            count = cursor.rowcount
+            # Merge the index b-trees into one for the fastest queries
+            cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+    return count
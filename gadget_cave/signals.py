@@ -0,0 +1,82 @@
+# gadget_cave/signals.py
+from django.contrib.auth.signals import user_logged_in
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import analytics, autocomplete, carts, images, search
+from .guest_cart import merge_into_user_cart
+from .cache import bump_generation, catalog_cache, invalidate_products, product_fragment_keys
+from .models import Category, Order, Product, ProductImage
+
+
+# Product fragments are keyed on Product.updated, so saving a product
+# already moves its card and gallery to new keys; a delete drops them.
+# Either way its cached detail bundle is stale.
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, **kwargs):
+    invalidate_products([instance.pk])
+    search.index_products([instance.pk])
+    # The in-memory autocomplete index isn't transactional, so it waits for the commit
+    transaction.on_commit(lambda: autocomplete.index.update_product(instance))
+    # The price may have changed, and with it the subtotal of carts holding the product
+    carts.forget_summaries_for_products([instance.pk])
+
+
+@receiver(pre_delete, sender=Product)
+def product_deleting(sender, instance, **kwargs):
+    # Before the delete cascades to the cart lines that say whose summaries are affected
+    carts.forget_summaries_for_products([instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    catalog_cache().delete_many(product_fragment_keys(instance))
+    invalidate_products([instance.pk])
+    search.unindex_products([instance.pk])
+    pk = instance.pk
+    transaction.on_commit(lambda: autocomplete.index.remove('product', pk))
+
+
+# Images are part of the product's gallery: touching Product.updated moves
+# its fragments to new keys (a queryset update, so no Product signals fire).
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def product_image_changed(sender, instance, **kwargs):
+    Product.objects.filter(pk=instance.product_id).update(updated=timezone.now())
+    invalidate_products([instance.product_id])
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed(sender, instance, **kwargs):
+    bump_generation('categories')
+    if kwargs['signal'] is post_delete:
+        pk = instance.pk
+        transaction.on_commit(lambda: autocomplete.index.remove('category', pk))
+    else:
+        transaction.on_commit(lambda: autocomplete.index.update_category(instance))
+
+
+# New uploads are re-encoded and get their renditions in the background
+# (see gadget_cave/images.py); this is a no-op for already-processed files.
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=ProductImage)
+def queue_image_processing(sender, instance, **kwargs):
+    images.queue_processing(instance)
+
+
+# The sales rollups find changed orders by Order.updated; a deleted order
+# has none, so its day is rebuilt in the background (see analytics.py).
+@receiver(post_delete, sender=Order)
+def order_deleted(sender, instance, **kwargs):
+    analytics.queue_rebuild(instance.created)
+
+
+# What a visitor put in their cookie cart moves into their Cart at login
+@receiver(user_logged_in)
+def merge_guest_cart(sender, request, user, **kwargs):
+    guest_cart = getattr(request, 'guest_cart', None)
+    if guest_cart:
+        merge_into_user_cart(guest_cart, user)
@@ -0,0 +1,191 @@
+# gadget_cave/tasks.py
+#
+# A small database-backed task queue. Tasks are rows in gadget_cave.Task, so
+# enqueueing inside a transaction commits (or rolls back) together with the
+# data the task is about. Workers (`manage.py run_tasks`) claim due tasks in
+# batches with one conditional UPDATE and hold them under a lease.
+import logging
+import os
+import socket
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, close_old_connections, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+LEASE = timedelta(seconds=getattr(settings, 'TASK_LEASE_SECONDS', 300))
+RETRY_BACKOFF = getattr(settings, 'TASK_RETRY_BACKOFF_SECONDS', 5)
+MAX_BACKOFF = 60 * 60
+
+_registry = {}
+
+
+def task(name):
+    """Register a function as the handler for tasks called `name`."""
+    def decorator(func):
+        _registry[name] = func
+        return func
+    return decorator
+
+
+def enqueue(name, payload=None, key=None, run_after=None, max_attempts=5):
+    """
+    Queue a task and return its Task row.
+
+    With a `key`, enqueueing is idempotent: if a task with that key already
+    exists (in any status) it is returned unchanged, so the same piece of
+    work is never done twice.
+    """
+    defaults = {
+        'name': name,
+        'payload': payload or {},
+        'run_after': run_after or timezone.now(),
+        'max_attempts': max_attempts,
+    }
+    if key is None:
+        return Task.objects.create(key=f'{name}:{uuid.uuid4().hex}', **defaults)
+    try:
+        with transaction.atomic():
+            return Task.objects.get_or_create(key=key, defaults=defaults)[0]
+    except IntegrityError:
+        # Lost a race with another enqueue of the same key
+        return Task.objects.get(key=key)
+
+
+def enqueue_many(tasks):
+    """Queue [(name, payload, key), ...] with one INSERT; existing keys are skipped."""
+    now = timezone.now()
+    Task.objects.bulk_create(
+        [Task(name=name, payload=payload or {}, key=key or f'{name}:{uuid.uuid4().hex}', run_after=now)
+         for name, payload, key in tasks],
+        ignore_conflicts=True,
+    )
+
+
+def worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+
+
+def _claimable(now):
+    # Due queued tasks, and running tasks whose worker let its lease lapse
+    return Q(status='queued', run_after__lte=now) | Q(status='running', locked_until__lt=now)
+
+
+def claim(worker, limit=10):
+    """
+    Lease up to `limit` due tasks to `worker` and return them. The UPDATE
+    repeats the claimable condition, so when two workers pick the same rows
+    only one of them gets each task.
+    """
+    now = timezone.now()
+    candidates = Task.objects.filter(_claimable(now)).order_by('run_after', 'id')
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        ids = list(candidates.values_list('id', flat=True)[:limit])
+        if not ids:
+            return []
+        Task.objects.filter(_claimable(now), id__in=ids).update(
+            status='running', locked_by=worker, locked_until=now + LEASE,
+            attempts=F('attempts') + 1, updated=now,
+        )
+    return list(Task.objects.filter(id__in=ids, status='running', locked_by=worker).order_by('run_after', 'id'))
+
+
+def _attempt(task, worker):
+    """
+    Run one claimed task. Failures are recorded straight away (requeued with
+    backoff, or failed after max_attempts); successes are left for the
+    caller to mark done in bulk. Returns the new status.
+    """
+    handler = _registry.get(task.name)
+    try:
+        if handler is None:
+            raise LookupError(f'No handler registered for task {task.name!r}')
+        # A failed attempt leaves no partial writes behind
+        with transaction.atomic():
+            handler(**task.payload)
+    except Exception as e:
+        now = timezone.now()
+        if task.attempts >= task.max_attempts or handler is None:
+            status, run_after = 'failed', task.run_after
+        else:
+            status = 'queued'
+            run_after = now + timedelta(seconds=min(MAX_BACKOFF, RETRY_BACKOFF * 2 ** (task.attempts - 1)))
+        logger.warning('Task %s (attempt %s) raised %r', task.key, task.attempts, e)
+        # Only the lease holder may record a result
+        Task.objects.filter(id=task.id, status='running', locked_by=worker).update(
+            status=status, run_after=run_after, last_error=f'{type(e).__name__}: {e}',
+            locked_by='', locked_until=None, updated=now,
+        )
+        return status
+    return 'done'
+
+
+def _attempt_pooled(task, worker):
+    # Pool threads get their own connections; treat each task like a request
+    close_old_connections()
+    try:
+        return _attempt(task, worker)
+    finally:
+        close_old_connections()
+
+
+def _mark_done(task_ids, worker):
+    # One UPDATE per batch rather than one commit per task
+    if task_ids:
+        Task.objects.filter(id__in=task_ids, status='running', locked_by=worker).update(
+            status='done', last_error='', locked_by='', locked_until=None, updated=timezone.now(),
+        )
+
+
+def run_worker(concurrency=1, batch_size=None, once=False, idle_sleep=1.0, max_tasks=None, worker=None):
+    """
+    Claim and run tasks until the queue is empty (`once`), `max_tasks` have
+    run, or forever. `concurrency` tasks of a batch run at a time on a thread
+    pool; image work is mostly in Pillow, which releases the GIL. Delivery is
+    at-least-once: a worker that dies mid-batch leaves its tasks to be
+    claimed again when the lease lapses, so handlers must be idempotent.
+    Returns a {status: count} dict.
+    """
+    worker = worker or worker_id()
+    # Claiming is a transaction of its own, so small batches cost throughput
+    batch_size = batch_size or concurrency * 10
+    counts = {'done': 0, 'queued': 0, 'failed': 0}
+    pool = ThreadPoolExecutor(concurrency) if concurrency > 1 else None
+    try:
+        while max_tasks is None or sum(counts.values()) < max_tasks:
+            limit = batch_size if max_tasks is None else min(batch_size, max_tasks - sum(counts.values()))
+            try:
+                tasks = claim(worker, limit)
+            except OperationalError as e:
+                # SQLite: another worker holds the write lock; try again shortly
+                if 'locked' not in str(e):
+                    raise
+                time.sleep(0.01)
+                continue
+            if not tasks:
+                if once:
+                    break
+                close_old_connections()
+                time.sleep(idle_sleep)
+                continue
+            if pool:
+                results = list(pool.map(_attempt_pooled, tasks, [worker] * len(tasks)))
+            else:
+                results = [_attempt(t, worker) for t in tasks]
+            _mark_done([t.id for t, status in zip(tasks, results) if status == 'done'], worker)
+            for status in results:
+                counts[status] = counts.get(status, 0) + 1
+    finally:
+        if pool:
+            pool.shutdown()
+    return counts
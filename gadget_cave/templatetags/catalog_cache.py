@@ -0,0 +1,52 @@
+from django import template
+
+from ..cache import FRAGMENT_TIMEOUT, catalog_cache, fragment_key, get_generation, stats
+
+register = template.Library()
+
+
+class CachedFragmentNode(template.Node):
+    def __init__(self, nodelist, name, vary_on, generation):
+        self.nodelist = nodelist
+        self.name = name
+        self.vary_on = vary_on
+        self.generation = generation
+
+    def render(self, context):
+        vary_on = [var.resolve(context) for var in self.vary_on]
+        if self.generation:
+            vary_on.append(get_generation(self.generation))
+        key = fragment_key(self.name, vary_on)
+        cache = catalog_cache()
+        value = cache.get(key)
+        stats.record(self.name, value is not None)
+        if value is None:
+            value = self.nodelist.render(context)
+            cache.set(key, value, FRAGMENT_TIMEOUT)
+        return value
+
+
+@register.tag
+def cachedfragment(parser, token):
+    """
+    Cache a rendered fragment in the catalog cache and count hits/misses:
+
+        {% cachedfragment "product_card" product.id product.updated.timestamp %}
+            ...
+        {% endcachedfragment %}
+
+    The key is the fragment name plus the vary-on values. Ending with
+    generation=<namespace> also keys it on that namespace's generation
+    (see gadget_cave.cache.bump_generation), for fragments that depend on
+    a whole table such as the category list.
+    """
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError(f"'{bits[0]}' tag requires a fragment name.")
+    name = bits[1].strip('"\'')
+    generation = None
+    if bits[-1].startswith('generation='):
+        generation = bits.pop()[len('generation='):].strip('"\'')
+    nodelist = parser.parse(('endcachedfragment',))
+    parser.delete_first_token()
+    return CachedFragmentNode(nodelist, name, [parser.compile_filter(bit) for bit in bits[2:]], generation)
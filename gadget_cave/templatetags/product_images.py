@@ -0,0 +1,22 @@
+from django import template
+
+from ..images import responsive_image
+
+register = template.Library()
+
+
+@register.simple_tag
+def renditions(field_file, width=320):
+    """
+    Resized renditions of an image field, for <picture>/srcset markup:
+
+        {% renditions product.main_image 320 as image %}
+        <picture>
+            <source type="image/webp" srcset="{{ image.webp }}" sizes="...">
+            <img src="{{ image.src }}" srcset="{{ image.jpeg }}" sizes="...">
+        </picture>
+
+    `width` picks the plain src for browsers without srcset support. See
+    gadget_cave.images.responsive_image.
+    """
+    return responsive_image(field_file, width)
@@ -1,3 +1,1539 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
 
-# Create your tests here.
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection, connections, router, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from .benchmarks import checkout_workload, compare_to_baseline, connection_capacity, stock_contention, storefront_load
+from .cache import catalog_cache, stats as fragment_stats
+from .catalog import CATALOG_SORTS, catalog_page
+from .images import generate_renditions, get_manifest
+from .guest_cart import MAX_LINES, GuestCart
+from .tasks import enqueue, run_worker, task
+from .search import rebuild_index, search
+from . import analytics, autocomplete, carts, catalog_io, inventory_feed, metrics, order_export, order_status, orders, routers
+from .inventory import InsufficientStock, place_order, release_expired_reservations, reserve_stock
+from .models import (
+    Cart, CartItem, Category, CustomUser, DailySales, InventoryChange, Order, OrderItem, OrderTransition, Product, ProductImage,
+    ProductSales, StockReservation, Task,
+)
+
+
+def make_catalog(products=30, categories=2):
+    cats = [Category.objects.create(name=f'Category {i}', slug=f'category-{i}') for i in range(categories)]
+    Product.objects.bulk_create([
+        Product(
+            category=cats[i % categories],
+            name=f'Product {i % 7}',  # duplicate names exercise the id tie-breaker
+            slug=f'product-{i}',
+            price=Decimal(100 + (i * 37) % 50),
+            stock=10,
+        )
+        for i in range(products)
+    ])
+    return cats
+
+
+class CatalogPaginationTests(TestCase):
+    def setUp(self):
+        catalog_cache().clear()
+        self.categories = make_catalog()
+
+    def walk(self, **kwargs):
+        seen, cursor = [], None
+        while True:
+            page = catalog_page(cursor=cursor, per_page=4, **kwargs)
+            seen.extend(p.id for p in page)
+            if not page.has_next:
+                return seen
+            cursor = page.next_cursor
+
+    def test_every_sort_visits_each_product_once_in_order(self):
+        for sort, ordering in CATALOG_SORTS.items():
+            expected = list(Product.objects.filter(available=True).order_by(*ordering).values_list('id', flat=True))
+            self.assertEqual(self.walk(sort=sort), expected, sort)
+
+    def test_category_filter(self):
+        category = self.categories[0]
+        expected = set(category.products.values_list('id', flat=True))
+        self.assertEqual(set(self.walk(category=category)), expected)
+
+    def test_listing_query_count_is_constant(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('gadget_cave:home'))
+        next_cursor = response.context['page'].next_cursor
+        # The category comes from the cached category list
+        with self.assertNumQueries(1):
+            self.client.get(
+                reverse('gadget_cave:product_list_by_category', args=[self.categories[0].slug]),
+                {'sort': 'price_desc'},
+            )
+        with self.assertNumQueries(1):  # the category sidebar is now cached
+            self.client.get(reverse('gadget_cave:home'), {'cursor': next_cursor})
+
+    def test_api(self):
+        response = self.client.get(reverse('gadget_cave:product_list_api'), {'sort': 'newest'})
+        data = response.json()
+        self.assertEqual(len(data['results']), 24)
+        self.assertIsNotNone(data['next_cursor'])
+        response = self.client.get(reverse('gadget_cave:product_list_api'), {'cursor': data['next_cursor'], 'sort': 'newest'})
+        self.assertEqual(len(response.json()['results']), 6)
+        self.assertEqual(self.client.get(reverse('gadget_cave:product_list_api'), {'cursor': 'garbage'}).status_code, 400)
+
+
+def make_order(user, products, quantity=2, **fields):
+    order = Order.objects.create(
+        user=user, first_name='Test', last_name='User', email='test@example.com',
+        address='1 Street', city='Kochi', postal_code='682001', **fields
+    )
+    OrderItem.objects.bulk_create([
+        OrderItem(order=order, product=product, price=product.price, quantity=quantity)
+        for product in products
+    ])
+    return order
+
+
+class TotalsTests(TestCase):
+    def setUp(self):
+        make_catalog(products=12)
+        self.products = list(Product.objects.order_by('id'))
+        self.user = CustomUser.objects.create_user('buyer', password='pw')
+        self.client.force_login(self.user)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(ctx)
+
+    def test_order_totals_match_python(self):
+        order = make_order(self.user, self.products[:3], quantity=3)
+        annotated = Order.objects.with_totals().get(id=order.id)
+        self.assertEqual(annotated.get_total_cost(), sum(item.get_cost() for item in order.items.all()))
+        self.assertEqual(annotated.item_count, 9)
+        self.assertEqual(sorted(annotated.get_product_names().split(', ')), sorted(p.name for p in self.products[:3]))
+        empty = Order.objects.with_totals().get(id=make_order(self.user, []).id)
+        self.assertEqual((empty.get_total_cost(), empty.item_count, empty.get_product_names()), (0, 0, ''))
+
+    def test_cart_query_count_is_constant(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.products[0])
+        carts.refresh_summaries([self.user.pk])  # the header badge, normally kept warm by carts.py
+        small = self.count_queries(reverse('gadget_cave:cart_detail'))
+        CartItem.objects.bulk_create([CartItem(cart=cart, product=p, quantity=2) for p in self.products[1:]])
+        self.assertEqual(self.count_queries(reverse('gadget_cave:cart_detail')), small)
+        cart = Cart.objects.with_totals().get(id=cart.id)
+        self.assertEqual(cart.get_total_cost(), sum(item.get_cost() for item in cart.items.all()))
+
+    def test_my_orders_query_count_is_constant(self):
+        make_order(self.user, self.products[:1])
+        small = self.count_queries(reverse('gadget_cave:my_orders'))
+        for i in range(5):
+            make_order(self.user, self.products[i:i + 6])
+        self.assertEqual(self.count_queries(reverse('gadget_cave:my_orders')), small)
+
+
+
+class OrderHistoryTests(TestCase):
+    def setUp(self):
+        make_catalog(products=6, categories=1)
+        self.products = list(Product.objects.order_by('id'))
+        self.user = CustomUser.objects.create_user('buyer', password='pw')
+        # Same-second timestamps: the id breaks the ties
+        self.orders = [make_order(self.user, self.products[:1 + i % 4]) for i in range(23)]
+        make_order(CustomUser.objects.create_user('other', password='pw'), self.products[:1])
+        self.client.force_login(self.user)
+        carts.refresh_summaries([self.user.pk])
+
+    def test_infinite_scroll_pages(self):
+        seen, counts, cursor = [], set(), ''
+        while cursor is not None:
+            with CaptureQueriesContext(connection) as ctx:
+                data = self.client.get(reverse('gadget_cave:my_orders_api'), {'cursor': cursor} if cursor else {}).json()
+            counts.add(len(ctx))
+            seen += data['results']
+            cursor = data['next_cursor']
+        self.assertEqual(len(counts), 1, counts)
+        expected = sorted(self.orders, key=lambda order: (order.created, order.id), reverse=True)
+        self.assertEqual([order['id'] for order in seen], [order.id for order in expected])
+        first = seen[0]
+        self.assertEqual(first['total_cost'], str(sum(item.get_cost() for item in expected[0].items.all())))
+        self.assertEqual(len(first['items']), expected[0].items.count())
+        self.assertEqual(self.client.get(reverse('gadget_cave:my_orders_api'), {'cursor': 'junk'}).status_code, 400)
+
+    def test_page_links_to_the_next_one(self):
+        response = self.client.get(reverse('gadget_cave:my_orders'))
+        page = response.context['page']
+        self.assertEqual(len(page), orders.HISTORY_PAGE_SIZE)
+        self.assertContains(response, f'?cursor={page.next_cursor}')
+        response = self.client.get(reverse('gadget_cave:my_orders'), {'cursor': page.next_cursor})
+        self.assertEqual(len(response.context['page']), orders.HISTORY_PAGE_SIZE)
+        self.assertEqual(self.client.get(reverse('gadget_cave:my_orders'), {'cursor': 'junk'}).status_code, 404)
+
+    def test_history_uses_the_user_created_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite query plan')
+        queryset = orders._paginator(self.user, orders.HISTORY_PAGE_SIZE).queryset
+        self.assertIn('order_user_created_idx', queryset.explain())
+
+class OrderExportTests(TestCase):
+    def setUp(self):
+        make_catalog(products=3, categories=1)
+        self.products = list(Product.objects.order_by('id'))
+        user = CustomUser.objects.create_user('buyer', password='pw')
+        self.orders = [make_order(user, self.products[:1 + i % 3], paid=i % 2 == 0) for i in range(6)]
+        # Two orders a day, from 2026-01-01
+        for i, order in enumerate(self.orders):
+            Order.objects.filter(pk=order.pk).update(created=timezone.make_aware(timezone.datetime(2026, 1, 1 + i // 2, 12)))
+
+    def export(self, fmt='csv', kind='orders', **filters):
+        with CaptureQueriesContext(connection) as queries:
+            text = ''.join(order_export.export_orders(fmt, kind, chunk_size=2, **filters))
+        self.assertEqual(len(queries), 1)  # however many chunks
+        return text
+
+    def test_orders_with_sql_totals(self):
+        lines = self.export(since=order_export.parse_moment('2026-01-02'), until=order_export.parse_moment('2026-01-03')).splitlines()
+        self.assertEqual(lines[0].split(','), list(order_export.ORDER_COLUMNS))
+        self.assertEqual([int(line.split(',')[0]) for line in lines[1:]], [self.orders[2].id, self.orders[3].id])
+        rows = [json.loads(line) for line in self.export('jsonl', paid=True).splitlines()]
+        self.assertEqual([row['id'] for row in rows], [order.id for order in self.orders[::2]])
+        expected = Order.objects.get(pk=self.orders[2].pk)
+        self.assertEqual(rows[1]['total_cost'], f'{expected.get_total_cost():.2f}')
+        self.assertEqual((rows[1]['item_count'], rows[1]['customer']), (6, 'buyer'))
+
+    def test_order_lines(self):
+        rows = [json.loads(line) for line in self.export('jsonl', 'items', status='pending').splitlines()]
+        self.assertEqual(len(rows), 12)
+        self.assertEqual(rows[-1]['line_total'], f"{Decimal(rows[-1]['price']) * 2:.2f}")
+
+    def test_range_scan_uses_the_created_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite query plan')
+        columns, queryset = order_export.rows(since=order_export.parse_moment('2026-01-02'))
+        self.assertIn('order_created_idx', queryset.explain())
+
+    def test_admin_and_command(self):
+        CustomUser.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+        changelist = self.client.get(reverse('admin:gadget_cave_order_changelist'), {'paid__exact': '1'})
+        self.assertContains(changelist, 'paid__exact=1&amp;kind=items')
+        response = self.client.get(reverse('admin:gadget_cave_order_export'), {
+            'kind': 'items', 'paid__exact': '1', 'created__gte': '2026-01-03 00:00:00+00:00',
+        })
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="items.csv"')
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 1 + 2)
+        self.assertEqual(self.client.get(reverse('admin:gadget_cave_order_export'), {'created__gte': 'soon'}).status_code, 400)
+
+        out = StringIO()
+        call_command('export_orders', '--unpaid', '--since', '2026-01-02', stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 1 + 2)
+
+
+class SalesRollupTests(TestCase):
+    def setUp(self):
+        make_catalog(products=3, categories=1)
+        self.products = list(Product.objects.order_by('id'))
+        user = CustomUser.objects.create_user('buyer', password='pw')
+        self.orders = [make_order(user, self.products[:1 + i % 3], paid=i % 3 != 2) for i in range(6)]
+        self.today = timezone.localdate()
+        # Two orders a day: the day before yesterday, yesterday and today
+        for i, order in enumerate(self.orders):
+            created = timezone.make_aware(timezone.datetime.combine(self.today - timedelta(days=2 - i // 2), timezone.datetime.min.time()))
+            Order.objects.filter(pk=order.pk).update(created=created + timedelta(hours=1))
+        self.later = timezone.now() + timedelta(hours=1)
+
+    def sold(self):
+        orders = Order.objects.filter(analytics.SOLD)
+        items = OrderItem.objects.filter(order__in=orders)
+        return orders.count(), sum(item.quantity for item in items), sum(item.get_cost() for item in items)
+
+    def test_backfill_matches_the_orders(self):
+        days, rows = analytics.backfill(now=self.later)
+        self.assertEqual(days, 3)
+        self.assertEqual(rows, DailySales.objects.count() + ProductSales.objects.count())
+        sales = analytics.dashboard(self.today - timedelta(days=6), self.today)
+        totals = sales['totals']
+        self.assertEqual((totals['order_count'], totals['unit_count'], totals['amount']), self.sold())
+        self.assertEqual(len(sales['days']), 3)
+        self.assertEqual(sales['top_products'][0]['product'], self.products[0].id)
+        self.assertEqual(sum(row['order_count'] for row in sales['by_status']), 6)
+        # Rebuilding is idempotent
+        analytics.backfill(now=self.later)
+        self.assertEqual(analytics.dashboard(self.today - timedelta(days=6), self.today)['totals'], totals)
+
+    def test_incremental_update_picks_up_changed_orders(self):
+        self.assertEqual(analytics.update_rollups(now=self.later)[0], 3)  # first run backfills
+        self.assertEqual(analytics.update_rollups(now=self.later + timedelta(minutes=5)), (0, 0))
+        Order.objects.filter(pk=self.orders[0].pk).update(status='cancelled', updated=self.later + timedelta(minutes=6))
+        days, rows = analytics.update_rollups(now=self.later + timedelta(minutes=10))
+        self.assertEqual(days, 1)
+        self.assertEqual(analytics.dashboard(self.today - timedelta(days=6), self.today)['totals']['order_count'], self.sold()[0])
+        self.assertTrue(DailySales.objects.filter(status='cancelled').exists())
+
+    def test_deleted_order_queues_its_day(self):
+        analytics.backfill(now=self.later)
+        # Both orders of that day, one rebuild
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.filter(pk__in=[self.orders[0].pk, self.orders[1].pk]).delete()
+        job = Task.objects.get(name='rebuild_sales_day')
+        self.assertEqual(job.payload, {'day': (self.today - timedelta(days=2)).isoformat()})
+        run_worker(once=True)
+        self.assertEqual(analytics.dashboard(self.today - timedelta(days=6), self.today)['totals']['order_count'], self.sold()[0])
+        # A rebuild that already ran doesn't cover later deletes
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.get(pk=self.orders[2].pk).delete()
+            Order.objects.get(pk=self.orders[3].pk).delete()
+        self.assertEqual(Task.objects.filter(name='rebuild_sales_day', status='queued').count(), 1)
+
+    def test_dashboard_reads_only_the_rollups(self):
+        analytics.backfill(now=self.later)
+        with CaptureQueriesContext(connection) as queries:
+            analytics.dashboard(self.today - timedelta(days=29), self.today)
+        sql = ' '.join(query['sql'] for query in queries.captured_queries)
+        self.assertNotIn('"gadget_cave_order"', sql)
+        self.assertNotIn('"gadget_cave_orderitem"', sql)
+
+    def test_admin_dashboard_and_command(self):
+        out = StringIO()
+        call_command('rollup_sales', '--backfill', '--chunk-days', '2', stdout=out)
+        self.assertIn('Rebuilt 3 days', out.getvalue())
+        CustomUser.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+        response = self.client.get(reverse('admin:gadget_cave_dailysales_changelist'), {'days': '7'})
+        self.assertContains(response, self.products[0].name)
+        self.assertContains(response, 'Last 7 days')
+
+
+class AdminChangelistTests(TestCase):
+    def setUp(self):
+        make_catalog(products=8)
+        self.products = list(Product.objects.order_by('id'))
+        self.admin = CustomUser.objects.create_superuser('admin', password='pw')
+        self.client.force_login(self.admin)
+
+    def count_queries(self, url, **params):
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.client.get(url, params).status_code, 200)
+        return len(ctx)
+
+    def test_changelists_do_not_grow_with_rows(self):
+        buyer = CustomUser.objects.create_user('buyer', password='pw')
+        make_order(buyer, self.products[:2])
+        cart = Cart.objects.create(user=buyer)
+        CartItem.objects.create(cart=cart, product=self.products[0])
+        urls = [reverse(f'admin:gadget_cave_{name}_changelist') for name in ('order', 'cart', 'cartitem', 'product')]
+        before = [self.count_queries(url) for url in urls]
+        for i in range(6):
+            user = CustomUser.objects.create_user(f'buyer{i}', password='pw')
+            make_order(user, self.products[i:i + 3])
+            cart = Cart.objects.create(user=user)
+            CartItem.objects.bulk_create([CartItem(cart=cart, product=p) for p in self.products[i:i + 3]])
+        self.assertEqual([self.count_queries(url) for url in urls], before)
+        # Sorting by the annotated total happens in SQL
+        from .admin import OrderAdmin
+        column = OrderAdmin.list_display.index('get_total_cost_display') + 1  # after the action checkbox
+        response = self.client.get(urls[0], {'o': f'-{column}'})
+        totals = [order.total_cost for order in response.context['cl'].result_list]
+        self.assertEqual(totals, sorted(totals, reverse=True))
+
+    def test_order_change_form_inline_is_constant(self):
+        small = make_order(self.admin, self.products[:1])
+        large = make_order(self.admin, self.products)
+        url = lambda order: reverse('admin:gadget_cave_order_change', args=[order.id])
+        self.count_queries(url(small))  # warm per-process caches (content types, permissions)
+        self.assertEqual(self.count_queries(url(large)), self.count_queries(url(small)))
+
+    def test_estimated_count_paginator(self):
+        from .pagination import EstimatedCountPaginator
+        paginator = EstimatedCountPaginator(Product.objects.all(), 5)
+        paginator.exact_threshold = 3
+        Product.objects.filter(id=self.products[0].id).delete()
+        # MAX(rowid) over-counts deleted rows; filtered querysets stay exact
+        self.assertEqual(paginator.count, self.products[-1].id)
+        self.assertEqual(EstimatedCountPaginator(Product.objects.filter(stock=10), 5).count, 7)
+
+
+class StockReservationTests(TestCase):
+    def setUp(self):
+        make_catalog(products=3)
+        self.a, self.b, self.c = Product.objects.order_by('id')
+        self.user = CustomUser.objects.create_user('buyer', password='pw')
+
+    def test_all_or_nothing_with_shortfalls(self):
+        with self.assertRaises(InsufficientStock) as ctx:
+            reserve_stock({self.a.id: 4, self.b.id: 11, self.c.id: 10})
+        self.assertEqual([(s.product_id, s.requested, s.available) for s in ctx.exception.shortfalls], [(self.b.id, 11, 10)])
+        self.assertEqual(list(Product.objects.order_by('id').values_list('stock', flat=True)), [10, 10, 10])
+
+    def test_place_order_is_one_update_and_one_insert(self):
+        order = Order(user=self.user, first_name='A', last_name='B', email='a@example.com',
+                      address='x', city='y', postal_code='1')
+        lines = [(self.a, 2, self.a.price), (self.b, 3, self.b.price), (self.a, 1, self.a.price)]
+        # 2 savepoints + 2 releases, one UPDATE for all lines, INSERT order,
+        # one bulk INSERT each for items and reservations
+        with self.assertNumQueries(8):
+            place_order(order, lines)
+        self.assertEqual(order.items.count(), 3)
+        self.assertEqual(list(Product.objects.order_by('id').values_list('stock', 'reserved')), [(7, 3), (7, 3), (10, 0)])
+        self.assertEqual(sorted(order.reservations.values_list('product_id', 'quantity')), [(self.a.id, 3), (self.b.id, 3)])
+
+    def test_checkout_reports_shortfall(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.a, quantity=5)
+        self.client.force_login(self.user)
+        Product.objects.filter(id=self.a.id).update(stock=2)  # sold elsewhere after the cart was shown
+        response = self.client.post(reverse('gadget_cave:order_create'), {
+            'first_name': 'A', 'last_name': 'B', 'email': 'a@example.com', 'address': 'x',
+            'city': 'y', 'postal_code': '1',
+        })
+        self.assertRedirects(response, reverse('gadget_cave:cart_detail'), fetch_redirect_response=False)
+        self.assertFalse(Order.objects.exists())
+
+
+class OrderStatusTests(TestCase):
+    def setUp(self):
+        make_catalog(products=2)
+        self.a, self.b = Product.objects.order_by('id')
+        self.user = CustomUser.objects.create_user('buyer', password='pw')
+
+    def order(self, *lines):
+        order = Order(user=self.user, first_name='A', last_name='B', email='a@example.com',
+                      address='x', city='y', postal_code='1')
+        return place_order(order, [(product, quantity, product.price) for product, quantity in lines])
+
+    def stock(self):
+        return list(Product.objects.order_by('id').values_list('stock', 'reserved'))
+
+    def test_only_allowed_orders_move(self):
+        pending, shipped, cancelled = self.order((self.a, 1)), self.order((self.a, 1)), self.order((self.b, 1))
+        unpaid = self.order((self.b, 1))
+        Order.objects.filter(id=shipped.id).update(status='shipped')
+        Order.objects.filter(id=cancelled.id).update(status='cancelled')
+        Order.objects.exclude(id=unpaid.id).update(paid=True, payment_status='completed')
+        before = timezone.now()
+        ids = [pending.id, shipped.id, cancelled.id, unpaid.id]
+        # Lock/read, UPDATE, transition INSERT, plus the savepoint pair
+        with self.assertNumQueries(5):
+            result = order_status.transition(ids, 'ship', source='test', batch_size=10)
+        self.assertEqual((result['changed'], result['skipped']), (1, 3))
+        self.assertEqual(sorted(result['skipped_ids']), [shipped.id, cancelled.id, unpaid.id])
+        self.assertEqual(dict(Order.objects.filter(id__in=ids).values_list('id', 'status')), {
+            pending.id: 'shipped', shipped.id: 'shipped', cancelled.id: 'cancelled', unpaid.id: 'pending',
+        })
+        self.assertGreaterEqual(Order.objects.get(id=pending.id).updated, before)
+        log = OrderTransition.objects.get()
+        self.assertEqual((log.order_id, log.from_status, log.to_status, log.source), (pending.id, 'pending', 'shipped', 'test'))
+
+    def test_cancel_restocks_reserved_and_sold_units(self):
+        unpaid = self.order((self.a, 3), (self.b, 1))
+        paid = self.order((self.a, 2))
+        order_status.transition([paid.id], 'mark_paid')
+        self.assertEqual(self.stock(), [(5, 3), (9, 1)])
+        self.assertFalse(paid.reservations.exists())
+        result = order_status.transition(Order.objects.all(), 'cancel', batch_size=1)
+        self.assertEqual((result['changed'], result['units_restocked']), (2, 6))
+        self.assertEqual(self.stock(), [(10, 0), (10, 0)])
+        self.assertFalse(StockReservation.objects.exists())
+        # Cancelling again is refused, so nothing is restocked twice
+        self.assertEqual(order_status.transition(Order.objects.all(), 'cancel')['skipped'], 2)
+        self.assertEqual(self.stock(), [(10, 0), (10, 0)])
+
+    def test_batches_count_each_order_once(self):
+        orders = [self.order((self.a, 1)) for i in range(3)]
+        ids = [order.id for order in orders]
+        result = order_status.transition(ids + ids[:2], 'process', batch_size=2)
+        self.assertEqual((result['orders'], result['changed']), (3, 3))
+        # A queryset the move empties as it goes still reaches every order
+        result = order_status.transition(Order.objects.filter(status='processing'), 'cancel', batch_size=1)
+        self.assertEqual((result['orders'], result['changed']), (3, 3))
+
+    def test_admin_actions_and_command(self):
+        orders = [self.order((self.a, 1)) for i in range(3)]
+        Order.objects.filter(id=orders[2].id).update(status='cancelled')
+        # The customer paid for the first; the second is marked paid in the admin
+        self.client.force_login(self.user)
+        self.client.post(reverse('gadget_cave:confirm_payment', args=[orders[0].id]))
+        self.assertEqual(Order.objects.get(id=orders[0].id).payment_status, 'completed')
+        admin_user = CustomUser.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.force_login(admin_user)
+        self.client.post(reverse('admin:gadget_cave_order_changelist'), {'action': 'make_paid', '_selected_action': [orders[1].id]})
+        self.assertFalse(StockReservation.objects.filter(order=orders[1]).exists())
+        response = self.client.post(reverse('admin:gadget_cave_order_changelist'), {
+            'action': 'mark_as_shipped', '_selected_action': [order.id for order in orders],
+        }, follow=True)
+        self.assertContains(response, '2 orders were successfully marked as shipped.')
+        self.assertContains(response, '1 orders were skipped')
+        self.assertEqual(OrderTransition.objects.filter(user=admin_user, source='admin', action='ship').count(), 2)
+
+        out = StringIO()
+        call_command('transition_orders', 'deliver', '--status', 'shipped', '--json', stdout=out)
+        self.assertEqual(json.loads(out.getvalue())['changed'], 2)
+        self.assertEqual(Order.objects.filter(status='delivered').count(), 2)
+
+
+class StockContentionTests(TransactionTestCase):
+    def test_concurrent_checkouts_never_oversell(self):
+        category = Category.objects.create(name='Hot', slug='hot')
+        product = Product.objects.create(category=category, name='Hot', slug='hot', price='10.00', stock=25)
+        result = stock_contention(product.id, workers=6, attempts=8)
+        self.assertFalse(result['oversold'], result)
+        self.assertEqual(result['units_sold'], result['orders'])
+        self.assertEqual(result['orders'] + result['rejected'] + result['errors'], result['attempts'])
+        self.assertEqual(result['final_stock'], 25 - result['orders'])
+
+
+class ReservationExpiryTests(TestCase):
+    def setUp(self):
+        make_catalog(products=2)
+        self.a, self.b = Product.objects.order_by('id')
+        self.user = CustomUser.objects.create_user('buyer', password='pw')
+        self.client.force_login(self.user)
+
+    def order(self, *lines):
+        order = Order(user=self.user, first_name='A', last_name='B', email='a@example.com',
+                      address='x', city='y', postal_code='1')
+        return place_order(order, [(product, quantity, product.price) for product, quantity in lines])
+
+    def stock(self):
+        return list(Product.objects.order_by('id').values_list('stock', 'reserved'))
+
+    def test_reaper_releases_only_expired_unpaid_orders(self):
+        expired = self.order((self.a, 3), (self.b, 1))
+        paid = self.order((self.a, 2))
+        fresh = self.order((self.b, 4))
+        self.client.post(reverse('gadget_cave:confirm_payment', args=[paid.id]))
+        later = timezone.now() + timedelta(minutes=31)
+        Order.objects.filter(id__in=[expired.id, paid.id]).update(created=timezone.now() - timedelta(minutes=31))
+        StockReservation.objects.filter(order=fresh).update(expires_at=later + timedelta(minutes=30))
+        self.assertEqual(release_expired_reservations(batch_size=1, now=later), (1, 4))
+        self.assertEqual(self.stock(), [(8, 0), (6, 4)])
+        expired.refresh_from_db()
+        self.assertEqual((expired.status, expired.payment_status), ('cancelled', 'failed'))
+        self.assertFalse(expired.reservations.exists())
+        self.assertEqual(release_expired_reservations(now=later), (0, 0))
+
+    def test_payment_after_expiry_is_refused(self):
+        order = self.order((self.a, 1))
+        StockReservation.objects.filter(order=order).update(expires_at=timezone.now())
+        Order.objects.filter(id=order.id).update(created=timezone.now() - timedelta(hours=1))
+        call_command('reap_reservations', stdout=StringIO())
+        response = self.client.post(reverse('gadget_cave:confirm_payment', args=[order.id]), {'upi_transaction_id': 'T1'})
+        self.assertRedirects(response, reverse('gadget_cave:my_orders'))
+        order.refresh_from_db()
+        self.assertFalse(order.paid)
+        self.assertEqual(self.stock(), [(10, 0), (10, 0)])
+
+
+class FragmentCacheTests(TestCase):
+    def setUp(self):
+        catalog_cache().clear()
+        fragment_stats.reset()
+        self.categories = make_catalog(products=4)
+        self.product = Product.objects.order_by('id').first()
+
+    def tearDown(self):
+        catalog_cache().clear()
+
+    def test_listing_hits_skip_category_query(self):
+        home = reverse('gadget_cave:home')
+        self.client.get(home)
+        with self.assertNumQueries(1):  # products only; the category sidebar is cached
+            response = self.client.get(home)
+        self.assertContains(response, 'Category 0')
+        stats = fragment_stats.snapshot()
+        self.assertEqual(stats['category_list'], {'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+        self.assertEqual(stats['product_card']['hits'], 4)
+
+        self.categories[0].name = 'Renamed'
+        self.categories[0].save()
+        self.assertContains(self.client.get(home), 'Renamed')
+
+    def test_product_save_and_image_changes_invalidate(self):
+        url = self.product.get_absolute_url()
+        self.client.get(url)
+        with self.assertNumQueries(0):  # product bundle and gallery are both cached
+            self.client.get(url)
+        image = ProductImage.objects.create(product=self.product, image='products/extra/new.jpg')
+        self.assertContains(self.client.get(url), 'products/extra/new.jpg')
+        image.delete()
+        self.assertNotContains(self.client.get(url), 'products/extra/new.jpg')
+
+        self.product.name = 'Fresh Name'
+        self.product.save()
+        self.assertContains(self.client.get(reverse('gadget_cave:home')), 'Fresh Name')
+
+    def test_works_with_file_backend(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as location:
+            backend = {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}}
+            with override_settings(CACHES=backend):
+                self.test_product_save_and_image_changes_invalidate()
+
+    def test_stats_endpoint_is_staff_only(self):
+        url = reverse('gadget_cave:cache_stats')
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.force_login(CustomUser.objects.create_superuser('ops', password='pw'))
+        self.assertIn('fragments', self.client.get(url).json())
+
+
+class ObjectCacheTests(TestCase):
+    def setUp(self):
+        catalog_cache().clear()
+        self.category, = make_catalog(products=2, categories=1)
+        self.product = Product.objects.order_by('id').first()
+        self.url = self.product.get_absolute_url()
+
+    def tearDown(self):
+        catalog_cache().clear()
+
+    def test_dead_urls_are_cached(self):
+        dead = reverse('gadget_cave:product_detail', args=[999, 'nope'])
+        self.assertEqual(self.client.get(dead).status_code, 404)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(dead).status_code, 404)
+        dead_category = reverse('gadget_cave:product_list_by_category', args=['no-such-category'])
+        self.assertEqual(self.client.get(dead_category).status_code, 404)
+        with self.assertNumQueries(0):  # answered from the cached category list
+            self.assertEqual(self.client.get(dead_category).status_code, 404)
+        # Creating the product bumps its generation, so the cached 404 is ignored
+        Product.objects.create(id=999, category=self.category, name='New', slug='nope', price='1.00', stock=1)
+        self.assertEqual(self.client.get(dead).status_code, 200)
+
+    def test_unavailable_then_available(self):
+        self.product.available = False
+        self.product.save()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.product.available = True
+        self.product.save()
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+    def test_stock_and_category_changes_invalidate(self):
+        self.client.get(self.url)
+        order = Order(first_name='A', last_name='B', email='a@example.com', address='x', city='y', postal_code='1')
+        with self.captureOnCommitCallbacks(execute=True):
+            place_order(order, [(self.product, 4, self.product.price)])
+        self.assertContains(self.client.get(self.url), 'In Stock (6 items left)')
+        self.category.name = 'Wearables'
+        self.category.save()
+        self.assertContains(self.client.get(self.url), 'Wearables')
+
+
+def make_jpeg(size=(800, 600), color='red', exif=None):
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'JPEG', **({'exif': exif} if exif else {}))
+    return ContentFile(buffer.getvalue(), name='photo.jpg')
+
+
+class RenditionTests(TestCase):
+    def setUp(self):
+        catalog_cache().clear()
+        self.media_root = tempfile.mkdtemp()
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.category, = make_catalog(products=1, categories=1)
+        self.product = Product.objects.get()
+        self.product.main_image.save('photo.jpg', make_jpeg())
+
+    def test_renditions_are_content_addressed(self):
+        manifest = generate_renditions(self.product.main_image.name)
+        # Never upscaled past the 800px original
+        self.assertEqual([width for width, path in manifest['webp']], [160, 320, 640])
+        for fmt in ('webp', 'jpeg'):
+            for width, path in manifest[fmt]:
+                with default_storage.open(path) as f, Image.open(f) as image:
+                    self.assertEqual(image.size, (width, width * 3 // 4))
+                    self.assertEqual(image.format, fmt.upper())
+        # The same bytes uploaded again share the renditions
+        ProductImage.objects.create(product=self.product, image=make_jpeg())
+        image = ProductImage.objects.get()
+        self.assertNotEqual(image.image.name, self.product.main_image.name)
+        self.assertEqual(generate_renditions(image.image.name), manifest)
+        small = generate_renditions(default_storage.save('tiny.jpg', make_jpeg((100, 50))))
+        self.assertEqual([width for width, path in small['jpeg']], [100])
+
+    def test_listing_renders_srcset_lazily(self):
+        Task.objects.all().delete()  # just the renditions, not the upload processing
+        name = self.product.main_image.name
+        # Without renditions the page shows the original, decoding and writing nothing
+        response = self.client.get(reverse('gadget_cave:home'))
+        self.assertContains(response, self.product.main_image.url)
+        self.assertIsNone(get_manifest(name))
+        self.assertFalse(default_storage.exists('renditions'))
+        self.assertFalse(Task.objects.exists())
+        call_command('backfill_renditions', queue=True, stdout=StringIO())
+        self.assertEqual(Task.objects.get().payload, {'name': name})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(run_worker(once=True)['done'], 1)
+        # The manifest is in storage, for processes that never cached it
+        catalog_cache().clear()
+        response = self.client.get(reverse('gadget_cave:home'))
+        manifest = get_manifest(name)
+        self.assertIsNotNone(manifest)
+        self.assertContains(response, 'type="image/webp"')
+        self.assertContains(response, default_storage.url(manifest['webp'][0][1]) + ' 160w')
+        self.assertNotContains(response, self.product.main_image.url)
+
+    def test_backfill_command(self):
+        ProductImage.objects.create(product=self.product, image=make_jpeg(color='blue'))
+        broken = ProductImage.objects.create(product=self.product, image=ContentFile(b'not an image', name='x.jpg'))
+        out, err = StringIO(), StringIO()
+        call_command('backfill_renditions', workers=1, stdout=out, stderr=err)
+        self.assertIn('Rendered 2 images (1 failed)', out.getvalue())
+        self.assertIn(broken.image.name, err.getvalue())
+        self.assertIsNotNone(get_manifest(self.product.main_image.name))
+        # Stored manifests are skipped in the next run, whatever its cache holds
+        catalog_cache().clear()
+        out = StringIO()
+        call_command('backfill_renditions', workers=1, stdout=out, stderr=StringIO())
+        self.assertIn('Rendered 0 images (1 failed)', out.getvalue())
+        # Unreadable uploads fall back to the original file
+        self.assertEqual(self.client.get(self.product.get_absolute_url()).status_code, 200)
+
+
+flaky_calls = []
+
+
+@task('test.flaky')
+def flaky(fail_times):
+    flaky_calls.append(fail_times)
+    # Writes from a failed attempt are rolled back
+    Category.objects.create(name=f'Flaky {len(flaky_calls)}', slug=f'flaky-{len(flaky_calls)}')
+    if len(flaky_calls) <= fail_times:
+        raise RuntimeError('try again')
+
+
+class TaskQueueTests(TestCase):
+    def setUp(self):
+        flaky_calls.clear()
+
+    def run_due(self):
+        Task.objects.filter(status='queued').update(run_after=timezone.now())
+        return run_worker(once=True)
+
+    def test_enqueue_is_idempotent(self):
+        first = enqueue('test.flaky', {'fail_times': 0}, key='flaky:1')
+        self.assertEqual(enqueue('test.flaky', {'fail_times': 5}, key='flaky:1'), first)
+        self.assertEqual(run_worker(once=True), {'done': 1, 'queued': 0, 'failed': 0})
+        enqueue('test.flaky', {'fail_times': 0}, key='flaky:1')
+        self.assertEqual(run_worker(once=True)['done'], 0)
+        self.assertEqual(len(flaky_calls), 1)
+
+    def test_retries_with_backoff_then_fails(self):
+        enqueue('test.flaky', {'fail_times': 1}, key='retry')
+        self.assertEqual(run_worker(once=True)['queued'], 1)
+        retry = Task.objects.get(key='retry')
+        self.assertGreater(retry.run_after, timezone.now())
+        self.assertEqual((retry.attempts, retry.last_error), (1, 'RuntimeError: try again'))
+        self.assertEqual(run_worker(once=True)['done'], 0)  # not due yet
+        self.assertEqual(self.run_due()['done'], 1)
+        self.assertEqual(list(Category.objects.filter(slug__startswith='flaky').values_list('slug', flat=True)), ['flaky-2'])
+
+        enqueue('test.flaky', {'fail_times': 99}, key='doomed', max_attempts=2)
+        self.run_due()
+        self.assertEqual(self.run_due()['failed'], 1)
+        self.assertEqual(Task.objects.get(key='doomed').status, 'failed')
+
+    def test_expired_lease_is_reclaimed(self):
+        enqueue('test.flaky', {'fail_times': 0}, key='lease')
+        Task.objects.update(status='running', locked_by='dead-worker', locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(run_worker(once=True)['done'], 1)
+        self.assertEqual(Task.objects.get().attempts, 1)
+
+
+class ImageProcessingTests(TestCase):
+    def setUp(self):
+        catalog_cache().clear()
+        self.media_root = tempfile.mkdtemp()
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, self.media_root)
+        make_catalog(products=1, categories=1)
+        self.product = Product.objects.get()
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: rotate 90 degrees clockwise
+        exif[0x010F] = 'Camera Maker'
+        self.product.main_image = make_jpeg((3000, 1000), exif=exif.tobytes())
+        self.product.save()
+
+    def test_upload_is_processed_in_the_background(self):
+        original = self.product.main_image.name
+        self.assertEqual(Task.objects.get().status, 'queued')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(run_worker(once=True)['done'], 1)
+        self.product.refresh_from_db()
+        processed = self.product.main_image.name
+        self.assertNotEqual(processed, original)
+        self.assertFalse(default_storage.exists(original))
+        with default_storage.open(processed) as f, Image.open(f) as image:
+            # Rotated upright, scaled to fit 2048px, EXIF gone
+            self.assertEqual(image.size, (683, 2048))
+            self.assertFalse(image.getexif())
+        self.assertIsNotNone(get_manifest(processed))
+        # Saving the product again doesn't process the file a second time
+        self.product.save()
+        self.assertEqual(run_worker(once=True)['done'], 0)
+
+        CustomUser.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+        response = self.client.get(reverse('admin:gadget_cave_product_changelist'))
+        self.assertContains(response, '<span class="badge badge-success">done</span>', html=True)
+
+    def test_replaced_upload_is_skipped(self):
+        self.product.main_image = make_jpeg(color='blue')
+        self.product.save()
+        self.assertEqual(run_worker(once=True)['done'], 2)
+        self.product.refresh_from_db()
+        with default_storage.open(self.product.main_image.name) as f, Image.open(f) as image:
+            self.assertEqual(image.size, (800, 600))
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        catalog_cache().clear()
+        self.watches = Category.objects.create(name='Watches', slug='watches')
+        self.audio = Category.objects.create(name='Audio', slug='audio')
+
+        def create(name, category, description='', **fields):
+            return Product.objects.create(
+                category=category, name=name, slug=name.lower().replace(' ', '-'),
+                description=description, price='999.00', stock=5, **fields
+            )
+        self.ultra = create('Apple Watch Ultra', self.watches, 'Titanium case')
+        self.band = create('Sport Band', self.watches, 'Fits the Apple Watch')
+        self.buds = create('Apple AirPods', self.audio, 'Wireless earbuds')
+        self.hidden = create('Apple Watch Prototype', self.watches, available=False)
+
+    def test_ranked_results_and_facets_in_one_query(self):
+        search('apple')  # warm the cached category list
+        with self.assertNumQueries(2):  # ranked hits + facet counts, then the products
+            results = search('apple watch')
+        # A name match outranks a description match; unavailable products are left out
+        self.assertEqual(list(results), [self.ultra, self.band])
+        self.assertEqual(results.facets, [(self.watches, 2)])
+        results = search('apple', category=self.audio)
+        self.assertEqual((list(results), results.total, results.match_count), ([self.buds], 1, 3))
+        self.assertEqual(list(search('"ultra" *)')), [self.ultra])  # query syntax is not passed through
+
+    def test_prefix_matches_names(self):
+        self.assertEqual(list(search('apple wat', prefix=True)), [self.ultra])
+        self.assertEqual(list(search('wat')), [])
+        response = self.client.get(reverse('gadget_cave:product_search_api'), {'q': 'airp'})
+        self.assertEqual([r['name'] for r in response.json()['results']], ['Apple AirPods'])
+
+    def test_index_follows_product_changes(self):
+        self.buds.name = 'Galaxy Buds'
+        self.buds.save()
+        self.assertEqual(list(search('galaxy')), [self.buds])
+        self.assertEqual(list(search('airpods')), [])
+        self.ultra.delete()
+        self.assertEqual(list(search('titanium')), [])
+        Product.objects.filter(pk=self.band.pk).update(name='Loop')  # bypasses the signals...
+        self.assertEqual(rebuild_index(), 3)  # ...until the index is rebuilt
+        self.assertEqual(list(search('loop')), [self.band])
+
+    def test_storefront_and_admin_search(self):
+        response = self.client.get(reverse('gadget_cave:product_search'), {'q': 'apple', 'category': 'watches'})
+        self.assertContains(response, 'Apple Watch Ultra')
+        self.assertNotContains(response, 'Apple AirPods')
+        self.assertContains(response, '?q=apple&amp;category=audio')
+        admin = CustomUser.objects.create_superuser('admin', password='pw')
+        self.client.force_login(admin)
+        def admin_search(q):
+            response = self.client.get(reverse('admin:gadget_cave_product_changelist'), {'q': q})
+            return sorted(response.context['cl'].result_list, key=lambda p: p.id)
+        self.assertEqual(admin_search('apple wat'), [self.ultra, self.band, self.hidden])
+        # Descriptions are searched too, and what the index can't match falls back to a scan
+        self.assertEqual(admin_search('titanium'), [self.ultra])
+        self.assertEqual(admin_search('atch ultr'), [self.ultra])
+
+
+class AutocompleteTests(TestCase):
+    def setUp(self):
+        self.addCleanup(setattr, autocomplete, 'index', autocomplete.index)
+        autocomplete.index = autocomplete.PrefixIndex()
+        self.watches = Category.objects.create(name='Watches', slug='watches')
+        self.ultra = Product.objects.create(category=self.watches, name='Apple Watch Ultra', slug='ultra', price=1, stock=1)
+        self.strap = Product.objects.create(category=self.watches, name='Watch Strap', slug='strap', price=1, stock=1)
+        Product.objects.create(category=self.watches, name='Watch Prototype', slug='proto', price=1, stock=1, available=False)
+        autocomplete.index.refresh()  # what the background thread does at startup
+        self.url = reverse('gadget_cave:autocomplete')
+
+    def labels(self, q):
+        return [s['label'] for s in self.client.get(self.url, {'q': q}).json()['suggestions']]
+
+    def test_suggestions_come_from_memory(self):
+        self.assertEqual(self.labels('wat'), ['Watches', 'Watch Strap', 'Apple Watch Ultra'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.labels('Ápple  W'), ['Apple Watch Ultra'])
+            self.assertEqual(self.labels('ultra'), ['Apple Watch Ultra'])
+            self.assertEqual(self.labels('xyz'), [])
+        response = self.client.get(self.url, {'q': 'strap'})
+        self.assertEqual(response.json()['suggestions'][0]['url'], self.strap.get_absolute_url())
+
+    def test_categories_rank_first_for_short_prefixes(self):
+        Product.objects.bulk_create([
+            Product(category=self.watches, name=f'Wallet {i}', slug=f'wallet-{i}', price=1, stock=1) for i in range(40)
+        ])
+        autocomplete.index.request_sync()
+        autocomplete.index.refresh()
+        # Forty "wallet ..." keys sort ahead of "watches"
+        self.assertEqual(self.labels('wa')[0], 'Watches')
+
+    def test_signals_update_the_index(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.strap.name = 'Milanese Loop'
+            self.strap.save()
+            self.ultra.available = False
+            self.ultra.save()
+            Category.objects.create(name='Audio', slug='audio')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.labels('wat'), ['Watches'])
+            self.assertEqual(self.labels('loop'), ['Milanese Loop'])
+            self.assertEqual(self.labels('au'), ['Audio'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.strap.delete()
+        self.assertEqual(self.labels('milanese'), [])
+
+    def test_sync_picks_up_changes_from_other_processes(self):
+        # Written without signals, as by another process
+        Product.objects.filter(pk=self.strap.pk).update(name='Sport Loop', updated=timezone.now())
+        autocomplete.index.request_sync()
+        # Requests never sync themselves, however overdue
+        with self.assertNumQueries(0):
+            self.assertEqual(self.labels('sport'), [])
+        autocomplete.index.refresh()
+        self.assertEqual(self.labels('sport'), ['Sport Loop'])
+
+
+class AutocompleteRefreshTests(TransactionTestCase):
+    def test_background_thread_builds_and_syncs(self):
+        watches = Category.objects.create(name='Watches', slug='watches')
+        prefix_index = autocomplete.PrefixIndex()
+        prefix_index.start()
+        self.addCleanup(prefix_index.stop)
+        self.assertTrue(self.wait_for(lambda: prefix_index.lookup('wat')))
+        Product.objects.create(category=watches, name='Watch Strap', slug='strap', price=1, stock=1)
+        prefix_index.request_sync()
+        self.assertTrue(self.wait_for(lambda: len(prefix_index.lookup('wat')) == 2))
+
+    def wait_for(self, condition, seconds=5):
+        deadline = time.monotonic() + seconds
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+
+CATALOG_CSV = """category,category_name,name,slug,description,price,stock,available,image,images
+audio,Audio,Sony Speaker,,Loud wireless speaker,4999,5,yes,speaker.jpg,
+audio,,Boat Earbuds,boat-earbuds,,1499.50,12,0,,a.jpg|b.jpg
+audio,,Broken Row,,,not-a-price,1,1,,
+watches,Watches,Apple Watch,apple-watch,,41900,3,,missing.jpg,
+"""
+
+
+class CatalogImportTests(TestCase):
+    def setUp(self):
+        catalog_cache().clear()
+        self.media_root = tempfile.mkdtemp()
+        self.images_dir = tempfile.mkdtemp()
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, CATALOG_IMPORT_IMAGES_DIR=self.images_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.addCleanup(shutil.rmtree, self.images_dir)
+        for name, color in (('speaker.jpg', 'red'), ('a.jpg', 'green'), ('b.jpg', 'blue')):
+            with open(os.path.join(self.images_dir, name), 'wb') as f:
+                f.write(make_jpeg(color=color).read())
+
+    def import_csv(self, text=CATALOG_CSV, **kwargs):
+        return catalog_io.import_catalog(StringIO(text), 'csv', self.images_dir, **kwargs)
+
+    def test_upserts_in_chunks_and_skips_bad_rows(self):
+        result = self.import_csv(chunk_size=2)
+        self.assertEqual((result['rows'], result['created'], result['categories'], result['images'], result['errors']), (3, 3, 2, 3, 2))
+        self.assertTrue(result['error_messages'][0].startswith('line 4: price:'))
+        self.assertIn('missing.jpg', result['error_messages'][1])
+        speaker = Product.objects.get(slug='sony-speaker')
+        self.assertEqual((speaker.category.name, speaker.price, speaker.available), ('Audio', Decimal('4999'), True))
+        self.assertTrue(speaker.main_image.name.startswith('products/import/'))
+        earbuds = Product.objects.get(slug='boat-earbuds')
+        self.assertFalse(earbuds.available)
+        self.assertEqual(earbuds.images.count(), 2)
+        self.assertEqual(list(search('speaker')), [speaker])
+        # bulk_create sends no signals; the images are queued all the same
+        self.assertEqual(Task.objects.filter(name='process_image').count(), 3)
+
+        # Running the file again updates in place and copies no image twice,
+        # even after processing renamed the files
+        run_worker(once=True)
+        result = self.import_csv(CATALOG_CSV.replace('4999', '3999'))
+        self.assertEqual((result['rows'], result['created'], result['updated'], result['images']), (3, 0, 3, 0))
+        self.assertEqual(Product.objects.count(), 3)
+        self.assertEqual(ProductImage.objects.count(), 2)
+        self.assertEqual(Product.objects.get(slug='sony-speaker').price, Decimal('3999'))
+
+    def test_sku_conflicts_are_row_errors(self):
+        self.import_csv()
+        Product.objects.filter(slug='apple-watch').update(sku='AW-1')
+        header = 'category,name,slug,sku,price\n'
+        result = self.import_csv(header + (
+            'audio,Sony Speaker,sony-speaker,AW-1,10\n'  # another product's
+            'audio,Boat Earbuds,boat-earbuds,BE-1,10\n'
+            'audio,New Earbuds,new-earbuds,BE-1,10\n'  # taken a row earlier
+            'watches,Apple Watch,apple-watch,AW-1,10\n'
+        ), chunk_size=2)
+        self.assertEqual((result['rows'], result['errors']), (2, 2))
+        self.assertEqual(result['error_messages'], [
+            "line 2: sku: 'AW-1' already belongs to the product 'apple-watch'",
+            "line 4: sku: 'BE-1' already belongs to the product 'boat-earbuds'",
+        ])
+        self.assertEqual(dict(Product.objects.exclude(sku=None).values_list('slug', 'sku')), {'apple-watch': 'AW-1', 'boat-earbuds': 'BE-1'})
+        self.assertFalse(Product.objects.filter(slug='new-earbuds').exists())
+        # Two new products with one SKU in a chunk: the first row gets it
+        result = self.import_csv(header + 'audio,One,one,X-1,10\naudio,Two,two,X-1,10\n')
+        self.assertEqual(result['error_messages'], ["line 3: sku: 'X-1' already belongs to the product 'one'"])
+        self.assertEqual(Product.objects.get(sku='X-1').slug, 'one')
+
+    def test_queries_do_not_grow_with_rows(self):
+        rows = ''.join(f'audio,Audio,Product {i},,,{100 + i},1,1,,\n' for i in range(60))
+        text = CATALOG_CSV.splitlines(keepends=True)[0] + rows
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.import_csv(text)['created'], 60)
+        self.assertLess(len(queries), 15)
+
+    def test_export_round_trip_and_commands(self):
+        self.import_csv()
+        out = StringIO()
+        call_command('export_catalog', '--format', 'jsonl', stdout=out)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        rows = {row['slug']: row for row in rows}
+        self.assertEqual(sorted(rows), ['apple-watch', 'boat-earbuds', 'sony-speaker'])
+        self.assertEqual(len(rows['boat-earbuds']['images']), 2)
+        path = os.path.join(self.images_dir, 'catalog.jsonl')
+        with open(path, 'w') as f:
+            f.write(out.getvalue().replace('Sony Speaker', 'Sony Speaker XB'))
+        out = StringIO()
+        call_command('import_catalog', path, '--images-dir', self.media_root, stdout=out)
+        self.assertIn('Imported 3 products (0 new, 3 updated)', out.getvalue())
+        self.assertEqual(ProductImage.objects.count(), 2)
+        self.assertTrue(Product.objects.filter(name='Sony Speaker XB').exists())
+
+    def test_stock_is_on_hand_with_reservations(self):
+        self.import_csv()
+        speaker = Product.objects.get(slug='sony-speaker')
+        order = Order(first_name='A', last_name='B', email='a@example.com', address='x', city='y', postal_code='1')
+        place_order(order, [(speaker, 2, speaker.price)])
+        stock = Product.objects.values_list('stock', 'reserved')
+        # The file's 5 are on hand: importing it again leaves the 2 reserved units off the stock to sell
+        self.import_csv()
+        self.assertEqual(stock.get(pk=speaker.pk), (3, 2))
+        # Exports count the reserved units as on hand, so a round trip changes nothing
+        rows = [json.loads(line) for line in catalog_io.export_catalog('jsonl')]
+        self.assertEqual(next(row['stock'] for row in rows if row['slug'] == 'sony-speaker'), 5)
+        catalog_io.import_catalog(StringIO(''.join(json.dumps(row) + '\n' for row in rows)), 'jsonl', self.media_root)
+        self.assertEqual(stock.get(pk=speaker.pk), (3, 2))
+        order_status.transition([order.id], 'cancel')
+        self.assertEqual(stock.get(pk=speaker.pk), (5, 0))
+
+    def test_admin_export_and_import(self):
+        CustomUser.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+        changelist = reverse('admin:gadget_cave_product_changelist')
+        upload = ContentFile(CATALOG_CSV.encode(), name='catalog.csv')
+        response = self.client.post(reverse('admin:gadget_cave_product_import'), {'file': upload})
+        self.assertRedirects(response, changelist)
+        run_worker(once=True)
+        self.assertEqual(Product.objects.count(), 3)
+        self.assertFalse(os.listdir(os.path.join(self.media_root, 'imports')))
+
+        response = self.client.post(changelist, {
+            'action': 'export_csv', '_selected_action': Product.objects.filter(category__slug='audio').values_list('pk', flat=True),
+        })
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], ','.join(catalog_io.COLUMNS))
+        self.assertEqual(len(lines), 3)
+
+
+class InventoryFeedTests(TestCase):
+    def setUp(self):
+        catalog_cache().clear()
+        make_catalog(products=3, categories=1)
+        self.products = list(Product.objects.order_by('id'))
+        for i, product in enumerate(self.products):
+            Product.objects.filter(pk=product.pk).update(sku=f'SKU-{i}', price=Decimal('100.00'), stock=10)
+        self.stamps = dict(Product.objects.values_list('sku', 'updated'))
+
+    def tearDown(self):
+        catalog_cache().clear()
+
+    def test_feed_writes_only_real_changes(self):
+        feed = (
+            'sku,price,stock,available\n'
+            'SKU-0,120,,\n'        # price only
+            'SKU-1,100.00,10,1\n'  # no change
+            'SKU-2,,0,no\n'        # stock and availability
+            'SKU-9,1,1,1\n'
+            'SKU-1,free,,\n'
+        )
+        self.client.get(self.products[2].get_absolute_url())
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as queries:
+            result = inventory_feed.apply_feed(StringIO(feed), 'csv', source='nightly')
+        self.assertEqual((result['rows'], result['changed'], result['changes'], result['unknown'], result['errors']), (4, 2, 3, 1, 1))
+        self.assertEqual(result['unknown_keys'], ['SKU-9'])
+        # The diff is one query, and each combination of changed fields one UPDATE
+        self.assertEqual(sum(q['sql'].startswith('UPDATE "gadget_cave_product"') for q in queries), 2)
+        self.assertEqual(sum('FROM "gadget_cave_product"' in q['sql'] and q['sql'].startswith('SELECT') for q in queries), 1)
+
+        products = {p.sku: p for p in Product.objects.all()}
+        self.assertEqual(products['SKU-0'].price, Decimal('120'))
+        self.assertEqual((products['SKU-2'].stock, products['SKU-2'].available), (0, False))
+        self.assertEqual(products['SKU-1'].updated, self.stamps['SKU-1'])
+        self.assertNotEqual(products['SKU-0'].updated, self.stamps['SKU-0'])
+        self.assertEqual(
+            sorted(InventoryChange.objects.values_list('product__sku', 'field', 'old_value', 'new_value', 'source')),
+            [('SKU-0', 'price', '100.00', '120', 'nightly'),
+             ('SKU-2', 'available', 'True', 'False', 'nightly'),
+             ('SKU-2', 'stock', '10', '0', 'nightly')],
+        )
+        # The cached product page went with the update
+        self.assertEqual(self.client.get(self.products[2].get_absolute_url()).status_code, 404)
+
+    def test_feed_stock_is_on_hand(self):
+        order = Order(first_name='A', last_name='B', email='a@example.com', address='x', city='y', postal_code='1')
+        place_order(order, [(self.products[0], 3, self.products[0].price), (self.products[1], 4, self.products[1].price)])
+        # 3 units of SKU-0 are held for the unpaid order, so the 10 on hand leave 7 to sell, as now
+        result = inventory_feed.update_products({'SKU-0': {'stock': 10}, 'SKU-1': {'stock': 2}, 'SKU-2': {'stock': 12}}, source='nightly')
+        self.assertEqual(result['changes'], 2)
+        stock = dict(Product.objects.values_list('sku', 'stock'))
+        self.assertEqual((stock['SKU-0'], stock['SKU-1'], stock['SKU-2']), (7, 0, 12))
+        change = InventoryChange.objects.get(product__sku='SKU-1')
+        self.assertEqual((change.old_value, change.new_value, change.on_hand), ('6', '0', 2))
+        # Cancelling gives the held units back: on hand again, not counted twice
+        order_status.transition([order.id], 'cancel')
+        self.assertEqual(Product.objects.get(sku='SKU-0').stock, 10)
+
+    def test_command(self):
+        path = os.path.join(tempfile.mkdtemp(), 'feed.jsonl')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('{"sku": "SKU-0", "stock": 3}\n{"sku": "SKU-1", "stock": 10}\n')
+        out = StringIO()
+        call_command('apply_inventory_feed', path, stdout=out)
+        self.assertIn('Read 2 SKUs', out.getvalue())
+        self.assertIn('1 products changed (1 fields)', out.getvalue())
+
+    def test_list_editable_is_one_bulk_update(self):
+        admin_user = CustomUser.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+        data = {'form-TOTAL_FORMS': 3, 'form-INITIAL_FORMS': 3, '_save': 'Save'}
+        for i, product in enumerate(self.products):
+            data.update({f'form-{i}-id': product.pk, f'form-{i}-price': '100.00', f'form-{i}-stock': 10 + i, f'form-{i}-available': 'on'})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('admin:gadget_cave_product_changelist'), data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(sum(q['sql'].startswith('UPDATE "gadget_cave_product"') for q in queries), 1)
+        self.assertEqual(list(Product.objects.order_by('id').values_list('stock', flat=True)), [10, 11, 12])
+        self.assertEqual(InventoryChange.objects.filter(user=admin_user, source='admin').count(), 2)
+
+
+class GuestCartTests(TestCase):
+    def setUp(self):
+        self.category, = make_catalog(products=3, categories=1)
+        self.a, self.b, self.c = Product.objects.order_by('id')
+        self.user = CustomUser.objects.create_user('shopper', password='pw')
+
+    def add(self, product, quantity=1):
+        return self.client.post(reverse('gadget_cave:cart_add', args=[product.id]), {'quantity': quantity})
+
+    def test_guest_cart_makes_no_writes(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.add(self.a, 2)
+            self.add(self.b)
+            self.add(self.a)
+        self.assertEqual(len(ctx), 3)
+        self.assertTrue(all(q['sql'].startswith('SELECT') for q in ctx.captured_queries))
+        self.assertFalse(Cart.objects.exists() or CartItem.objects.exists())
+        self.assertIn('gadget_cave_cart', self.client.cookies)
+        self.assertNotIn('sessionid', self.client.cookies)
+
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('gadget_cave:cart_detail'))
+        self.assertEqual([(i.product, i.quantity) for i in response.context['cart_items']], [(self.a, 3), (self.b, 1)])
+        self.assertContains(response, self.a.name)
+
+        response = self.add(self.a, 8)  # 3 + 8 > stock of 10
+        self.assertEqual(response.status_code, 302)
+        self.client.get(reverse('gadget_cave:cart_remove', args=[self.b.id]))
+        response = self.client.get(reverse('gadget_cave:cart_detail'))
+        self.assertEqual([(i.product, i.quantity) for i in response.context['cart_items']], [(self.a, 3)])
+
+    def test_tampered_cookie_is_ignored(self):
+        self.add(self.a)
+        value = self.client.cookies['gadget_cave_cart'].value
+        self.client.cookies['gadget_cave_cart'] = value.replace(f'{self.a.id}:1', f'{self.a.id}:9')
+        response = self.client.get(reverse('gadget_cave:cart_detail'))
+        self.assertEqual(list(response.context['cart_items']), [])
+
+    def test_update_is_all_or_nothing(self):
+        cart = GuestCart({product_id: 1 for product_id in range(1, MAX_LINES + 1)})
+        with self.assertRaises(ValueError):
+            cart.update({1: 0, MAX_LINES + 1: 1, MAX_LINES + 2: 1})
+        self.assertEqual(len(cart.lines), MAX_LINES)
+        self.assertEqual(cart.quantity(1), 1)
+        self.assertFalse(cart.modified)
+        cart.update({1: 0, 2: 5, MAX_LINES + 1: 1})
+        self.assertEqual((len(cart.lines), cart.quantity(1), cart.quantity(2)), (MAX_LINES, 0, 5))
+        self.assertTrue(cart.modified)
+
+    def test_login_merges_into_the_user_cart(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.a, quantity=4)
+        self.add(self.a, 3)
+        self.add(self.c, 2)
+        response = self.client.post(reverse('gadget_cave:login'), {'username': 'shopper', 'password': 'pw'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            dict(cart.items.values_list('product', 'quantity')),
+            {self.a.id: 7, self.c.id: 2},
+        )
+        self.assertEqual(self.client.cookies['gadget_cave_cart'].value, '')  # deleted
+        # Capped at stock when the merged quantity would exceed it
+        self.client.logout()
+        self.add(self.a, 5)
+        self.client.post(reverse('gadget_cave:login'), {'username': 'shopper', 'password': 'pw'})
+        self.assertEqual(cart.items.get(product=self.a).quantity, 10)
+
+
+class CartServiceTests(TestCase):
+    def setUp(self):
+        make_catalog(products=3, categories=1)
+        self.a, self.b, self.c = Product.objects.order_by('id')
+        self.user = CustomUser.objects.create_user('shopper', password='pw')
+        self.cart = Cart.objects.create(user=self.user)
+
+    def lines(self):
+        return dict(self.cart.items.values_list('product', 'quantity'))
+
+    def test_add_increments_in_one_statement(self):
+        carts.add_item(self.user, self.a.id, 3)
+        with self.assertNumQueries(2):  # the cart, then the upsert
+            carts.add_item(self.user, self.a.id, 4)
+        self.assertEqual(self.lines(), {self.a.id: 7})
+        with self.assertRaises(InsufficientStock) as raised:
+            carts.add_item(self.user, self.a.id, 4)
+        self.assertEqual(raised.exception.shortfalls, [(self.a.id, 11, 10)])
+        self.assertEqual(self.lines(), {self.a.id: 7})
+
+        Product.objects.filter(id=self.b.id).update(available=False)
+        with self.assertRaises(InsufficientStock):
+            carts.add_item(self.user, self.b.id, 1)
+        carts.set_quantity(self.user, self.a.id, 2)
+        self.assertEqual(self.lines(), {self.a.id: 2})
+        with self.assertNumQueries(1):
+            self.assertEqual(carts.remove_item(self.user, self.a.id), 1)
+        self.assertEqual(carts.remove_item(self.user, self.a.id), 0)
+
+    def test_cart_views(self):
+        self.client.force_login(self.user)
+        url = reverse('gadget_cave:cart_add', args=[self.a.id])
+        self.client.post(url, {'quantity': 6})
+        self.client.post(url, {'quantity': 6})  # would make 12 of 10
+        self.client.post(url, {'quantity': 2, 'override': 'True'})
+        self.assertEqual(self.lines(), {self.a.id: 2})
+        response = self.client.get(reverse('gadget_cave:cart_remove', args=[self.a.id]), follow=True)
+        self.assertContains(response, f'{self.a.name} removed from your cart.')
+        self.assertEqual(self.client.get(reverse('gadget_cave:cart_remove', args=[self.a.id])).status_code, 404)
+
+    def update(self, items):
+        return self.client.post(reverse('gadget_cave:cart_update_api'), {'items': items}, content_type='application/json')
+
+    def test_batch_update(self):
+        CartItem.objects.create(cart=self.cart, product=self.c, quantity=1)
+        self.client.force_login(self.user)
+        response = self.update([
+            {'product': self.a.id, 'quantity': 2},
+            {'product': self.b.id, 'quantity': 3},
+            {'product': self.c.id, 'remove': True},
+        ])
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([(line['product'], line['quantity']) for line in data['items']], [(self.a.id, 2), (self.b.id, 3)])
+        self.assertEqual(data['item_count'], 5)
+        self.assertEqual(Decimal(data['total_cost']), self.a.price * 2 + self.b.price * 3)
+
+        # All or nothing
+        response = self.update([{'product': self.a.id, 'quantity': 0}, {'product': self.b.id, 'quantity': 11}])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['shortfalls'], [{'product': self.b.id, 'requested': 11, 'available': 10}])
+        self.assertEqual(self.lines(), {self.a.id: 2, self.b.id: 3})
+
+        self.assertEqual(self.update([{'product': self.a.id, 'quantity': -1}]).status_code, 400)
+        self.assertEqual(self.client.post(reverse('gadget_cave:cart_update_api'), 'nope', content_type='application/json').status_code, 400)
+        self.assertEqual(self.client.get(reverse('gadget_cave:cart_update_api')).status_code, 405)
+
+    def test_guest_batch_update(self):
+        response = self.update([{'product': self.a.id, 'quantity': 2}, {'product': self.b.id, 'quantity': 1}])
+        self.assertEqual(response.json()['item_count'], 3)
+        response = self.update([{'product': self.a.id, 'remove': True}])
+        self.assertEqual([line['product'] for line in response.json()['items']], [self.b.id])
+        self.assertFalse(CartItem.objects.exclude(cart=self.cart).exists())
+
+
+class CartSummaryTests(TestCase):
+    def setUp(self):
+        catalog_cache().clear()
+        make_catalog(products=3, categories=1)
+        self.a, self.b, self.c = Product.objects.order_by('id')
+        self.user = CustomUser.objects.create_user('shopper', password='pw')
+
+    def badge(self):
+        return self.client.get(reverse('gadget_cave:home')).context['cart_summary']
+
+    def test_summary_follows_cart_changes(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.badge()['count'], 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            carts.add_item(self.user, self.a.id, 2)
+            carts.apply_changes(self.user, {self.b.id: 3})
+        self.assertEqual(dict(self.badge()), {'count': 5, 'subtotal': self.a.price * 2 + self.b.price * 3})
+        # Warm: a page view reads the cache, never Cart or CartItem
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('gadget_cave:home'))
+        self.assertFalse([q for q in ctx.captured_queries if 'cart' in q['sql']])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            carts.remove_item(self.user, self.a.id)
+        self.assertEqual(self.badge()['count'], 3)
+
+        # A price change drops the summary; the next page view recomputes it
+        self.b.price = Decimal('1.00')
+        self.b.save()
+        self.assertEqual(dict(self.badge()), {'count': 3, 'subtotal': Decimal('3.00')})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            make_order(self.user, [self.b], quantity=3)
+            Cart.objects.get(user=self.user).items.all().delete()
+            carts.summary_changed(self.user.pk)
+        self.assertEqual(self.badge()['count'], 0)
+
+    def test_rolled_back_change_is_not_cached(self):
+        carts.refresh_summaries([self.user.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    carts.add_item(self.user, self.a.id, 2)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertEqual(carts.get_summary(self.user.pk)['count'], 0)
+
+    def test_guest_count_comes_from_the_cookie(self):
+        self.client.post(reverse('gadget_cave:cart_add', args=[self.a.id]), {'quantity': 2})
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('gadget_cave:home'))
+        self.assertEqual(response.context['cart_summary']['count'], 2)
+        self.assertContains(response, 'id="cartCount">2<')
+        self.assertFalse([q for q in ctx.captured_queries if 'cart' in q['sql']])
+
+
+class StorefrontLoadTests(TransactionTestCase):
+    def setUp(self):
+        make_catalog(products=6, categories=2)
+
+    def test_checkout_flow_through_the_client_and_a_server(self):
+        # One shopper: the in-memory test database doesn't take concurrent writers
+        for driver in ('client', 'wsgi'):
+            with self.subTest(driver=driver):
+                result = storefront_load(driver, shoppers=1, flows=2)
+                self.assertEqual(result['errors'], 0, result)
+                self.assertEqual(result['requests'], 2 * 8)
+                self.assertTrue(all(step['queries'] for step in result['steps'].values()))
+        self.assertEqual(Order.objects.filter(paid=True).count(), 2 * 3)
+
+    def test_regressions_against_a_baseline(self):
+        step = {'requests': 10, 'errors': 0, 'p50_ms': 10.0, 'p95_ms': 20.0, 'p99_ms': 30.0, 'queries': 4.0}
+        baseline = {'errors': 0, 'requests_per_s': 100.0, 'steps': {'home': step}}
+        same = {'errors': 0, 'requests_per_s': 90.0, 'steps': {'home': dict(step, p95_ms=23.0)}}
+        self.assertEqual(compare_to_baseline(same, baseline), [])
+        worse = {'errors': 1, 'requests_per_s': 50.0, 'steps': {'home': dict(step, queries=6.0, p50_ms=15.0)}}
+        self.assertEqual(len(compare_to_baseline(worse, baseline)), 4)
+
+    def test_connection_capacity(self):
+        result = connection_capacity('wsgi', connections=4, hold=0.3, probes=2)
+        self.assertEqual((result['completed'], result['errors'], result['probe_errors']), (4, 0, 0), result)
+        # A waiting WSGI request keeps its thread
+        self.assertGreater(result['peak_server_threads'], 4)
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        catalog_cache().clear()
+        make_catalog(products=3, categories=1)
+        metrics.registry.reset()
+
+    def test_server_timing_and_prometheus_export(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('gadget_cave:home'))
+        timing = response['Server-Timing']
+        self.assertIn(f'desc="{len(ctx)} queries"', timing)
+        self.assertRegex(timing, r'tpl;dur=[1-9]')
+        self.client.get(reverse('gadget_cave:home'))
+
+        stats = metrics.registry.snapshot()['gadget_cave:home']
+        self.assertEqual(stats['requests'], 2)
+        self.assertGreater(stats['template_seconds'], 0)
+        text = self.client.get(reverse('gadget_cave:metrics')).content.decode()
+        self.assertIn('gadget_cave_request_duration_seconds_count{view="gadget_cave:home"} 2', text)
+        self.assertIn('gadget_cave_request_queries_bucket{view="gadget_cave:home",le="+Inf"} 2', text)
+        self.assertIn('# TYPE gadget_cave_request_sql_seconds_total counter', text)
+
+        self.assertEqual(self.client.get(reverse('gadget_cave:metrics'), REMOTE_ADDR='203.0.113.9').status_code, 404)
+
+    def test_query_budgets(self):
+        with self.settings(QUERY_BUDGETS={'gadget_cave:home': 0}):
+            with self.assertRaises(metrics.QueryBudgetExceeded):
+                self.client.get(reverse('gadget_cave:home'))
+            with self.settings(QUERY_BUDGET_STRICT=False), self.assertLogs('gadget_cave.metrics', 'WARNING'):
+                self.assertEqual(self.client.get(reverse('gadget_cave:home')).status_code, 200)
+        self.assertEqual(metrics.registry.snapshot()['gadget_cave:home']['over_budget'], 2)
+
+
+class DatabaseSettingsTests(TransactionTestCase):
+    def test_sqlite_connections_are_tuned(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite settings')
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 20000)
+        self.assertEqual(connection.transaction_mode, 'IMMEDIATE')
+
+    def test_checkout_workload(self):
+        make_catalog(products=10, categories=2)
+        result = checkout_workload(writers=1, readers=1, seconds=0.3)
+        self.assertGreater(result['orders'], 0)
+        self.assertGreater(result['reads'], 0)
+        self.assertEqual(Order.objects.count(), result['orders'])
+
+
+class ReplicaRoutingTests(TransactionTestCase):
+    # 'replica' is a second test database (see gadgetcave/test_settings.py), kept
+    # in sync by the sync_replica command
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite replica file')
+        catalog_cache().clear()
+        replicas = override_settings(DATABASE_REPLICAS=['replica'])
+        replicas.enable()
+        self.addCleanup(replicas.disable)
+        make_catalog(products=3, categories=1)
+        call_command('sync_replica', stdout=StringIO())
+
+    def test_catalog_reads_the_replica_until_the_visitor_writes(self):
+        product = Product.objects.order_by('id').first()
+        product.name = 'Fresh Name'
+        product.save()
+        response = self.client.get(reverse('gadget_cave:home'))
+        self.assertNotContains(response, 'Fresh Name')
+        self.assertNotIn(routers.STICKY_COOKIE, response.cookies)
+
+        # Any POST (here a failed login) keeps the visitor on the primary
+        response = self.client.post(reverse('gadget_cave:login'), {'username': 'nobody', 'password': 'x'})
+        self.assertIn(routers.STICKY_COOKIE, response.cookies)
+        self.assertContains(self.client.get(reverse('gadget_cave:home')), 'Fresh Name')
+
+        # Everyone else sees the change once the replica has caught up
+        self.assertNotContains(self.client_class().get(reverse('gadget_cave:home')), 'Fresh Name')
+        call_command('sync_replica', stdout=StringIO())
+        self.assertContains(self.client_class().get(reverse('gadget_cave:home')), 'Fresh Name')
+
+    def test_writes_sessions_and_carts_use_the_primary(self):
+        user = CustomUser.objects.create_user('shopper', password='pw')
+        with routers.use_replicas():
+            self.assertEqual(Product.objects.all().db, 'replica')
+            self.assertEqual(Order.objects.all().db, 'replica')
+            self.assertEqual(CustomUser.objects.all().db, 'default')
+            self.assertEqual(Cart.objects.all().db, 'default')
+            product = Product.objects.order_by('id').first()
+            product.stock = 3
+            product.save()
+        self.assertEqual(Product.objects.using('default').get(pk=product.pk).stock, 3)
+        self.assertEqual(Product.objects.using('replica').get(pk=product.pk).stock, 10)
+        self.assertIs(router.allow_migrate('replica', 'gadget_cave'), False)
+
+        # A GET that writes (removing a cart line) is sticky too
+        self.client.force_login(user)
+        carts.add_item(user, product.pk, 1)
+        response = self.client.get(reverse('gadget_cave:cart_remove', args=[product.pk]))
+        self.assertIn(routers.STICKY_COOKIE, response.cookies)
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        catalog_cache().clear()
+        make_catalog(products=3, categories=1)
+        self.product = Product.objects.order_by('id').first()
+        self.user = CustomUser.objects.create_user('shopper', password='pw')
+        self.order = make_order(self.user, [self.product])
+
+    async def test_views_through_the_asgi_handler(self):
+        self.assertContains(await self.async_client.get(reverse('gadget_cave:home')), self.product.name)
+        self.assertContains(await self.async_client.get(reverse('gadget_cave:product_detail', args=[self.product.id, self.product.slug])), self.product.name)
+        response = await self.async_client.post(
+            reverse('gadget_cave:cart_update_api'), json.dumps({'items': [{'product': self.product.id, 'quantity': 2}]}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.json()['item_count'], 2)
+
+        await self.async_client.aforce_login(self.user)
+        await self.async_client.post(reverse('gadget_cave:cart_add', args=[self.product.id]), {'quantity': 3})
+        self.assertContains(await self.async_client.get(reverse('gadget_cave:cart_detail')), self.product.name)
+        self.assertEqual((await carts.aload_cart(self.user)).item_count, 3)
+        response = await self.async_client.get(reverse('gadget_cave:my_orders'))
+        self.assertEqual([order.id for order in response.context['orders']], [self.order.id])
+
+    @override_settings(ORDER_STATUS_POLL=0.02)
+    async def test_order_status_long_poll(self):
+        url = reverse('gadget_cave:order_status', args=[self.order.id])
+        self.assertEqual((await self.async_client.get(url)).status_code, 302)
+        await self.async_client.aforce_login(self.user)
+
+        # Already different from what the page shows: answers at once
+        response = await self.async_client.get(url, {'paid': '1', 'status': 'pending', 'wait': 10})
+        self.assertEqual(response.json(), {'paid': False, 'status': 'pending', 'changed': True, 'next': None})
+        # Unchanged: waits out ?wait=
+        response = await self.async_client.get(url, {'paid': '0', 'status': 'pending', 'wait': 0.05})
+        self.assertFalse(response.json()['changed'])
+
+        async def pay():
+            await asyncio.sleep(0.1)
+            await Order.objects.filter(id=self.order.id).aupdate(paid=True)
+
+        response, _ = await asyncio.gather(
+            self.async_client.get(url, {'paid': '0', 'status': 'pending', 'wait': 10}), pay(),
+        )
+        self.assertEqual(response.json()['next'], reverse('gadget_cave:order_confirmation', args=[self.order.id]))
+
+        other = await CustomUser.objects.acreate(username='other')
+        await self.async_client.aforce_login(other)
+        self.assertEqual((await self.async_client.get(url, {'wait': 0})).status_code, 404)
@@ -13,11 +13,16 @@ urlpatterns = [
     path('', views.home, name='home'),
     path('category/<slug:category_slug>/', views.product_list_by_category, name='product_list_by_category'),
     path('product/<int:id>/<slug:slug>/', views.product_detail, name='product_detail'),
+    path('api/products/', views.product_list_api, name='product_list_api'),
+    path('search/', views.product_search, name='product_search'),
+    path('api/search/', views.product_search_api, name='product_search_api'),
+    path('api/autocomplete/', views.autocomplete, name='autocomplete'),
 
     # Cart
     path('cart/add/<int:product_id>/', views.cart_add, name='cart_add'),
     path('cart/remove/<int:product_id>/', views.cart_remove, name='cart_remove'),
     path('cart/', views.cart_detail, name='cart_detail'),
+    path('api/cart/', views.cart_update_api, name='cart_update_api'),
 
    # Buy Now URL
     path('buy_now/<int:product_id>/', views.buy_now, name='buy_now'),
@@ -27,8 +32,14 @@ urlpatterns = [
     path('order/payment/<int:order_id>/', views.order_payment, name='order_payment'),
     path('order/confirmation/<int:order_id>/', views.order_confirmation, name='order_confirmation'),
     path('my-orders/', views.my_orders, name='my_orders'),
+    path('api/my-orders/', views.my_orders_api, name='my_orders_api'),
     path('order/payment/<int:order_id>/confirm/', views.confirm_payment, name='confirm_payment'),
+    path('api/order/<int:order_id>/status/', views.order_status, name='order_status'),
     path('order/confirmation/<int:order_id>/', views.order_confirmation, name='order_confirmation'),
+
+    # Ops
+    path('cache/stats/', views.cache_stats, name='cache_stats'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
 
 
@@ -1,50 +1,167 @@
-from django.shortcuts import render, redirect, get_object_or_404
+import asyncio
+import json
+import os
+
+from asgiref.sync import sync_to_async
+
+from django.shortcuts import aget_object_or_404, render, redirect, get_object_or_404
 from .models import Product, Category, Cart, CartItem, Order, OrderItem, CustomUser # Ensure CustomUser is imported
 from .forms import CartAddProductForm, OrderCreateForm, CustomUserCreationForm
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
+from django.conf import settings
 from django.contrib import messages
 from django.db import transaction # For atomic operations
+from django.utils import timezone
 from django.contrib.auth.forms import AuthenticationForm # Imported here for login_view
 from django.shortcuts import render, get_object_or_404, redirect
+from django.http import Http404, HttpResponse, JsonResponse
+from django.urls import reverse
+from django.views.decorators.http import require_POST
+from . import carts, metrics, orders
+from .routers import replica_reads
+from .cache import get_categories, get_category, get_product_bundle, stats as fragment_stats
+from .inventory import InsufficientStock, commit_reservations, place_order
+from .catalog import CATALOG_SORTS, DEFAULT_SORT, SORT_CHOICES, acatalog_page
+from .pagination import InvalidCursor
+from .search import search
+from .autocomplete import suggestions
+
+# Async views (catalog, cart, order history, payment status): under ASGI
+# they run in the event loop and only borrow a thread for each query. Cart
+# changes and the cache helpers run in one thread hop each (transactions
+# and cache fills are sync-only), and templates render in a thread because
+# the header badge and fragment-cache misses may still query.
+
+async def _arender(request, template_name, context):
+    return await sync_to_async(render)(request, template_name, context)
+
+async def _auser(request):
+    # Resolved once without blocking; the templates then read request.user without a query
+    request.user = user = await request.auser()
+    return user
+
+async def _acatalog_context(request, category=None):
+    sort = request.GET.get('sort', DEFAULT_SORT)
+    if sort not in CATALOG_SORTS:
+        sort = DEFAULT_SORT
+    try:
+        page = await acatalog_page(category=category, sort=sort, cursor=request.GET.get('cursor'))
+    except InvalidCursor:
+        raise Http404("Invalid page cursor.")
+    return {
+        'category': category,
+        'categories': get_categories, # called by the template only when the sidebar isn't cached
+        'products': page,
+        'page': page,
+        'sort': sort,
+        'sort_choices': SORT_CHOICES,
+    }
+
+@replica_reads
+async def home(request):
+    return await _arender(request, 'gadget_cave/product/list.html', await _acatalog_context(request))
 
-def home(request):
-    products = Product.objects.filter(available=True)
-    categories = Category.objects.all()
-    return render(request, 'gadget_cave/product/list.html', {'products': products, 'categories': categories})
+@replica_reads
+async def product_list_by_category(request, category_slug=None):
+    category = None
+    if category_slug:
+        category = await sync_to_async(get_category)(category_slug)
+        if category is None:
+            raise Http404("No category matches the given query.")
+    return await _arender(request, 'gadget_cave/product/list.html', await _acatalog_context(request, category))
+
+@replica_reads
+async def product_list_api(request):
+    category = None
+    category_slug = request.GET.get('category')
+    if category_slug:
+        category = await sync_to_async(get_category)(category_slug)
+        if category is None:
+            raise Http404("No category matches the given query.")
+    try:
+        page = await acatalog_page(category=category, sort=request.GET.get('sort', DEFAULT_SORT),
+                                   cursor=request.GET.get('cursor'))
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({
+        'results': [
+            {
+                'id': product.id,
+                'name': product.name,
+                'price': str(product.price),
+                'url': product.get_absolute_url(),
+                'image': product.main_image.url if product.main_image else None,
+            }
+            for product in page
+        ],
+        'next_cursor': page.next_cursor,
+    })
 
-def product_list_by_category(request, category_slug=None):
+def _search_params(request):
     category = None
-    categories = Category.objects.all()
-    products = Product.objects.filter(available=True)
+    category_slug = request.GET.get('category')
     if category_slug:
-        category = get_object_or_404(Category, slug=category_slug)
-        products = products.filter(category=category)
-    return render(request, 'gadget_cave/product/list.html', {
+        category = get_category(category_slug)
+        if category is None:
+            raise Http404("No category matches the given query.")
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+    except ValueError:
+        page = 1
+    return request.GET.get('q', '').strip()[:200], category, page
+
+def product_search(request):
+    query, category, page = _search_params(request)
+    return render(request, 'gadget_cave/product/search.html', {
+        'results': search(query, category=category, page=page),
         'category': category,
-        'categories': categories,
-        'products': products
     })
 
-def product_detail(request, id, slug):
-    product = get_object_or_404(Product, id=id, slug=slug, available=True)
+def product_search_api(request):
+    # Typeahead: the last word typed may be incomplete
+    query, category, page = _search_params(request)
+    results = search(query, category=category, page=page, per_page=10, prefix=True)
+    return JsonResponse({
+        'results': [
+            {'id': product.id, 'name': product.name, 'price': str(product.price), 'url': product.get_absolute_url()}
+            for product in results
+        ],
+        'total': results.total,
+        'facets': [{'category': c.slug, 'name': c.name, 'count': count} for c, count in results.facets],
+        'has_next': results.has_next,
+    })
+
+def autocomplete(request):
+    # Served from the in-process prefix index; no database query per keystroke
+    query = request.GET.get('q', '')[:100]
+    return JsonResponse({'q': query, 'suggestions': suggestions(query)})
+
+@replica_reads
+async def product_detail(request, id, slug):
+    # Product, category and images from the read-through cache (404s are cached too)
+    product = await sync_to_async(get_product_bundle)(id, slug)
+    if product is None:
+        raise Http404("No Product matches the given query.")
     cart_product_form = CartAddProductForm()
-    return render(request, 'gadget_cave/product/detail.html', {
+    return await _arender(request, 'gadget_cave/product/detail.html', {
         'product': product,
         'cart_product_form': cart_product_form
     })
 
 
 
-@login_required
-def cart_detail(request):
+async def cart_detail(request):
+    user = await _auser(request)
+    if not user.is_authenticated:
+        # Guest cart from the signed cookie: one read query, no writes
+        cart = request.guest_cart
+        return await _arender(request, 'gadget_cave/cart/details.html', {'cart': cart, 'cart_items': await cart.aitems()})
+
     cart = None
     try:
-        cart = Cart.objects.get(user=request.user)
-    except Cart.DoesNotExist:
-        # If the cart doesn't exist, it means the user hasn't added anything yet.
-        # We can just pass a None cart or an empty list of items.
-        pass # cart remains None
+        cart = await carts.aload_cart(user)
 
     except Exception as e:
         # This handles the "ValueError: Cannot query 'hisham'" or similar
@@ -54,45 +171,105 @@ def cart_detail(request):
         # It's good practice to log this error too in a real application
 
     # This line is correct for the template path 'gadget_cave/cart/details.html'
-    return render(request, 'gadget_cave/cart/details.html', {'cart': cart})
-@login_required
-def cart_add(request, product_id):
-    product = get_object_or_404(Product, id=product_id)
-    # Get or create cart for the logged-in user
-    cart, created = Cart.objects.get_or_create(user=request.user)
-    
+    return await _arender(request, 'gadget_cave/cart/details.html', {
+        'cart': cart,
+        'cart_items': cart.items.all() if cart else [],
+    })
+
+def _guest_cart_add(request, product, quantity, override=False):
+    # Guests: the cart is a signed cookie, so adding is a read of the product and no writes
+    cart = request.guest_cart
+    in_cart = 0 if override else cart.quantity(product.id)
+    if in_cart + quantity > product.stock:
+        messages.error(request, f'Adding {quantity} more {product.name}(s) would exceed stock. Current in cart: {in_cart}, Stock: {product.stock}.')
+        return redirect('gadget_cave:product_detail', id=product.id, slug=product.slug)
+    try:
+        cart.set(product.id, in_cart + quantity)
+    except ValueError as e:
+        messages.error(request, str(e))
+        return redirect('gadget_cave:cart_detail')
+    messages.success(request, f'{quantity} x {product.name} added to your cart.')
+    return redirect('gadget_cave:cart_detail')
+
+async def cart_add(request, product_id):
+    product = await aget_object_or_404(Product.objects.only('id', 'name', 'slug', 'stock'), id=product_id, available=True)
     form = CartAddProductForm(request.POST)
+    user = await _auser(request)
+    if not user.is_authenticated:
+        if form.is_valid():
+            return _guest_cart_add(request, product, form.cleaned_data['quantity'], form.cleaned_data['override'])
+        return redirect('gadget_cave:cart_detail')
+
     if form.is_valid():
         quantity = form.cleaned_data['quantity']
-        
-        # Check if requested quantity exceeds available stock
-        if quantity > product.stock:
-            messages.error(request, f'Only {product.stock} items of {product.name} are available.')
+        # One upsert checks stock and adds (or, from the cart page's update form, sets) the quantity
+        try:
+            change = carts.set_quantity if form.cleaned_data['override'] else carts.add_item
+            await sync_to_async(change)(user, product.id, quantity)
+        except InsufficientStock as e:
+            shortfall, = e.shortfalls
+            in_cart = shortfall.requested - quantity
+            if in_cart:
+                messages.error(request, f'Adding {quantity} more {product.name}(s) would exceed stock. Current in cart: {in_cart}, Stock: {shortfall.available}.')
+            else:
+                messages.error(request, f'Only {shortfall.available} items of {product.name} are available.')
             return redirect('gadget_cave:product_detail', id=product.id, slug=product.slug)
-
-        # Try to get the item, if it exists, update quantity
-        cart_item, created = CartItem.objects.get_or_create(
-            cart=cart, product=product,
-            defaults={'quantity': quantity}
-        )
-        if not created:
-            # If item already in cart, update quantity
-            if cart_item.quantity + quantity > product.stock:
-                messages.error(request, f'Adding {quantity} more {product.name}(s) would exceed stock. Current in cart: {cart_item.quantity}, Stock: {product.stock}.')
-                return redirect('gadget_cave:product_detail', id=product.id, slug=product.slug)
-            cart_item.quantity += quantity
-            cart_item.save()
         messages.success(request, f'{quantity} x {product.name} added to your cart.')
     return redirect('gadget_cave:cart_detail')
 
-@login_required
-def cart_remove(request, product_id):
-    cart = get_object_or_404(Cart, user=request.user)
-    product = get_object_or_404(Product, id=product_id)
-    cart_item = get_object_or_404(CartItem, cart=cart, product=product)
-    cart_item.delete()
-    messages.success(request, f'{product.name} removed from your cart.')
+async def cart_remove(request, product_id):
+    user = await _auser(request)
+    if not user.is_authenticated:
+        product = await aget_object_or_404(Product.objects.only('id', 'name'), id=product_id)
+        request.guest_cart.remove(product.id)
+        messages.success(request, f'{product.name} removed from your cart.')
+        return redirect('gadget_cave:cart_detail')
+    # A single DELETE; the name is only read for the message
+    if not await sync_to_async(carts.remove_item)(user, product_id):
+        raise Http404("No CartItem matches the given query.")
+    name = await Product.objects.filter(id=product_id).values_list('name', flat=True).afirst()
+    messages.success(request, f'{name} removed from your cart.')
     return redirect('gadget_cave:cart_detail')
+
+def _cart_changes(request):
+    """{product_id: quantity} from a JSON body {"items": [{"product": id, "quantity": n}, ...]}; 0 removes."""
+    try:
+        lines = json.loads(request.body)['items']
+        if not isinstance(lines, list) or len(lines) > carts.MAX_BATCH:
+            raise ValueError
+        changes = {}
+        for line in lines:
+            product_id, quantity = line['product'], 0 if line.get('remove') else line['quantity']
+            if type(product_id) is not int or type(quantity) is not int or quantity < 0:
+                raise ValueError
+            changes[product_id] = quantity
+        return changes
+    except (ValueError, KeyError, TypeError):
+        return None
+
+@require_POST
+async def cart_update_api(request):
+    # Many quantity changes and removals in one request and one transaction; replies with the updated cart
+    changes = _cart_changes(request)
+    if changes is None:
+        return JsonResponse({'error': f'Expected {{"items": [{{"product": <id>, "quantity": <n>}}, ...]}} with at most {carts.MAX_BATCH} items.'}, status=400)
+    user = await _auser(request)
+    try:
+        if user.is_authenticated:
+            await sync_to_async(carts.apply_changes)(user, changes)
+        else:
+            await sync_to_async(carts.apply_guest_changes)(request.guest_cart, changes)
+    except InsufficientStock as e:
+        return JsonResponse({
+            'error': 'Not enough stock.',
+            'shortfalls': [{'product': s.product_id, 'requested': s.requested, 'available': s.available} for s in e.shortfalls],
+        }, status=409)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    if user.is_authenticated:
+        cart = await carts.aload_cart(user)
+        return JsonResponse(carts.cart_json(cart, cart.items.all() if cart else []))
+    return JsonResponse(carts.cart_json(request.guest_cart, await request.guest_cart.aitems()))
 # gadget_cave/views.py
 
 
@@ -149,13 +326,14 @@ def order_create(request):
 
     else:
         # ഇത് കാർട്ട് ഫ്ലോ ആണ്
-        cart = get_object_or_404(Cart, user=request.user)
-        if not cart.items.exists():
+        cart = get_object_or_404(Cart.objects.with_totals(), user=request.user)
+        cart_items = list(cart.items.select_related('product'))
+        if not cart_items:
             messages.warning(request, 'Your cart is empty. Please add items before placing an order.')
             return redirect('gadget_cave:cart_detail')
 
         # കാർട്ടിലെ സ്റ്റോക്ക് പരിശോധിക്കുക
-        for item in cart.items.all():
+        for item in cart_items:
             if item.quantity > item.product.stock:
                 messages.error(request, f'Not enough stock for {item.product.name}. Only {item.product.stock} available in stock, but you have {item.quantity} in cart.')
                 return redirect('gadget_cave:cart_detail')
@@ -171,38 +349,35 @@ def order_create(request):
     if request.method == 'POST':
         form = OrderCreateForm(request.POST)
         if form.is_valid():
-            with transaction.atomic():
-                order = form.save(commit=False)
-                order.user = request.user # ലോഗിൻ ചെയ്ത യൂസറിനെ ഓർഡറിലേക്ക് ചേർക്കുക
-                order.save()
-
-                # Buy Now ആണെങ്കിൽ ഒരു പ്രോഡക്റ്റും, കാർട്ട് ആണെങ്കിൽ കാർട്ടിലുള്ളതെല്ലാം ഓർഡർ ഐറ്റംസ് ആക്കുക
-                for item_data in products_to_order_display:
-                    product = item_data['product']
-                    quantity = item_data['quantity']
-                    price = item_data['price']
-
-                    OrderItem.objects.create(
-                        order=order,
-                        product=product,
-                        price=price,
-                        quantity=quantity
-                    )
-                    # സ്റ്റോക്ക് കുറയ്ക്കുക
-                    product.stock -= quantity
-                    product.save()
-
-                # സെഷൻ വേരിയബിൾ ക്ലിയർ ചെയ്യുക (Buy Now ആണെങ്കിൽ)
+            order = form.save(commit=False)
+            order.user = request.user # ലോഗിൻ ചെയ്ത യൂസറിനെ ഓർഡറിലേക്ക് ചേർക്കുക
+            lines = [(item['product'], item['quantity'], item['price']) for item in products_to_order_display]
+            try:
+                with transaction.atomic():
+                    # Buy Now ആണെങ്കിൽ ഒരു പ്രോഡക്റ്റും, കാർട്ട് ആണെങ്കിൽ കാർട്ടിലുള്ളതെല്ലാം ഓർഡർ ഐറ്റംസ് ആക്കുക
+                    # Stock for every line is taken in one conditional UPDATE (see inventory.place_order)
+                    place_order(order, lines)
+
+                    # കാർട്ട് ക്ലിയർ ചെയ്യുക (കാർട്ട് ഫ്ലോ ആണെങ്കിൽ)
+                    if not buy_now_product_id:
+                        cart.items.all().delete()
+                        carts.summary_changed(request.user.pk)
+            except InsufficientStock as e:
+                names = {item['product'].id: item['product'].name for item in products_to_order_display}
+                for shortfall in e.shortfalls:
+                    messages.error(request, f'Not enough stock for {names[shortfall.product_id]}. Only {shortfall.available or 0} available, but you requested {shortfall.requested}.')
                 if buy_now_product_id:
-                    del request.session['buy_now_product_id']
-                    if 'buy_now_quantity' in request.session: del request.session['buy_now_quantity']
+                    product = products_to_order_display[0]['product']
+                    return redirect('gadget_cave:product_detail', id=product.id, slug=product.slug)
+                return redirect('gadget_cave:cart_detail')
 
-                # കാർട്ട് ക്ലിയർ ചെയ്യുക (കാർട്ട് ഫ്ലോ ആണെങ്കിൽ)
-                else: # buy_now_product_id ഇല്ലെങ്കിൽ അത് കാർട്ട് ആണ്
-                    cart.items.all().delete()
+            # സെഷൻ വേരിയബിൾ ക്ലിയർ ചെയ്യുക (Buy Now ആണെങ്കിൽ)
+            if buy_now_product_id:
+                del request.session['buy_now_product_id']
+                if 'buy_now_quantity' in request.session: del request.session['buy_now_quantity']
 
-                messages.success(request, 'Your order details have been saved. Please proceed to payment.')
-                return redirect('gadget_cave:order_payment', order_id=order.id)
+            messages.success(request, 'Your order details have been saved. Please proceed to payment.')
+            return redirect('gadget_cave:order_payment', order_id=order.id)
         else:
             messages.error(request, 'Please correct the errors in the shipping information.')
     else:
@@ -232,10 +407,13 @@ def order_create(request):
     return render(request, 'gadget_cave/order/create.html', context)
 @login_required
 def order_payment(request, order_id):
-    order = get_object_or_404(Order, id=order_id, user=request.user)
+    order = get_object_or_404(Order.objects.with_totals(), id=order_id, user=request.user)
     if order.paid:
         messages.info(request, "This order has already been paid.")
         return redirect('gadget_cave:order_confirmation', order_id=order.id)
+    if order.status == 'cancelled':
+        messages.error(request, "This order expired before payment and its items were released. Please place a new order.")
+        return redirect('gadget_cave:my_orders')
 
     total_amount = order.get_total_cost()
     upi_id = "hixzam313@okaxis" # Replace with your actual UPI ID
@@ -257,24 +435,94 @@ def confirm_payment(request, order_id):
         upi_transaction_id = request.POST.get('upi_transaction_id', '')
 
         with transaction.atomic():
-            order.paid = True  # Mark order as paid
+            # Mark order as paid, as the admin's mark_paid does (see order_status.TRANSITIONS)
+            fields = {'paid': True, 'payment_status': 'completed', 'updated': timezone.now()}
             if upi_transaction_id:
-                order.upi_transaction_id = upi_transaction_id # Save the transaction ID
-            order.save()
+                fields['transaction_id'] = upi_transaction_id # Save the transaction ID
+            # Conditional update, so a payment can't race reap_reservations cancelling the order
+            confirmed = Order.objects.filter(id=order.id, paid=False).exclude(status='cancelled').update(**fields)
+            if confirmed:
+                commit_reservations(order)
+        if confirmed or order.paid:
             messages.success(request, 'Your payment has been confirmed! Order placed successfully.')
             return redirect('gadget_cave:order_confirmation', order_id=order.id)
+        messages.error(request, 'This order expired before payment was confirmed and its items were released. Please place a new order.')
+        return redirect('gadget_cave:my_orders')
     messages.error(request, 'Invalid request for payment confirmation.')
     return redirect('gadget_cave:order_payment', order_id=order.id) # Redirect back to payment if invalid
 
 @login_required
 def order_confirmation(request, order_id):
-    order = get_object_or_404(Order, id=order_id, user=request.user)
+    order = get_object_or_404(Order.objects.with_totals(), id=order_id, user=request.user)
     return render(request, 'gadget_cave/order/confirmation.html', {'order': order})
 
 @login_required
-def my_orders(request):
-    orders = Order.objects.filter(user=request.user).order_by('-created')
-    return render(request, 'gadget_cave/account/my_orders.html', {'orders': orders})
+@replica_reads
+async def my_orders(request):
+    # One page of history; the "More orders" link (and the infinite scroll in the page) goes on from its cursor
+    user = await _auser(request)
+    try:
+        page = await orders.ahistory_page(user, request.GET.get('cursor'))
+    except InvalidCursor:
+        raise Http404("Invalid page cursor.")
+    return await _arender(request, 'gadget_cave/account/my_orders.html', {'orders': page, 'page': page})
+
+@login_required
+@replica_reads
+async def my_orders_api(request):
+    # Infinite scroll: the same page as my_orders, as JSON; always two queries for the orders
+    user = await _auser(request)
+    try:
+        page = await orders.ahistory_page(user, request.GET.get('cursor'))
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'results': [orders.order_json(order) for order in page], 'next_cursor': page.next_cursor})
+
+@login_required
+async def order_status(request, order_id):
+    # Long poll for the payment page: answers as soon as the order's payment state
+    # differs from ?paid=&status= (what the page shows), or after ?wait= seconds.
+    # Under ASGI a waiting poll holds no thread; each check is one short query.
+    user = await _auser(request)
+    known = (request.GET.get('paid') == '1', request.GET.get('status'))
+    max_wait = getattr(settings, 'ORDER_STATUS_WAIT', 25)
+    poll_every = getattr(settings, 'ORDER_STATUS_POLL', 1.0)
+    try:
+        wait = max(0.0, min(float(request.GET.get('wait', max_wait)), max_wait))
+    except ValueError:
+        wait = max_wait
+    deadline = asyncio.get_running_loop().time() + wait
+    current = Order.objects.filter(id=order_id, user=user).values_list('paid', 'status')
+    while True:
+        state = await current.afirst()
+        if state is None:
+            raise Http404("No Order matches the given query.")
+        remaining = deadline - asyncio.get_running_loop().time()
+        if state != known or remaining <= 0:
+            break
+        await asyncio.sleep(min(poll_every, remaining))
+    paid, status = state
+    return JsonResponse({
+        'paid': paid,
+        'status': status,
+        'changed': state != known,
+        'next': reverse('gadget_cave:order_confirmation', args=[order_id]) if paid else None,
+    })
+
+@staff_member_required
+def cache_stats(request):
+    # Per-process counters: with several workers, each reports its own share
+    return JsonResponse({
+        'backend': settings.CACHES[getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')]['BACKEND'],
+        'pid': os.getpid(),
+        'fragments': fragment_stats.snapshot(),
+    })
+
+def metrics_view(request):
+    # Prometheus scrape endpoint: local addresses (or staff) only
+    if request.META.get('REMOTE_ADDR') not in getattr(settings, 'METRICS_ALLOWED_IPS', ()) and not request.user.is_staff:
+        raise Http404
+    return HttpResponse(metrics.registry.prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 # Authentication views
 def register_view(request):
@@ -0,0 +1,17 @@
+# gadgetcave/test_settings.py
+#
+# Settings for the test suite. `manage.py test` uses them; other runners
+# take DJANGO_SETTINGS_MODULE=gadgetcave.test_settings.
+from .settings import *  # noqa: F401,F403
+from .settings import DATABASES
+
+# Nothing is routed to a replica in the test suite; ReplicaRoutingTests
+# turns routing on with a replica test database of its own
+DATABASE_REPLICAS = []
+DATABASES['replica'] = {
+    **DATABASES['default'],
+    'TEST': {'NAME': None if DATABASES['default']['ENGINE'].endswith('sqlite3') else 'test_gadgetcave_replica'},
+}
+
+# A view over its query budget fails the test that requested it
+QUERY_BUDGET_STRICT = True
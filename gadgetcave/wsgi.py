@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gadgetcave.settings')
 
 application = get_wsgi_application()
+
+# Build the in-memory autocomplete index in the background, off the request path
+from gadget_cave.autocomplete import start  # noqa: E402
+start()